@@ -0,0 +1,128 @@
+# abx_bits.py
+import re
+
+import numpy as np
+import pandas as pd
+
+# Bit layout: bit = antibiotic * len(SOURCES) + source (fits in an int64 column)
+ANTIBIOTICS = ['Vancomycin', 'Cefepime', 'Piperacillin/Tazobactam', 'Meropenem', 'Cefazolin']
+SOURCES = ['inputevents', 'prescriptions', 'pharmacy', 'emar', 'microbiology']
+
+CODE_COLUMN = 'antibiotic_code'
+
+# emar events that mean the dose was actually given
+ADMINISTERED_EVENTS = {
+    'Administered', 'Started', 'Restarted', 'Partial Administered',
+    'Delayed Administered', 'Delayed Started', 'Administered Bolus from IV Drip'
+}
+
+# Substring patterns that identify each antibiotic in free-text medication names
+NAME_PATTERNS = {
+    'Vancomycin': 'vancomycin',
+    'Cefepime': 'cefepime',
+    'Piperacillin/Tazobactam': 'piperacillin|tazobactam',
+    'Meropenem': 'meropenem',
+    'Cefazolin': 'cefazolin',
+}
+
+# Medication name -> antibiotic position (-1 = not an antibiotic), filled lazily
+_name_cache = {}
+
+
+def _normalize(names):
+    """Lower-case names with dash/slash variants folded together"""
+    return (pd.Series(names, dtype=object).fillna('').astype(str).str.lower()
+            .str.replace(r'[–—/]', '-', regex=True).str.strip())
+
+
+def _index(values, vocabulary):
+    """Position of each normalized value in the normalized vocabulary (-1 if absent)"""
+    lookup = {v: i for i, v in enumerate(_normalize(vocabulary))}
+    return _normalize(values).map(lookup).fillna(-1).to_numpy(dtype=np.int64)
+
+
+def antibiotic_index(names):
+    """Canonical antibiotic position for ICU labels ('Piperacillin/Tazobactam') and hosp names"""
+    return _index(names, ANTIBIOTICS)
+
+
+def match_medication_names(names):
+    """Antibiotic position for free-text medication names (-1 if none), cached per distinct name
+
+    emar/pharmacy repeat a few thousand names over tens of millions of rows,
+    so each distinct name is pattern-matched once and then looked up.
+    """
+    names = pd.Series(names, dtype=object).fillna('')
+    new = [n for n in names.unique() if n not in _name_cache]
+    if new:
+        lowered = pd.Series(new, dtype=object).str.lower()
+        found = np.full(len(new), -1, dtype=np.int64)
+        for a, antibiotic in enumerate(ANTIBIOTICS):
+            hit = lowered.str.contains(NAME_PATTERNS[antibiotic], regex=True).to_numpy()
+            found = np.where((found < 0) & hit, a, found)
+        _name_cache.update(zip(new, found.tolist()))
+    return names.map(_name_cache).to_numpy(dtype=np.int64)
+
+
+def source_index(sources):
+    """Source position for 'inputevents.csv'-style file names and hosp source labels"""
+    stripped = pd.Series(sources, dtype=object).astype(str).str.replace(r'\.csv$', '', regex=True)
+    return _index(stripped, SOURCES)
+
+
+def pair_bits(abx_idx, src_idx):
+    """One bit per (antibiotic, source) pair; 0 where either is unknown"""
+    valid = (abx_idx >= 0) & (src_idx >= 0)
+    shift = np.where(valid, abx_idx * len(SOURCES) + src_idx, 0)
+    return np.where(valid, np.left_shift(np.int64(1), shift), 0).astype(np.int64)
+
+
+def encode_records(records, antibiotic_column='antibiotic', source_column='source'):
+    """Bits for long-format records; multi-source cells ('emar; pharmacy') set several bits"""
+    sources = records[source_column].fillna('').astype(str).str.split(r'\s*;\s*')
+    counts = sources.str.len().to_numpy()
+    abx = np.repeat(antibiotic_index(records[antibiotic_column].to_numpy()), counts)
+    src = source_index(np.concatenate(sources.to_numpy()) if len(sources) else [])
+    bits = pair_bits(abx, src)
+    # Fold the per-source bits back onto their record
+    owner = np.repeat(np.arange(len(records)), counts)
+    return _or_reduce(owner, bits, len(records))
+
+
+def _or_reduce(keys, bits, n):
+    """Bitwise OR of bits per dense key in [0, n)"""
+    out = np.zeros(n, dtype=np.int64)
+    if len(keys) == 0:
+        return out
+    order = np.argsort(keys, kind='stable')
+    keys, bits = keys[order], bits[order]
+    first = np.r_[0, np.flatnonzero(np.diff(keys)) + 1]
+    out[keys[first]] = np.bitwise_or.reduceat(bits, first)
+    return out
+
+
+def aggregate_codes(subject_ids, bits):
+    """Per-subject OR of bits -> DataFrame(subject_id, antibiotic_code), vectorized"""
+    subjects, inverse = np.unique(np.asarray(subject_ids, dtype=np.int64), return_inverse=True)
+    codes = _or_reduce(inverse, np.asarray(bits, dtype=np.int64), len(subjects))
+    frame = pd.DataFrame({'subject_id': subjects, CODE_COLUMN: codes})
+    return frame[frame[CODE_COLUMN] != 0].reset_index(drop=True)
+
+
+def _slug(name):
+    return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+
+
+def expand_codes(codes, level='antibiotic'):
+    """One-hot columns from codes: per antibiotic (any source) or per (antibiotic, source) pair"""
+    codes = np.asarray(codes, dtype=np.int64)
+    columns = {}
+    for a, antibiotic in enumerate(ANTIBIOTICS):
+        if level == 'antibiotic':
+            mask = sum(1 << (a * len(SOURCES) + s) for s in range(len(SOURCES)))
+            columns[f'abx_{_slug(antibiotic)}'] = ((codes & mask) != 0).astype(np.int8)
+        else:
+            for s, source in enumerate(SOURCES):
+                bit = np.int64(1 << (a * len(SOURCES) + s))
+                columns[f'abx_{_slug(antibiotic)}__{source}'] = ((codes & bit) != 0).astype(np.int8)
+    return pd.DataFrame(columns)
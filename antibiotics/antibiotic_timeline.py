@@ -0,0 +1,181 @@
+# antibiotic_timeline.py
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from chunk_reader import read_csv_chunks
+from cohort import subject_index, to_epoch_seconds
+from concepts import concept_itemids
+from sampling import apply_sample
+from abx_bits import ADMINISTERED_EVENTS, ANTIBIOTICS, match_medication_names
+
+print("=== EXTRACTING ANTIBIOTIC TIMELINE & SUSPECTED INFECTION ===")
+
+# Configuration
+data_path = "/home/nishat/physionet.org/files/mimiciv/3.1/"
+administrations_file = "antibiotic_administrations.csv"
+output_file = "antibiotic_timeline.csv"
+
+# Antibiotic itemids from d_items.csv (via the concept dictionary)
+abx_itemids = {name: int(concept_itemids(name)[0]) for name in ANTIBIOTICS}
+
+# Sepsis-3 suspicion of infection windows (Seymour et al.)
+CULTURE_AFTER_ABX_HOURS = 24
+ABX_AFTER_CULTURE_HOURS = 72
+
+
+def load_emar_times(cohort_ids, chunksize=None):
+    """Antibiotic administration times from emar"""
+    records = []
+    chunks = read_csv_chunks(os.path.join(data_path, 'hosp/emar.csv'), chunksize=chunksize, subjects=cohort_ids,
+                             usecols=['subject_id', 'charttime', 'medication', 'event_txt'])
+    for i, chunk in enumerate(chunks):
+        abx = match_medication_names(chunk['medication'].to_numpy())
+        keep = ((abx >= 0) & chunk['event_txt'].isin(ADMINISTERED_EVENTS).to_numpy()
+                & chunk['charttime'].notna().to_numpy()
+                & (subject_index(cohort_ids, chunk['subject_id'].to_numpy()) >= 0))
+        chunk = chunk[keep]
+        if not chunk.empty:
+            records.append(pd.DataFrame({
+                'subject_id': chunk['subject_id'].to_numpy(),
+                'time': to_epoch_seconds(chunk['charttime']),
+                'antibiotic': np.asarray(ANTIBIOTICS, dtype=object)[abx[keep]],
+                'source': 'emar'
+            }))
+        if i % 10 == 0:
+            print(f"  emar: processed {i+1} chunks...")
+    return records
+
+
+def load_inputevents_times(cohort_ids, chunksize=None):
+    """Antibiotic administration times from ICU inputevents"""
+    records = []
+    itemid_to_name = {v: k for k, v in abx_itemids.items()}
+    chunks = read_csv_chunks(os.path.join(data_path, 'icu/inputevents.csv'), chunksize=chunksize,
+                             subjects=cohort_ids, usecols=['subject_id', 'starttime', 'itemid'])
+    for i, chunk in enumerate(chunks):
+        chunk = chunk[chunk['itemid'].isin(itemid_to_name.keys()) & chunk['starttime'].notna()]
+        idx = subject_index(cohort_ids, chunk['subject_id'].to_numpy())
+        chunk = chunk[idx >= 0]
+        if not chunk.empty:
+            records.append(pd.DataFrame({
+                'subject_id': chunk['subject_id'].to_numpy(),
+                'time': to_epoch_seconds(chunk['starttime']),
+                'antibiotic': chunk['itemid'].map(itemid_to_name).to_numpy(),
+                'source': 'inputevents'
+            }))
+        if i % 10 == 0:
+            print(f"  inputevents: processed {i+1} chunks...")
+    return records
+
+
+def load_culture_times(cohort_ids):
+    """One time per culture specimen from microbiologyevents (charttime, else chartdate)"""
+    micro = pd.read_csv(os.path.join(data_path, 'hosp/microbiologyevents.csv'),
+                        usecols=['subject_id', 'micro_specimen_id', 'chartdate', 'charttime'])
+    micro = micro[subject_index(cohort_ids, micro['subject_id'].to_numpy()) >= 0]
+    micro = micro.drop_duplicates('micro_specimen_id')
+    when = micro['charttime'].fillna(micro['chartdate'])
+    return micro['subject_id'].to_numpy(dtype=np.int64), to_epoch_seconds(when)
+
+
+def _subject_keys(subject_idx, times, origin, span):
+    """Composite sort keys that keep each subject's times in a disjoint range"""
+    return subject_idx * span + (times - origin)
+
+
+def first_in_window(query_keys, target_keys, window_seconds):
+    """For each query, position of the first target in [query, query + window] (or -1)
+
+    Both key arrays must come from _subject_keys with a span larger than the
+    window, so a single searchsorted never matches across subjects.
+    """
+    if len(target_keys) == 0:
+        return np.full(len(query_keys), -1)
+    pos = np.minimum(np.searchsorted(target_keys, query_keys, side='left'), len(target_keys) - 1)
+    found = (target_keys[pos] >= query_keys) & (target_keys[pos] <= query_keys + window_seconds)
+    return np.where(found, pos, -1)
+
+
+def suspected_infection_onset(n_subjects, abx_idx, abx_time, culture_idx, culture_time):
+    """Sepsis-3 suspicion-of-infection onset per dense subject index (NaN if none)
+
+    Antibiotic first: a culture within 24 h after it, onset = antibiotic time.
+    Culture first: an antibiotic within 72 h after it, onset = culture time.
+    """
+    if len(abx_time) == 0 or len(culture_time) == 0:
+        return np.full(n_subjects, np.nan)
+
+    never = np.iinfo(np.int64).max
+    onset = np.full(n_subjects, never)
+    origin = min(abx_time.min(), culture_time.min())
+    span = max(abx_time.max(), culture_time.max()) - origin + ABX_AFTER_CULTURE_HOURS * 3600 + 1
+
+    abx_keys = np.sort(_subject_keys(abx_idx, abx_time, origin, span))
+    culture_keys = np.sort(_subject_keys(culture_idx, culture_time, origin, span))
+
+    # Direction 1: antibiotic -> culture within 24 h
+    hit = abx_keys[first_in_window(abx_keys, culture_keys, CULTURE_AFTER_ABX_HOURS * 3600) >= 0]
+    np.minimum.at(onset, hit // span, hit % span + origin)
+
+    # Direction 2: culture -> antibiotic within 72 h
+    hit = culture_keys[first_in_window(culture_keys, abx_keys, ABX_AFTER_CULTURE_HOURS * 3600) >= 0]
+    np.minimum.at(onset, hit // span, hit % span + origin)
+
+    return np.where(onset == never, np.nan, onset.astype(float))
+
+
+def main():
+    """Build the antibiotic timeline and suspicion-of-infection windows"""
+    cohort = apply_sample(pd.read_csv('ICU/patients.csv'))
+    cohort_ids = np.sort(cohort['subject_id'].unique()).astype(np.int64)
+    print(f"Patients: {len(cohort_ids)}")
+
+    records = load_emar_times(cohort_ids) + load_inputevents_times(cohort_ids)
+    if records:
+        administrations = pd.concat(records, ignore_index=True)
+    else:
+        administrations = pd.DataFrame(columns=['subject_id', 'time', 'antibiotic', 'source'])
+    administrations = administrations.sort_values(['subject_id', 'time']).reset_index(drop=True)
+    print(f"Antibiotic administrations: {len(administrations)}")
+
+    culture_subject, culture_time = load_culture_times(cohort_ids)
+    print(f"Cultures: {len(culture_time)}")
+
+    abx_subject = administrations['subject_id'].to_numpy(dtype=np.int64)
+    abx_time = administrations['time'].to_numpy(dtype=np.int64)
+    abx_idx = subject_index(cohort_ids, abx_subject)
+    n = len(cohort_ids)
+
+    timeline = pd.DataFrame({'subject_id': cohort_ids})
+
+    first_abx = np.full(n, np.iinfo(np.int64).max)
+    np.minimum.at(first_abx, abx_idx, abx_time)
+    timeline['first_antibiotic_time'] = pd.to_datetime(
+        np.where(first_abx == np.iinfo(np.int64).max, np.nan, first_abx.astype(float)), unit='s')
+
+    # Antibiotic days = distinct calendar days with at least one administration
+    day_keys = np.unique(abx_idx * 1_000_000 + abx_time // 86400)
+    timeline['antibiotic_days'] = np.bincount(day_keys // 1_000_000, minlength=n)
+    culture_idx = subject_index(cohort_ids, culture_subject)
+    timeline['culture_count'] = np.bincount(culture_idx, minlength=n)
+
+    onset = suspected_infection_onset(n, abx_idx, abx_time, culture_idx, culture_time)
+    timeline['suspected_infection'] = (~np.isnan(onset)).astype(int)
+    timeline['suspected_infection_time'] = pd.to_datetime(onset, unit='s')
+
+    administrations['time'] = pd.to_datetime(administrations['time'], unit='s')
+    administrations.to_csv(administrations_file, index=False)
+    timeline.to_csv(output_file, index=False)
+
+    print(f"✅ Saved: {administrations_file}")
+    print(f"✅ Saved: {output_file}")
+    print(f"Patients with antibiotics: {timeline['first_antibiotic_time'].notna().sum()}")
+    print(f"Suspected infection: {timeline['suspected_infection'].sum()} patients")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,31 @@
 # merge_final_with_combined_antibiotics.py
 import pandas as pd
 
+from abx_bits import CODE_COLUMN, expand_codes
+
+# One-hot granularity of the antibiotic columns: 'antibiotic' or 'pair'
+ONE_HOT_LEVEL = 'antibiotic'
+
 print("=== MERGING FINAL.CSV WITH COMBINED ANTIBIOTICS ===")
 
 # Load final.csv as base
 final_base = pd.read_csv('ICU/final.csv')
 print(f"Final base: {len(final_base)} patients")
 
-# Load patients with antibiotics
-patients_abx = pd.read_csv('patients_with_antibiotics.csv')
-
-# Combine multiple antibiotics into single cell per patient
-combined_abx = patients_abx.groupby('subject_id').agg({
-    'antibiotic': lambda x: ', '.join(x.dropna().unique()),
-    'source_file': lambda x: ', '.join(x.dropna().unique())
-}).reset_index()
+# Load patients with antibiotics (one bit-packed antibiotic_code per subject)
+patients_abx = pd.read_csv('patients_with_antibiotics.csv', usecols=['subject_id', CODE_COLUMN])
+combined_abx = patients_abx.drop_duplicates('subject_id')
+combined_abx = combined_abx[combined_abx[CODE_COLUMN] != 0]
 
 print(f"Patients with combined antibiotics: {len(combined_abx)}")
 
 # Merge with final base (left join to keep all final.csv patients)
 final_with_abx = final_base.merge(combined_abx, on='subject_id', how='left')
+final_with_abx[CODE_COLUMN] = final_with_abx[CODE_COLUMN].fillna(0).astype('int64')
+
+# Expand into one-hot columns: 'antibiotic' (any source) or 'pair' (antibiotic x source)
+final_with_abx = pd.concat([final_with_abx, expand_codes(final_with_abx[CODE_COLUMN], level=ONE_HOT_LEVEL)],
+                           axis=1)
 
 print(f"Final with antibiotics: {len(final_with_abx)} patients")
 
@@ -29,12 +35,11 @@ print("✅ Saved: FINAL_WITH_COMBINED_ANTIBIOTICS.csv")
 
 print(f"\n=== SUMMARY ===")
 print(f"Final base patients: {len(final_base)}")
-print(f"Patients with antibiotics: {final_with_abx['antibiotic'].notna().sum()}")
+print(f"Patients with antibiotics: {(final_with_abx[CODE_COLUMN] != 0).sum()}")
 
-print(f"\nSample patients with multiple antibiotics:")
-sample_patients = final_with_abx[final_with_abx['antibiotic'].notna()].head(3)
-for _, row in sample_patients.iterrows():
-    print(f"Subject {row['subject_id']}: {row['antibiotic']}")
+one_hot = [c for c in final_with_abx.columns if c.startswith('abx_')]
+print(f"\nOne-hot antibiotic columns ({ONE_HOT_LEVEL}):")
+print(final_with_abx[one_hot].sum())
 
 print(f"\nFirst 3 patients:")
-print(final_with_abx[['subject_id', 'antibiotic', 'source_file']].head(3))
\ No newline at end of file
+print(final_with_abx[['subject_id', CODE_COLUMN] + one_hot].head(3))
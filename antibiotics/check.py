@@ -1,8 +1,11 @@
-import pandas as pd
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from concepts import search_labels
 
-d_items = pd.read_csv('icu/d_items.csv')
 antibiotics = ['vancomycin', 'cefepime', 'piperacillin', 'meropenem', 'cefazolin']
 
-abx_items = d_items[d_items['label'].str.contains('|'.join(antibiotics), case=False, na=False)]
+abx_items = search_labels('|'.join(antibiotics), source='d_items')
 print("Antibiotic itemids in d_items.csv:")
-print(abx_items[['itemid', 'label']])
\ No newline at end of file
+print(abx_items[['itemid', 'label']])
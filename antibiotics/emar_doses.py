@@ -0,0 +1,120 @@
+# emar_doses.py
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from chunk_reader import read_csv_chunks
+from cohort import subject_index, to_epoch_seconds
+from sampling import apply_sample
+from abx_bits import ADMINISTERED_EVENTS, ANTIBIOTICS, match_medication_names
+
+# Configuration
+data_path = "/home/nishat/physionet.org/files/mimiciv/3.1/"
+output_file = "emar_antibiotic_doses.csv"
+
+EMAR_COLUMNS = ['subject_id', 'hadm_id', 'emar_seq', 'charttime', 'medication', 'event_txt']
+DETAIL_COLUMNS = ['subject_id', 'emar_seq', 'parent_field_ordinal', 'dose_given', 'dose_given_unit', 'route']
+
+
+def emar_keys(subject_ids, emar_seq):
+    """int64 join key per emar row (emar_id is '<subject_id>-<emar_seq>')"""
+    return (np.asarray(subject_ids, dtype=np.int64) << 32) | np.asarray(emar_seq, dtype=np.int64)
+
+
+def scan_emar(path, cohort_ids=None, chunksize=None):
+    """Pass 1: administered antibiotic emar rows, as arrays sorted by join key
+
+    Only matching rows are kept, so memory follows the number of antibiotic
+    administrations, not the size of emar.
+    """
+    parts = []
+    chunks = read_csv_chunks(path, chunksize=chunksize, subjects=cohort_ids, usecols=EMAR_COLUMNS)
+    for i, chunk in enumerate(chunks):
+        chunk = chunk[chunk['event_txt'].isin(ADMINISTERED_EVENTS) & chunk['charttime'].notna()]
+        abx = match_medication_names(chunk['medication'].to_numpy())
+        keep = abx >= 0
+        if cohort_ids is not None:
+            keep &= subject_index(cohort_ids, chunk['subject_id'].to_numpy()) >= 0
+        if keep.any():
+            chunk = chunk[keep]
+            parts.append({
+                'key': emar_keys(chunk['subject_id'], chunk['emar_seq']),
+                'subject_id': chunk['subject_id'].to_numpy(dtype=np.int64),
+                'hadm_id': chunk['hadm_id'].to_numpy(dtype=np.float64),
+                'time': to_epoch_seconds(chunk['charttime']),
+                'antibiotic': abx[keep],
+            })
+        if i % 10 == 0:
+            print(f"  emar: processed {i+1} chunks...")
+
+    fields = ['key', 'subject_id', 'hadm_id', 'time', 'antibiotic']
+    if not parts:
+        return {f: np.array([], dtype=np.int64) for f in fields}
+    matched = {f: np.concatenate([p[f] for p in parts]) for f in fields}
+    order = np.argsort(matched['key'], kind='stable')
+    return {f: v[order] for f, v in matched.items()}
+
+
+def join_emar_detail(path, matched, chunksize=None):
+    """Pass 2: stream emar_detail against the sorted key set of pass 1
+
+    Membership is a binary search over the sorted int64 keys (8 bytes per
+    matched administration); non-matching detail rows are dropped per chunk.
+    """
+    keys = matched['key']
+    rows = []
+    chunks = read_csv_chunks(path, chunksize=chunksize, usecols=DETAIL_COLUMNS,
+                             reserved_bytes=sum(a.nbytes for a in matched.values()),
+                             subjects=np.unique(matched['subject_id']))
+    for i, chunk in enumerate(chunks):
+        # Dose rows only; the parent row of each emar event carries no dose
+        chunk = chunk[chunk['dose_given'].notna()]
+        if chunk.empty or len(keys) == 0:
+            continue
+        detail_keys = emar_keys(chunk['subject_id'], chunk['emar_seq'])
+        pos = np.minimum(np.searchsorted(keys, detail_keys), len(keys) - 1)
+        hit = keys[pos] == detail_keys
+        if hit.any():
+            chunk = chunk[hit]
+            pos = pos[hit]
+            rows.append(pd.DataFrame({
+                'subject_id': matched['subject_id'][pos],
+                'hadm_id': matched['hadm_id'][pos],
+                'charttime': pd.to_datetime(matched['time'][pos], unit='s'),
+                'antibiotic': np.asarray(ANTIBIOTICS, dtype=object)[matched['antibiotic'][pos]],
+                'dose_given': pd.to_numeric(chunk['dose_given'], errors='coerce').to_numpy(),
+                'dose_given_unit': chunk['dose_given_unit'].to_numpy(),
+                'route': chunk['route'].to_numpy(),
+            }))
+        if i % 10 == 0:
+            print(f"  emar_detail: processed {i+1} chunks...")
+
+    if not rows:
+        return pd.DataFrame(columns=['subject_id', 'hadm_id', 'charttime', 'antibiotic',
+                                     'dose_given', 'dose_given_unit', 'route'])
+    doses = pd.concat(rows, ignore_index=True)
+    return doses.sort_values(['subject_id', 'charttime'], kind='stable').reset_index(drop=True)
+
+
+def main():
+    """Administered antibiotic doses from emar joined with emar_detail"""
+    print("=== EXTRACTING ADMINISTERED ANTIBIOTIC DOSES (emar + emar_detail) ===")
+    cohort = apply_sample(pd.read_csv('ICU/patients.csv'))
+    cohort_ids = np.unique(cohort['subject_id'].to_numpy(dtype=np.int64))
+    print(f"Patients: {len(cohort_ids)}")
+
+    matched = scan_emar(os.path.join(data_path, 'hosp/emar.csv'), cohort_ids)
+    print(f"  ✅ Administered antibiotic emar events: {len(matched['key'])}")
+
+    doses = join_emar_detail(os.path.join(data_path, 'hosp/emar_detail.csv'), matched)
+    doses.to_csv(output_file, index=False)
+    print(f"✅ Saved: {output_file}")
+    print(f"  Dose rows: {len(doses)} for {doses['subject_id'].nunique()} patients")
+    print(doses.groupby('antibiotic')['subject_id'].nunique())
+
+
+if __name__ == "__main__":
+    main()
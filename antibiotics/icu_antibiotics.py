@@ -1,24 +1,26 @@
 # extract_icu_antibiotics.py
+import os
+import sys
+
 import pandas as pd
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from chunk_reader import read_csv_chunks
+from concepts import concept_itemids
+from abx_bits import ANTIBIOTICS
+
 print("=== EXTRACTING ANTIBIOTICS FROM ICU FILES ===")
 
-# Antibiotic itemids from d_items.csv
-abx_itemids = {
-    'Vancomycin': 225798,
-    'Cefepime': 225851, 
-    'Piperacillin/Tazobactam': 225893,
-    'Meropenem': 225883,
-    'Cefazolin': 225850
-}
+# Antibiotic itemids from d_items.csv (via the concept dictionary)
+abx_itemids = {name: int(concept_itemids(name)[0]) for name in ANTIBIOTICS}
 
 antibiotics_data = []
 
 # Search inputevents.csv (IV medications)
 print("Searching inputevents.csv for antibiotics...")
 try:
-    chunks = pd.read_csv('icu/inputevents.csv', chunksize=50000, 
-                        usecols=['subject_id', 'hadm_id', 'stay_id', 'itemid', 'amount', 'rate'])
+    chunks = read_csv_chunks('icu/inputevents.csv',
+                             usecols=['subject_id', 'hadm_id', 'stay_id', 'itemid', 'amount', 'rate'])
     
     for i, chunk in enumerate(chunks):
         # Filter for antibiotic itemids
@@ -1,6 +1,13 @@
 # extract_antibiotics.py
+import os
+import sys
+
 import pandas as pd
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from chunk_reader import read_csv_chunks
+from abx_bits import match_medication_names
+
 print("=== EXTRACTING ANTIBIOTIC DATA ===")
 
 # Load all files that might contain antibiotics
@@ -38,13 +45,13 @@ try:
 except Exception as e:
     print(f"Error reading pharmacy: {e}")
 
-# 3. Check emar.csv
+# 3. Check emar.csv (streamed; medication names matched once per distinct name)
 try:
-    emar = pd.read_csv('hosp/emar.csv')
-    emar_abx = emar[emar['medication'].str.contains(
-        'vancomycin|cefepime|piperacillin|tazobactam|meropenem|cefazolin',
-        case=False, na=False
-    )]
+    emar_parts = []
+    for chunk in read_csv_chunks('hosp/emar.csv',
+                                 usecols=['subject_id', 'hadm_id', 'medication']):
+        emar_parts.append(chunk[match_medication_names(chunk['medication'].to_numpy()) >= 0])
+    emar_abx = pd.concat(emar_parts, ignore_index=True) if emar_parts else pd.DataFrame()
     if len(emar_abx) > 0:
         emar_abx['source_file'] = 'emar.csv'
         emar_abx['antibiotic'] = emar_abx['medication']
@@ -1,10 +1,17 @@
 # merge_patients_with_antibiotics.py
+import os
+import sys
+
 import pandas as pd
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sampling import apply_sample
+from abx_bits import CODE_COLUMN, aggregate_codes, encode_records, expand_codes
+
 print("=== MERGING ICU PATIENTS WITH ANTIBIOTICS ===")
 
 # Load subject_id and hadm_id from ICU/patients.csv
-icu_patients = pd.read_csv('ICU/patients.csv')[['subject_id', 'hadm_id']]
+icu_patients = apply_sample(pd.read_csv('ICU/patients.csv'))[['subject_id', 'hadm_id']]
 print(f"ICU patients: {len(icu_patients)} rows")
 
 # Load antibiotic files
@@ -14,11 +21,17 @@ hosp_abx = pd.read_csv('hosp_antibiotic.csv')
 print(f"ICU antibiotics: {len(icu_abx)} records")
 print(f"Hospital antibiotics: {len(hosp_abx)} records")
 
-# Combine both antibiotic files
-all_abx = pd.concat([icu_abx, hosp_abx], ignore_index=True)
+# Combine both antibiotic files (long format, one row per record)
+icu_abx = icu_abx.rename(columns={'source_file': 'source'})
+all_abx = pd.concat([icu_abx[['subject_id', 'antibiotic', 'source']],
+                     hosp_abx[['subject_id', 'antibiotic', 'source']]], ignore_index=True)
+
+# One bit per (antibiotic, source) pair, OR-reduced per subject (abx_bits.py)
+codes = aggregate_codes(all_abx['subject_id'].to_numpy(), encode_records(all_abx))
 
-# Merge with ICU patients (left join to keep all 32628 patients)
-final_data = icu_patients.merge(all_abx, on='subject_id', how='left')
+# Left join one row per subject, so ICU patients are not fanned out
+final_data = icu_patients.merge(codes, on='subject_id', how='left')
+final_data[CODE_COLUMN] = final_data[CODE_COLUMN].fillna(0).astype('int64')
 
 print(f"Final data: {len(final_data)} rows (should be {len(icu_patients)})")
 
@@ -28,8 +41,8 @@ print("✅ Saved: patients_with_antibiotics.csv")
 
 print(f"\n=== SUMMARY ===")
 print(f"ICU patients: {len(icu_patients)}")
-print(f"Patients with antibiotics: {final_data['antibiotic'].notna().sum()}")
-print(f"Unique patients with antibiotics: {final_data[final_data['antibiotic'].notna()]['subject_id'].nunique()}")
+print(f"Patients with antibiotics: {(final_data[CODE_COLUMN] != 0).sum()}")
+print(f"Unique patients with antibiotics: {final_data.loc[final_data[CODE_COLUMN] != 0, 'subject_id'].nunique()}")
 
-print(f"\nFirst 5 records:")
-print(final_data.head())
\ No newline at end of file
+print(f"\nPatients per antibiotic:")
+print(expand_codes(final_data[CODE_COLUMN]).sum())
@@ -0,0 +1,191 @@
+# byte_index.py
+import io
+import os
+import sys
+
+import numpy as np
+
+from sampling import FILTER_BLOCK_BYTES, line_subjects, subject_column
+
+# Configuration
+data_path = "/home/nishat/physionet.org/files/mimiciv/3.1/"
+
+# Event tables worth indexing (grouped by subject_id in MIMIC-IV)
+INDEXED_TABLES = [
+    'icu/chartevents.csv', 'icu/inputevents.csv', 'icu/outputevents.csv', 'icu/procedureevents.csv',
+    'hosp/labevents.csv', 'hosp/emar.csv', 'hosp/emar_detail.csv', 'hosp/prescriptions.csv',
+    'hosp/pharmacy.csv', 'hosp/diagnoses_icd.csv', 'hosp/procedures_icd.csv',
+]
+
+# Ranges closer than this are read as one (skipping a few KB costs more than reading it)
+MERGE_GAP_BYTES = 64 * 1024
+
+
+def index_path(path):
+    """Sidecar file of a source CSV"""
+    return path + '.subject_index.npz'
+
+
+def build_byte_index(path, output=None):
+    """One pass over raw bytes -> contiguous runs of one subject_id with their byte ranges
+
+    Files grouped by subject give one run per subject; a subject whose rows
+    are scattered gets several runs, so the index is correct for any row
+    order (it just gets bigger). Lines must not contain quoted newlines.
+    """
+    output = output or index_path(path)
+    column = subject_column(path)
+    if column < 0:
+        raise ValueError(f"{path} has no subject_id column")
+    stat = os.stat(path)
+    run_subjects, run_starts, run_ends = [], [], []
+    with open(path, 'rb') as f:
+        header_end = len(f.readline())
+        offset = header_end
+        carry = b''
+        while True:
+            data = f.read(FILTER_BLOCK_BYTES)
+            block = carry + data
+            if not data:
+                if not block:
+                    break
+                block = block if block.endswith(b'\n') else block + b'\n'
+                carry = b''
+            else:
+                cut = block.rfind(b'\n') + 1
+                block, carry = block[:cut], block[cut:]
+                if not block:
+                    continue
+            starts, ends, subjects = line_subjects(np.frombuffer(block, dtype=np.uint8), column)
+            # A run starts wherever the subject differs from the previous line
+            first = np.r_[0, np.flatnonzero(np.diff(subjects)) + 1]
+            run_subjects.append(subjects[first])
+            run_starts.append(offset + starts[first])
+            run_ends.append(offset + np.r_[starts[first[1:]], ends[-1]])
+            offset += len(block)
+            if not data:
+                break
+
+    subjects = np.concatenate(run_subjects) if run_subjects else np.array([], dtype=np.int64)
+    starts = np.concatenate(run_starts) if run_starts else np.array([], dtype=np.int64)
+    ends = np.concatenate(run_ends) if run_ends else np.array([], dtype=np.int64)
+    if len(subjects):
+        # Join runs split across block boundaries
+        keep = np.r_[True, subjects[1:] != subjects[:-1]]
+        last = np.r_[np.flatnonzero(keep)[1:] - 1, len(subjects) - 1]
+        subjects, starts, ends = subjects[keep], starts[keep], ends[last]
+
+    np.savez(output, subject_id=subjects.astype(np.int64), start=starts.astype(np.int64),
+             end=ends.astype(np.int64), header_end=header_end, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    print(f"  ✅ {path}: {len(subjects)} runs, {len(np.unique(subjects))} subjects -> {output}")
+    return load_byte_index(path, output)
+
+
+def load_byte_index(path, index_file=None):
+    """Index of a source CSV, or None if missing or built from a different version of the file"""
+    index_file = index_file or index_path(path)
+    if not os.path.exists(index_file) or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    with np.load(index_file) as f:
+        index = {name: f[name] for name in f.files}
+    if int(index['size']) != stat.st_size or int(index['mtime_ns']) != stat.st_mtime_ns:
+        print(f"  ⚠️  {index_file} is stale ({path} changed), ignoring it")
+        return None
+    return index
+
+
+def subject_ranges(index, subjects, merge_gap=MERGE_GAP_BYTES):
+    """Sorted, coalesced (start, end) byte ranges holding the rows of the given subjects"""
+    hit = np.isin(index['subject_id'], np.asarray(subjects, dtype=np.int64))
+    starts, ends = index['start'][hit], index['end'][hit]
+    if len(starts) == 0:
+        return starts, ends
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    # A new range begins where the gap to the previous range is too big to read through
+    new = np.r_[True, starts[1:] - ends[:-1] > merge_gap]
+    first = np.flatnonzero(new)
+    last = np.r_[first[1:] - 1, len(starts) - 1]
+    return starts[first], ends[last]
+
+
+class RangeCSV(io.RawIOBase):
+    """Read-only file yielding the header and the given byte ranges of a CSV
+
+    Bytes between ranges are skipped with a seek and never parsed. When
+    ranges were merged across a small gap, the gap's lines (other subjects)
+    pass through, and the caller's cohort filter drops them as it always has.
+    """
+
+    def __init__(self, path, header_end, starts, ends):
+        super().__init__()
+        self._file = open(path, 'rb')
+        self._remaining = header_end
+        self._ranges = list(zip(starts.tolist(), ends.tolist()))
+
+    def readable(self):
+        return True
+
+    def readinto(self, out):
+        while self._remaining == 0 and self._ranges:
+            start, end = self._ranges.pop(0)
+            self._file.seek(start)
+            self._remaining = end - start
+        n = self._file.readinto(memoryview(out)[:min(len(out), self._remaining)])
+        self._remaining -= n
+        return n
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def line_ranges(path, target_bytes):
+    """Header end and (start, end) byte ranges of about target_bytes each, cut at line starts
+
+    Every data line falls in exactly one range, so RangeCSV readers over the
+    ranges can parse the file in parallel.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header_end = len(f.readline())
+        cuts = [header_end]
+        while cuts[-1] < size:
+            target = cuts[-1] + target_bytes
+            if target >= size:
+                cuts.append(size)
+                break
+            # The next range starts after the line that holds the target byte
+            f.seek(target - 1)
+            f.readline()
+            cuts.append(f.tell())
+    cuts = np.array(cuts, dtype=np.int64)
+    return header_end, cuts[:-1], cuts[1:]
+
+
+def indexed_source(path, subjects):
+    """RangeCSV over the subjects' rows when the file has a current index, else None"""
+    if subjects is None or not isinstance(path, str):
+        return None
+    index = load_byte_index(path)
+    if index is None:
+        return None
+    starts, ends = subject_ranges(index, subjects)
+    raw = RangeCSV(path, int(index['header_end']), starts, ends)
+    return io.BufferedReader(raw, buffer_size=1024 ** 2)
+
+
+def main():
+    """Build sidecar indexes for the given tables (default: INDEXED_TABLES under data_path)"""
+    print("=== BUILDING SUBJECT BYTE-OFFSET INDEXES ===")
+    tables = sys.argv[1:] or [os.path.join(data_path, t) for t in INDEXED_TABLES]
+    for path in tables:
+        if not os.path.exists(path):
+            print(f"  ⚠️  {path} not found, skipped")
+            continue
+        build_byte_index(path)
+
+
+if __name__ == "__main__":
+    main()
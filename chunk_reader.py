@@ -0,0 +1,172 @@
+# chunk_reader.py
+import collections
+import os
+import threading
+
+import pandas as pd
+
+from byte_index import indexed_source
+from sampling import sampled_source
+
+# Chunks parsed ahead of the consumer (0 disables prefetching)
+PREFETCH_DEPTH = int(os.environ.get('ICU_PREFETCH_DEPTH', 2))
+
+# Cap on the memory held by parsed-but-unconsumed chunks
+PREFETCH_MAX_BYTES = int(float(os.environ.get('ICU_PREFETCH_MAX_MB', 1024)) * 1024 ** 2)
+
+# Memory a reader may fill with parsed chunks; run_pipeline.py sets it per stage.
+# Without it a quarter of physical RAM is assumed.
+MEMORY_BUDGET_ENV = 'ICU_MEMORY_BUDGET_MB'
+
+# Rows of the first chunk, used to measure bytes per parsed row
+INITIAL_CHUNK_ROWS = 100_000
+MIN_CHUNK_ROWS = 10_000
+MAX_CHUNK_ROWS = 5_000_000
+
+# Chunk-sized allocations alive besides the prefetch queue: the chunk being
+# consumed plus the filtered copies/temporaries the extractors make of it
+CHUNK_COPIES = 3
+
+# Rows measured with deep=True (string contents) per chunk
+SAMPLE_ROWS = 2_000
+
+
+def _nbytes(chunk):
+    """Approximate in-memory size of a parsed chunk, string contents included"""
+    try:
+        return int(_row_bytes(chunk) * len(chunk))
+    except AttributeError:
+        return 0
+
+
+def memory_budget():
+    """Bytes readers may use for parsed chunks (ICU_MEMORY_BUDGET_MB, else 1/4 of RAM)"""
+    if os.environ.get(MEMORY_BUDGET_ENV):
+        return int(float(os.environ[MEMORY_BUDGET_ENV]) * 1024 ** 2)
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 4
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024 ** 3
+
+
+def _row_bytes(chunk):
+    """Parsed bytes per row, strings included (measured on a sample of rows)"""
+    if len(chunk) == 0:
+        return 0.0
+    sample = chunk.iloc[:SAMPLE_ROWS]
+    return float(sample.memory_usage(index=True, deep=True).sum()) / len(sample)
+
+
+def chunk_rows(bytes_per_row, budget=None, reserved_bytes=0, depth=None):
+    """Rows per chunk so that all live chunk copies fit in the budget
+
+    reserved_bytes is the caller's accumulator footprint, which the chunks
+    must leave room for.
+    """
+    budget = memory_budget() if budget is None else budget
+    depth = PREFETCH_DEPTH if depth is None else depth
+    usable = max(budget - reserved_bytes, 0)
+    rows = usable / (max(bytes_per_row, 1.0) * (max(depth, 0) + CHUNK_COPIES))
+    return int(min(max(rows, MIN_CHUNK_ROWS), MAX_CHUNK_ROWS))
+
+
+def adaptive_chunks(reader, first_rows, budget, reserved_bytes=0, depth=None):
+    """Chunks from a pandas TextFileReader, resized after each one from measured row width"""
+    size = first_rows
+    bytes_per_row = 0.0
+    with reader:
+        while True:
+            try:
+                chunk = reader.get_chunk(size)
+            except StopIteration:
+                return
+            if len(chunk) == 0:
+                return
+            # Wide rows later in the file (long free text) shrink the next chunk
+            bytes_per_row = max(bytes_per_row * 0.9, _row_bytes(chunk))
+            size = chunk_rows(bytes_per_row, budget, reserved_bytes, depth)
+            yield chunk
+
+
+def prefetch(chunks, depth=None, max_bytes=None):
+    """Iterate over chunks while a background thread parses the next ones
+
+    At most `depth` chunks and `max_bytes` of parsed data wait in the queue;
+    the producer blocks until the consumer frees room (a single oversized
+    chunk is still let through so the scan cannot stall). pandas' C parser
+    releases the GIL, so parsing overlaps with the caller's per-chunk work.
+    """
+    depth = PREFETCH_DEPTH if depth is None else depth
+    max_bytes = PREFETCH_MAX_BYTES if max_bytes is None else max_bytes
+    if depth <= 0:
+        yield from chunks
+        return
+
+    cond = threading.Condition()
+    buffer = collections.deque()
+    state = {'bytes': 0, 'done': False, 'error': None, 'stop': False}
+
+    def producer():
+        try:
+            for chunk in chunks:
+                size = _nbytes(chunk)
+                with cond:
+                    while not state['stop'] and buffer and (
+                            len(buffer) >= depth or state['bytes'] + size > max_bytes):
+                        cond.wait()
+                    if state['stop']:
+                        return
+                    buffer.append((chunk, size))
+                    state['bytes'] += size
+                    cond.notify_all()
+        except BaseException as e:
+            with cond:
+                state['error'] = e
+        finally:
+            with cond:
+                state['done'] = True
+                cond.notify_all()
+
+    thread = threading.Thread(target=producer, name='csv-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            with cond:
+                while not buffer and not state['done']:
+                    cond.wait()
+                if buffer:
+                    chunk, size = buffer.popleft()
+                    state['bytes'] -= size
+                    cond.notify_all()
+                elif state['error'] is not None:
+                    raise state['error']
+                else:
+                    return
+            yield chunk
+    finally:
+        # Consumer stopped early (break/exception): let the producer exit
+        with cond:
+            state['stop'] = True
+            buffer.clear()
+            cond.notify_all()
+
+
+def read_csv_chunks(path, chunksize=None, depth=None, max_bytes=None, reserved_bytes=0, subjects=None, **kwargs):
+    """pd.read_csv in chunks sized to the memory budget, with background prefetching
+
+    chunksize only sets the first chunk; later chunks are sized from the
+    measured bytes per parsed row, the budget (ICU_MEMORY_BUDGET_MB) and the
+    caller's reserved_bytes. In sampled runs (--sample / ICU_SAMPLE) rows of
+    non-sampled subjects are dropped as raw bytes before pandas parses them.
+    With subjects (the caller's cohort) and a current sidecar index
+    (byte_index.py), only the byte ranges of those subjects are read.
+    """
+    budget = memory_budget()
+    first_rows = chunksize or INITIAL_CHUNK_ROWS
+    source = indexed_source(path, subjects)
+    if source is None:
+        source = sampled_source(path) if isinstance(path, str) else path
+    reader = pd.read_csv(source, chunksize=first_rows, **kwargs)
+    max_bytes = PREFETCH_MAX_BYTES if max_bytes is None else max_bytes
+    max_bytes = min(max_bytes, max(budget - reserved_bytes, 0))
+    return prefetch(adaptive_chunks(reader, first_rows, budget, reserved_bytes, depth), depth, max_bytes)
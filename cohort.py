@@ -0,0 +1,168 @@
+# cohort.py
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Observation window used by all extractors (first 30 hours of the ICU stay)
+WINDOW_HOURS = 30
+
+# Stay-level mode: one cohort row per qualifying ICU stay instead of the first
+# stay per subject. Enable with --stays on any stage or ICU_STAY_MODE=1;
+# run_pipeline.py forwards it to every stage through the environment.
+STAY_MODE_ENV = 'ICU_STAY_MODE'
+
+
+def stay_mode():
+    """True when the pipeline is keyed on stay_id (--stays or ICU_STAY_MODE=1)"""
+    if '--stays' in sys.argv:
+        os.environ[STAY_MODE_ENV] = '1'
+    return os.environ.get(STAY_MODE_ENV, '0') == '1'
+
+
+def cohort_key():
+    """Column the feature tables are keyed on: stay_id in stay mode, else subject_id"""
+    return 'stay_id' if stay_mode() else 'subject_id'
+
+
+def to_epoch_seconds(values):
+    """Convert a column of timestamps to int64 epoch seconds"""
+    return pd.to_datetime(values).values.astype('datetime64[s]').astype(np.int64)
+
+
+def cohort_arrays(cohort, window_hours=WINDOW_HOURS):
+    """Build sorted subject_id / intime / end_time arrays for vectorized lookups"""
+    first = cohort.sort_values(['subject_id', 'intime']).drop_duplicates('subject_id')
+    subject_ids = first['subject_id'].to_numpy(dtype=np.int64)
+    intime = to_epoch_seconds(first['intime'])
+    end_time = intime + window_hours * 3600
+    return subject_ids, intime, end_time
+
+
+def subject_index(cohort_ids, subject_ids):
+    """Map subject_ids to dense cohort positions (-1 for non-cohort subjects)"""
+    subject_ids = np.asarray(subject_ids, dtype=np.int64)
+    if len(cohort_ids) == 0:
+        return np.full(len(subject_ids), -1, dtype=np.int64)
+    pos = np.searchsorted(cohort_ids, subject_ids)
+    pos = np.minimum(pos, len(cohort_ids) - 1)
+    return np.where(cohort_ids[pos] == subject_ids, pos, -1)
+
+
+def load_weights(cohort_ids, general_file='general.csv'):
+    """Load weight_kg from general.csv aligned to the cohort arrays
+
+    cohort_ids may repeat a subject (one entry per stay); every entry gets
+    the subject's weight.
+    """
+    weights = np.full(len(cohort_ids), np.nan)
+    try:
+        general = pd.read_csv(general_file, usecols=['subject_id', 'weight_kg'])
+    except (FileNotFoundError, ValueError) as e:
+        print(f"  ⚠️  Could not load weights from {general_file}: {e}")
+        return weights
+
+    general = general.drop_duplicates('subject_id').sort_values('subject_id')
+    idx = subject_index(general['subject_id'].to_numpy(dtype=np.int64), cohort_ids)
+    found = idx >= 0
+    weights[found] = general['weight_kg'].to_numpy(dtype=float)[idx[found]]
+    weights[weights <= 0] = np.nan
+    return weights
+
+
+def stay_table(stays, window_hours=None):
+    """Stay arrays sorted by (subject_id, intime) for attribute_stays
+
+    The stay ends at outtime, or intime + window_hours when given.
+    """
+    stays = stays.sort_values(['subject_id', 'intime'])
+    intime = to_epoch_seconds(stays['intime'])
+    if window_hours is None:
+        end_time = to_epoch_seconds(stays['outtime'])
+    else:
+        end_time = intime + window_hours * 3600
+    return {
+        'subject_id': stays['subject_id'].to_numpy(dtype=np.int64),
+        'stay_id': stays['stay_id'].to_numpy(dtype=np.int64) if 'stay_id' in stays
+                   else np.arange(len(stays), dtype=np.int64),
+        'intime': intime,
+        'end_time': end_time,
+    }
+
+
+def attribute_stays(table, subject_ids, times, lookback_hours=0):
+    """Row of `table` (stay_table) holding each (subject_id, time) event, -1 if none
+
+    An event belongs to the stay it falls in; otherwise, to the subject's next
+    stay if it lies within lookback_hours before that stay's intime. Each
+    event costs two binary searches over subject-offset keys, so no join
+    product is ever materialized.
+    """
+    subject_ids = np.asarray(subject_ids, dtype=np.int64)
+    times = np.asarray(times, dtype=np.int64)
+    n_stays = len(table['intime'])
+    if n_stays == 0 or len(times) == 0:
+        return np.full(len(times), -1, dtype=np.int64)
+
+    subjects, stay_rank = np.unique(table['subject_id'], return_inverse=True)
+    origin = int(table['intime'].min()) - lookback_hours * 3600
+    span = int(max(table['end_time'].max(), table['intime'].max())) - origin + 2
+    stay_keys = stay_rank * span + (table['intime'] - origin)
+
+    rank = subject_index(subjects, subject_ids)
+    event_keys = np.maximum(rank, 0) * span + np.clip(times - origin, 0, span - 1)
+
+    # Latest stay of the subject starting at or before the event
+    current = np.searchsorted(stay_keys, event_keys, side='right') - 1
+    safe = np.maximum(current, 0)
+    inside = ((current >= 0) & (stay_rank[safe] == rank)
+              & (table['intime'][safe] <= times) & (times <= table['end_time'][safe]))
+
+    # Otherwise the subject's next stay, if the event is within its lookback
+    following = np.minimum(current + 1, n_stays - 1)
+    before = ((current + 1 < n_stays) & (stay_rank[following] == rank)
+              & (table['intime'][following] - lookback_hours * 3600 <= times)
+              & (times < table['intime'][following]))
+
+    result = np.where(inside, safe, np.where(before, following, -1))
+    return np.where(rank >= 0, result, -1)
+
+
+def cohort_units(cohort, window_hours=WINDOW_HOURS):
+    """Dense cohort units the accumulators are indexed by (a stay_table)
+
+    One unit per subject (its first stay) by default, one per stay in stay
+    mode. Accumulators size their arrays by the number of units, so the cost
+    of a scan depends on the events read, not on how many stays there are.
+    """
+    if not stay_mode():
+        cohort = cohort.sort_values(['subject_id', 'intime']).drop_duplicates('subject_id')
+    units = stay_table(cohort, window_hours)
+    units['by_stay'] = stay_mode()
+    return units
+
+
+def unit_index(units, subject_ids, stay_ids=None, times=None, lookback_hours=0):
+    """Dense unit index of events (-1 outside the cohort)
+
+    Subject mode matches on subject_id. Stay mode matches on the event's
+    stay_id when the source table has one, otherwise attributes the event
+    to a stay by its time (attribute_stays).
+    """
+    if not units['by_stay']:
+        return subject_index(units['subject_id'], subject_ids)
+    if stay_ids is not None:
+        order = np.argsort(units['stay_id'], kind='stable')
+        stay_ids = np.nan_to_num(np.asarray(stay_ids, dtype=np.float64), nan=-1).astype(np.int64)
+        pos = subject_index(units['stay_id'][order], stay_ids)
+        return np.where(pos >= 0, order[np.maximum(pos, 0)], -1)
+    return attribute_stays(units, subject_ids, times, lookback_hours)
+
+
+def unit_frame(units):
+    """Key columns for the units: subject_id, plus stay_id in stay mode"""
+    frame = pd.DataFrame({'subject_id': units['subject_id']})
+    if units['by_stay']:
+        frame['stay_id'] = units['stay_id']
+    return frame
@@ -0,0 +1,339 @@
+# concepts.py
+import hashlib
+import json
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+from reference_cache import reference_table
+
+# Configuration
+data_path = "/home/nishat/physionet.org/files/mimiciv/3.1/"
+CONCEPTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'concepts.npz')
+
+# Concepts defined by explicit itemids (d_items / d_labitems)
+ITEM_CONCEPTS = {
+    # Blood Gas & Oxygenation
+    'PO2': [220224, 490, 50821, 50816],  # mmHg
+    'FiO2': [223835, 3420, 3422, 189, 190],  # %
+    'SpO2': [220277, 646, 834],  # %
+
+    # Laboratory Values
+    'Bilirubin': [50885, 50884, 4948, 4949],  # mg/dl
+    'Lactate': [50813, 818, 1531],  # mmol/l
+    'CRP': [50889],  # mg/l
+    'Leukocytes': [51301, 51300, 51302, 51303],  # /nl
+    'Blood_Sugar': [50809, 50931, 807, 811, 1529],  # mg/dl
+    'Platelets': [51265, 51256, 52769],  # 10³/mm³
+    'Creatinine': [50912, 791, 1525],  # mg/dl
+
+    # Blood Pressure
+    'Systolic_BP': [220050, 51, 455, 6701, 442],  # mmHg
+    'Diastolic_BP': [220051, 8368, 8441, 8555, 443, 8440],  # mmHg
+    'Mean_Blood_Pressure': [220052, 456, 52, 6702, 444],  # mmHg
+
+    # Vital Signs
+    'Respiratory_Rate': [220210, 618, 615, 614, 651],  # /min
+    'Heart_Rate': [220045, 211, 220046],  # /min
+    'Temperature': [223762, 676, 677, 678, 223761, 679],  # °C / °F
+
+    # Output
+    'Urine_Output': [226559, 226560, 227510, 227489],  # ml per charting
+
+    # Neurological Scores
+    'GCS': [198, 226755, 227013],
+    'GCS_Eye': [220739, 184],
+    'GCS_Verbal': [223900, 723],
+    'GCS_Motor': [223901, 454],
+
+    # Anthropometrics
+    'Height': [226730],  # cm
+    'Weight': [226512],  # kg
+
+    # Vasopressors / inotropes (inputevents)
+    'Epinephrine': [221289, 30047, 30120],
+    'Norepinephrine': [221906, 30051, 30128],
+    'Dopamine': [221662, 30043, 30119],
+    'Dobutamine': [221653, 30042, 30125],
+
+    # Antibiotics (inputevents)
+    'Vancomycin': [225798],
+    'Cefepime': [225851],
+    'Piperacillin/Tazobactam': [225893],
+    'Meropenem': [225883],
+    'Cefazolin': [225850],
+}
+
+# Concepts defined by a label pattern over a dictionary table
+LABEL_CONCEPTS = {
+    'Mechanical_Ventilation': ('d_items', 'ventilat|intubat'),
+    'Antibiotic_items': ('d_items', 'vancomycin|cefepime|piperacillin|meropenem|cefazolin'),
+}
+
+# Concepts defined by ICD code prefixes per version (resolved against d_icd_diagnoses)
+ICD_CONCEPTS = {
+    'Bile_infection': {10: ['K80', 'K81', 'K82', 'K83', 'K85', 'K86', 'K87']},
+    'Urological_infection': {10: ['N10', 'N11', 'N12', 'N13', 'N15', 'N16', 'N30', 'N34', 'N39']},
+    'Respiratory_infection': {10: ['J09', 'J10', 'J11', 'J12', 'J13', 'J14', 'J15', 'J16', 'J18']},
+    'Skin_infection': {10: ['L00', 'L01', 'L02', 'L03', 'L04', 'L05', 'L08']},
+    'Bone_joint_infection': {10: ['M00', 'M01', 'M02', 'M86']},
+    'Colon_infection': {10: ['A04', 'K52', 'A09']},
+    'Catheter_infection': {10: ['T80.2', 'T82.7', 'T83.5', 'T84.5', 'T85.7']},
+    'Abdominal_infection': {10: ['K35', 'K36', 'K37', 'K38', 'K65']},
+    'Unknown_infection': {10: ['A49', 'B99']},
+    'Diabetes': {10: ['E10', 'E11', 'E12', 'E13', 'E14']},
+    'Diabetes_mellitus': {9: ['250'], 10: ['E08', 'E09', 'E10', 'E11', 'E13']},
+}
+
+DICTIONARY_TABLES = {
+    'd_items': 'icu/d_items.csv',
+    'd_labitems': 'hosp/d_labitems.csv',
+}
+
+# Source tables the dictionary is resolved against; concepts.npz is rebuilt when one changes
+CONCEPT_SOURCES = list(DICTIONARY_TABLES.values()) + ['hosp/d_icd_diagnoses.csv']
+
+_cache = {}
+
+
+def _definition_hash():
+    """Hash of ITEM_CONCEPTS, LABEL_CONCEPTS and ICD_CONCEPTS"""
+    text = json.dumps([ITEM_CONCEPTS, LABEL_CONCEPTS, ICD_CONCEPTS], sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _source_stats():
+    """(size, mtime_ns) of every CONCEPT_SOURCES file, -1 when it is not available"""
+    sizes, mtimes = [], []
+    for path in CONCEPT_SOURCES:
+        full = os.path.join(data_path, path)
+        stat = os.stat(full) if os.path.exists(full) else None
+        sizes.append(stat.st_size if stat else -1)
+        mtimes.append(stat.st_mtime_ns if stat else -1)
+    return np.array(sizes, dtype=np.int64), np.array(mtimes, dtype=np.int64)
+
+
+def _is_current(path):
+    """True when concepts.npz was built from the current definitions and source tables
+
+    Sources that are not available here (a dictionary copied without the raw
+    data) are not checked.
+    """
+    with np.load(path) as z:
+        if 'definition_hash' not in z.files or str(z['definition_hash']) != _definition_hash():
+            return False
+        stored_sizes, stored_mtimes = z['source_size'], z['source_mtime_ns']
+    sizes, mtimes = _source_stats()
+    if len(stored_sizes) != len(sizes):
+        return False
+    available = sizes >= 0
+    return bool(np.array_equal(stored_sizes[available], sizes[available])
+                and np.array_equal(stored_mtimes[available], mtimes[available]))
+
+
+def _pack_strings(values):
+    """Pack strings into a utf-8 blob + offsets (loads without pickle)"""
+    encoded = [str(v).encode('utf-8') for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack_strings(blob, offsets):
+    """Inverse of _pack_strings"""
+    raw = blob.tobytes()
+    return [raw[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def _csr(groups, dtype):
+    """Concatenate lists into (values, offsets)"""
+    offsets = np.zeros(len(groups) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(g) for g in groups])
+    values = np.concatenate([np.asarray(g, dtype=dtype) for g in groups]) if groups else np.array([], dtype=dtype)
+    return values, offsets
+
+
+def build_concept_dictionary(output=CONCEPTS_FILE):
+    """Resolve all concepts against d_items, d_labitems and d_icd_diagnoses and save them"""
+    print("=== BUILDING CONCEPT DICTIONARY ===")
+
+    labels = []
+    for source, path in DICTIONARY_TABLES.items():
+        table = reference_table(source, ['itemid', 'label'], os.path.join(data_path, path))
+        table['source'] = source
+        labels.append(table)
+    labels = pd.concat(labels, ignore_index=True)
+    labels['label'] = labels['label'].fillna('')
+
+    d_icd = reference_table('d_icd_diagnoses', ['icd_code', 'icd_version', 'long_title'])
+    d_icd['long_title'] = d_icd['long_title'].fillna('')
+
+    item_names, item_groups = [], []
+    for name, itemids in ITEM_CONCEPTS.items():
+        item_names.append(name)
+        item_groups.append(sorted(set(itemids)))
+    for name, (source, pattern) in LABEL_CONCEPTS.items():
+        table = labels[labels['source'] == source]
+        item_names.append(name)
+        item_groups.append(sorted(set(table.loc[table['label'].str.contains(pattern, case=False), 'itemid'])))
+
+    icd_names, code_groups, version_groups = [], [], []
+    for name, prefixes in ICD_CONCEPTS.items():
+        codes, versions = [], []
+        for version, version_prefixes in prefixes.items():
+            # MIMIC stores ICD codes without the dot
+            stripped = tuple(p.replace('.', '') for p in version_prefixes)
+            vocab = d_icd[d_icd['icd_version'] == version]
+            matched = vocab.loc[vocab['icd_code'].str.startswith(stripped), 'icd_code']
+            codes.extend(matched)
+            versions.extend([version] * len(matched))
+        icd_names.append(name)
+        code_groups.append(codes)
+        version_groups.append(versions)
+
+    item_values, item_offsets = _csr(item_groups, np.int32)
+    icd_versions, icd_offsets = _csr(version_groups, np.int8)
+    source_names = list(DICTIONARY_TABLES.keys())
+
+    arrays = {
+        'item_values': item_values, 'item_offsets': item_offsets,
+        'icd_versions': icd_versions, 'icd_offsets': icd_offsets,
+        'label_itemid': labels['itemid'].to_numpy(dtype=np.int32),
+        'label_source': labels['source'].map(source_names.index).to_numpy(dtype=np.int8),
+        'vocab_version': d_icd['icd_version'].to_numpy(dtype=np.int8),
+    }
+    strings = {
+        'item_names': item_names,
+        'icd_names': icd_names,
+        'code': [c for g in code_groups for c in g],
+        'label': labels['label'],
+        'source_names': source_names,
+        'vocab_code': d_icd['icd_code'],
+        'title': d_icd['long_title'],
+    }
+    for key, values in strings.items():
+        arrays[f'{key}_blob'], arrays[f'{key}_offsets'] = _pack_strings(values)
+
+    arrays['definition_hash'] = np.array(_definition_hash())
+    arrays['source_size'], arrays['source_mtime_ns'] = _source_stats()
+
+    # Write atomically: stages (and shards) running in parallel may load or rebuild it at once
+    partial = f'{output}.{os.getpid()}.tmp.npz'
+    np.savez(partial, **arrays)
+    os.replace(partial, output)
+    _cache.clear()
+    print(f"✅ Saved: {output}")
+    print(f"  Item concepts: {len(item_names)}, ICD concepts: {len(icd_names)}")
+    print(f"  Labels: {len(labels)}, ICD vocabulary: {len(d_icd)}")
+    return output
+
+
+def load_concept_dictionary(path=CONCEPTS_FILE):
+    """Load the concept dictionary (building it on first use, rebuilding it when stale)"""
+    if path in _cache:
+        return _cache[path]
+    if not os.path.exists(path):
+        build_concept_dictionary(path)
+    elif not _is_current(path):
+        print(f"🔄 {path} is stale (concept definitions or source tables changed), rebuilding")
+        build_concept_dictionary(path)
+
+    with np.load(path) as z:
+        arrays = {key: z[key] for key in z.files}
+
+    item_names = _unpack_strings(arrays['item_names_blob'], arrays['item_names_offsets'])
+    icd_names = _unpack_strings(arrays['icd_names_blob'], arrays['icd_names_offsets'])
+    concepts = {
+        'arrays': arrays,
+        'items': {name: i for i, name in enumerate(item_names)},
+        'icd': {name: i for i, name in enumerate(icd_names)},
+    }
+    _cache[path] = concepts
+    return concepts
+
+
+def concept_itemids(name, path=CONCEPTS_FILE):
+    """itemids for a concept as a sorted int32 array"""
+    concepts = load_concept_dictionary(path)
+    arrays = concepts['arrays']
+    i = concepts['items'][name]
+    return arrays['item_values'][arrays['item_offsets'][i]:arrays['item_offsets'][i + 1]]
+
+
+def concept_codes(name, version=None, path=CONCEPTS_FILE):
+    """ICD codes for a concept (optionally for one ICD version only)"""
+    concepts = load_concept_dictionary(path)
+    arrays = concepts['arrays']
+    i = concepts['icd'][name]
+    start, end = arrays['icd_offsets'][i], arrays['icd_offsets'][i + 1]
+    codes = _unpack_strings(arrays['code_blob'], arrays['code_offsets'][start:end + 1])
+    versions = arrays['icd_versions'][start:end]
+    if version is not None:
+        codes = [c for c, v in zip(codes, versions) if v == version]
+    return set(codes)
+
+
+def itemid_lookup(names, path=CONCEPTS_FILE):
+    """Dense itemid -> concept position array for vectorized tagging (-1 = untagged)
+
+    lookup[itemids] tags a whole chunk at once; itemids beyond the table
+    should be clipped by the caller (see tag_itemids).
+    """
+    ids = [concept_itemids(name, path) for name in names]
+    size = max([int(a.max()) for a in ids if len(a)] + [0]) + 1
+    lookup = np.full(size, -1, dtype=np.int16)
+    for position, itemids in enumerate(ids):
+        overlap = itemids[lookup[itemids] >= 0]
+        if len(overlap):
+            raise ValueError(f"itemids {overlap.tolist()} belong to more than one of {names}")
+        lookup[itemids] = position
+    return lookup
+
+
+def tag_itemids(lookup, itemids):
+    """Concept position for each itemid in a chunk (-1 when not tagged)"""
+    itemids = np.asarray(itemids, dtype=np.int64)
+    inside = (itemids >= 0) & (itemids < len(lookup))
+    return np.where(inside, lookup[np.where(inside, itemids, 0)], -1)
+
+
+def search_labels(pattern, source=None, path=CONCEPTS_FILE):
+    """Search d_items/d_labitems labels with a case-insensitive regex"""
+    concepts = load_concept_dictionary(path)
+    arrays = concepts['arrays']
+    source_names = _unpack_strings(arrays['source_names_blob'], arrays['source_names_offsets'])
+    labels = _unpack_strings(arrays['label_blob'], arrays['label_offsets'])
+    regex = re.compile(pattern, re.IGNORECASE)
+    hits = np.array([bool(regex.search(label)) for label in labels], dtype=bool)
+    if source is not None:
+        hits &= arrays['label_source'] == source_names.index(source)
+    return pd.DataFrame({
+        'itemid': arrays['label_itemid'][hits],
+        'label': np.array(labels, dtype=object)[hits],
+        'source': np.array(source_names, dtype=object)[arrays['label_source'][hits]],
+    })
+
+
+def search_icd(pattern, version=None, path=CONCEPTS_FILE):
+    """Search d_icd_diagnoses long titles with a case-insensitive regex"""
+    arrays = load_concept_dictionary(path)['arrays']
+    titles = pd.Series(_unpack_strings(arrays['title_blob'], arrays['title_offsets']))
+    hits = np.array(titles.str.contains(pattern, case=False, regex=True), dtype=bool)
+    if version is not None:
+        hits &= arrays['vocab_version'] == version
+    codes = np.array(_unpack_strings(arrays['vocab_code_blob'], arrays['vocab_code_offsets']), dtype=object)
+    return pd.DataFrame({
+        'icd_code': codes[hits],
+        'icd_version': arrays['vocab_version'][hits],
+        'long_title': titles[hits].to_numpy(),
+    })
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        print(search_labels(sys.argv[1]))
+    else:
+        build_concept_dictionary()
@@ -1,7 +1,13 @@
 # extract_diagnosis_features.py
 import pandas as pd
-import numpy as np
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from concepts import concept_codes
+from icd_matrix import charlson, code_indicator, icd_matrix, phenotype
+from reference_cache import reference_table, subject_lookup
+from sampling import apply_sample
 
 print("=== EXTRACTING DIAGNOSIS FEATURES ===")
 
@@ -10,68 +16,43 @@ data_path = "/home/nishat/physionet.org/files/mimiciv/3.1/"
 output_file = "diagnosis.csv"
 
 # Load patient cohort
-cohort = pd.read_csv('patients.csv')
+cohort = apply_sample(pd.read_csv('patients.csv'))
 our_patients = cohort['subject_id'].unique().tolist()
 print(f"Patients: {len(our_patients)}")
 
 # Initialize diagnosis dataframe with subject_id
 diagnosis_df = pd.DataFrame({'subject_id': our_patients})
 
+# Subject x ICD code matrix (built once, see icd_matrix.py); every flag below
+# is a sparse matrix-vector product instead of another read of diagnoses_icd.csv
+icd = icd_matrix(our_patients)
+
 def extract_infection_diagnoses():
     """Extract all infection diagnosis features (binary once)"""
     print("\n=== EXTRACTING INFECTION DIAGNOSES ===")
     
-    # Load diagnoses data
-    diagnoses = pd.read_csv(os.path.join(data_path, 'hosp/diagnoses_icd.csv'))
-    d_icd = pd.read_csv(os.path.join(data_path, 'hosp/d_icd_diagnoses.csv'))
-    
-    # Filter for our patients
-    diagnoses_cohort = diagnoses[diagnoses['subject_id'].isin(our_patients)]
-    print(f"Total diagnosis records for our patients: {len(diagnoses_cohort)}")
+    print(f"Distinct (patient, ICD code) pairs for our patients: {icd['matrix'].nnz}")
     
-    # ICD-10 codes for infections (comprehensive list)
-    infection_codes = {
-        'Bile_infection': [
-            'K80', 'K81', 'K82', 'K83', 'K85', 'K86', 'K87',  # Gallbladder disorders
-        ],
-        'Urological_infection': [
-            'N10', 'N11', 'N12', 'N13', 'N15', 'N16', 'N30', 'N34', 'N39',  # UTI
-        ],
-        'Respiratory_infection': [
-            'J09', 'J10', 'J11', 'J12', 'J13', 'J14', 'J15', 'J16', 'J18',  # Pneumonia
-        ],
-        'Skin_infection': [
-            'L00', 'L01', 'L02', 'L03', 'L04', 'L05', 'L08',  # Skin infections
-        ],
-        'Bone_joint_infection': [
-            'M00', 'M01', 'M02', 'M86',  # Osteomyelitis and joint infections
-        ],
-        'Colon_infection': [
-            'A04', 'K52', 'A09',  # Gastroenteritis and colitis
-        ],
-        'Catheter_infection': [
-            'T80.2', 'T82.7', 'T83.5', 'T84.5', 'T85.7',  # Device infections
-        ],
-        'Abdominal_infection': [
-            'K35', 'K36', 'K37', 'K38', 'K65',  # Appendicitis and peritonitis
-        ],
-        'Unknown_infection': [
-            'A49', 'B99',  # Unspecified infections
-        ]
-    }
+    # ICD-10 infection concepts (code sets resolved from d_icd_diagnoses, see concepts.py)
+    infection_types = [
+        'Bile_infection',          # Gallbladder disorders
+        'Urological_infection',    # UTI
+        'Respiratory_infection',   # Pneumonia
+        'Skin_infection',          # Skin infections
+        'Bone_joint_infection',    # Osteomyelitis and joint infections
+        'Colon_infection',         # Gastroenteritis and colitis
+        'Catheter_infection',      # Device infections
+        'Abdominal_infection',     # Appendicitis and peritonitis
+        'Unknown_infection',       # Unspecified infections
+    ]
     
     # Create binary indicators for each infection type
-    for infection_type, codes in infection_codes.items():
-        # Create pattern for ICD codes
-        pattern = '|'.join([f'^{code}' for code in codes])
-        
-        # Find patients with these infection codes
-        infected_patients = diagnoses_cohort[
-            diagnoses_cohort['icd_code'].str.match(pattern, na=False)
-        ]['subject_id'].unique()
+    for infection_type in infection_types:
+        codes = concept_codes(infection_type, version=10)
         
-        # Create binary column
-        diagnosis_df[infection_type] = diagnosis_df['subject_id'].isin(infected_patients).astype(int)
+        # Patients with any of these infection codes
+        indicator = code_indicator(icd, codes={10: codes})
+        diagnosis_df[infection_type] = phenotype(icd, indicator, diagnosis_df['subject_id'])
         infected_count = diagnosis_df[infection_type].sum()
         percentage = (infected_count / len(diagnosis_df)) * 100
         print(f"  ✅ {infection_type}: {infected_count} patients ({percentage:.1f}%)")
@@ -80,27 +61,26 @@ def extract_diabetes():
     """Extract diabetes diagnosis"""
     print("\n=== EXTRACTING DIABETES DIAGNOSIS ===")
     
-    # Load diagnoses data
-    diagnoses = pd.read_csv(os.path.join(data_path, 'hosp/diagnoses_icd.csv'))
-    
     # ICD-10 codes for diabetes (E10-E14)
-    diabetes_codes = ['E10', 'E11', 'E12', 'E13', 'E14']
-    
-    # Filter for our patients
-    diagnoses_cohort = diagnoses[diagnoses['subject_id'].isin(our_patients)]
-    
-    # Find patients with diabetes
-    pattern = '|'.join([f'^{code}' for code in diabetes_codes])
-    diabetic_patients = diagnoses_cohort[
-        diagnoses_cohort['icd_code'].str.match(pattern, na=False)
-    ]['subject_id'].unique()
+    diabetes_codes = concept_codes('Diabetes', version=10)
     
     # Create binary column
-    diagnosis_df['Diabetes'] = diagnosis_df['subject_id'].isin(diabetic_patients).astype(int)
+    diagnosis_df['Diabetes'] = phenotype(icd, code_indicator(icd, codes={10: diabetes_codes}),
+                                         diagnosis_df['subject_id'])
     diabetic_count = diagnosis_df['Diabetes'].sum()
     percentage = (diabetic_count / len(diagnosis_df)) * 100
     print(f"  ✅ Diabetes: {diabetic_count} patients ({percentage:.1f}%)")
 
+def extract_comorbidities():
+    """Charlson comorbidity groups and index (Quan ICD-9/ICD-10 coding)"""
+    print("\n=== EXTRACTING CHARLSON COMORBIDITIES ===")
+    global diagnosis_df
+    
+    comorbidities = charlson(icd, diagnosis_df['subject_id'])
+    diagnosis_df = diagnosis_df.merge(comorbidities, on='subject_id', how='left')
+    print(f"  ✅ Charlson index: median {diagnosis_df['Charlson_index'].median():.0f}, "
+          f"max {diagnosis_df['Charlson_index'].max()}")
+
 def load_sofa_scores():
     """Load SOFA scores from existing file"""
     print("\n=== LOADING SOFA SCORES ===")
@@ -164,12 +144,11 @@ def add_patient_demographics():
     print("\n=== ADDING PATIENT DEMOGRAPHICS ===")
     
     try:
-        # Load patients data
-        patients = pd.read_csv(os.path.join(data_path, 'hosp/patients.csv'))
-        admissions = pd.read_csv(os.path.join(data_path, 'hosp/admissions.csv'))
+        # Load patients data (reference cache, see reference_cache.py)
+        patients_cohort = subject_lookup('patients', our_patients, ['gender', 'anchor_age'])
+        admissions = reference_table('admissions', ['subject_id', 'race'])
         
         # Filter for our patients
-        patients_cohort = patients[patients['subject_id'].isin(our_patients)]
         admissions_cohort = admissions[admissions['subject_id'].isin(our_patients)]
         
         # Add age and gender
@@ -260,6 +239,7 @@ def main():
     # Extract all diagnosis features
     extract_infection_diagnoses()
     extract_diabetes()
+    extract_comorbidities()
     load_sofa_scores()
     add_patient_demographics()  # Optional: add demographics for context
     
@@ -285,6 +265,7 @@ def main():
     print("File includes:")
     print("  - 9 Infection diagnoses (binary)")
     print("  - Diabetes (binary)") 
+    print("  - Charlson comorbidity groups and index")
     print("  - SOFA scores (min/max)")
     print("  - Patient demographics (age, gender, ethnicity)")
     print("🎉")
@@ -1,12 +1,12 @@
 # calculate_sofa_complete.py
+import os
+import sys
+
 import pandas as pd
 import numpy as np
 
-print("=== CALCULATING SOFA SCORE ===")
-
-# Load our patients
-our_patients = pd.read_csv('filtered_patients.csv')['subject_id'].tolist()
-print(f"Patients: {len(our_patients)}")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sampling import apply_sample
 
 # SOFA component itemids
 sofa_components = {
@@ -76,63 +76,57 @@ def sofa_renal(creatinine):
     elif creatinine < 4.9: return 3
     else: return 4
 
-print("Step 1: Extracting SOFA components...")
+def main():
+    """Worst-value SOFA sub-scores per patient from the vital feature table"""
+    print("=== CALCULATING SOFA SCORE ===")
 
-# Initialize results
-result = pd.DataFrame({'subject_id': our_patients})
+    # Load our patients (one row per patient, also in stay mode)
+    cohort = apply_sample(pd.read_csv('filtered_patients.csv'))
+    our_patients = cohort['subject_id'].drop_duplicates().tolist()
+    print(f"Patients: {len(our_patients)}")
 
-# Extract each component (we'll use the lab data we already have)
-print("Using previously extracted lab data...")
-labs = pd.read_csv('vital_features.csv')
+    print("Step 1: Extracting SOFA components...")
 
-# Add lab components to result
-lab_components = ['platelets', 'bilirubin', 'creatinine']
-for comp in lab_components:
-    result[f'{comp}_min'] = labs[f'{comp}_min']
-    result[f'{comp}_max'] = labs[f'{comp}_max']
+    # Initialize results
+    result = pd.DataFrame({'subject_id': our_patients})
 
-print("Step 2: Calculating SOFA scores...")
+    # Extract each component (we'll use the lab data we already have)
+    print("Using previously extracted lab data...")
+    labs = pd.read_csv('vital_features.csv')
 
-# Calculate SOFA for each patient (using worst values)
-sofa_scores = []
+    # Add lab components to result (vital.py columns; worst over a patient's stays in stay mode)
+    lab_components = {'platelets': 'Platelets', 'bilirubin': 'Bilirubin', 'creatinine': 'Creatinine'}
+    worst = labs.groupby('subject_id').agg(
+        **{f'{comp}_min': (f'{column}_min', 'min') for comp, column in lab_components.items()},
+        **{f'{comp}_max': (f'{column}_max', 'max') for comp, column in lab_components.items()},
+    ).reset_index()
+    result = result.merge(worst, on='subject_id', how='left')
 
-for idx, patient in enumerate(our_patients):
-    if idx % 5000 == 0:
-        print(f"Processing patient {idx}/{len(our_patients)}...")
-    
-    # Get worst values for this patient
-    platelets_worst = result.loc[result['subject_id'] == patient, 'platelets_min'].iloc[0]
-    bilirubin_worst = result.loc[result['subject_id'] == patient, 'bilirubin_max'].iloc[0]
-    creatinine_worst = result.loc[result['subject_id'] == patient, 'creatinine_max'].iloc[0]
-    
-    # Calculate SOFA components (simplified - using available data)
-    sofa_coag = sofa_coagulation(platelets_worst) if not pd.isna(platelets_worst) else np.nan
-    sofa_liv = sofa_liver(bilirubin_worst) if not pd.isna(bilirubin_worst) else np.nan
-    sofa_ren = sofa_renal(creatinine_worst) if not pd.isna(creatinine_worst) else np.nan
-    
-    # For now, use simplified SOFA (3 components)
-    sofa_total = np.nansum([sofa_coag, sofa_liv, sofa_ren])
-    
-    sofa_scores.append({
-        'subject_id': patient,
-        'sofa_coagulation': sofa_coag,
-        'sofa_liver': sofa_liv,
-        'sofa_renal': sofa_ren,
-        'sofa_total': sofa_total
-    })
-
-# Create SOFA results
-sofa_df = pd.DataFrame(sofa_scores)
-result = result.merge(sofa_df, on='subject_id', how='left')
-
-# Save SOFA scores
-result[['subject_id', 'sofa_coagulation', 'sofa_liver', 'sofa_renal', 'sofa_total']].to_csv('sofa_scores.csv', index=False)
-print("✅ Saved: sofa_scores.csv")
-
-print(f"\nSOFA Score Summary:")
-print(f"Patients with SOFA data: {result['sofa_total'].notna().sum()}")
-print(f"SOFA Score range: {result['sofa_total'].min():.1f} to {result['sofa_total'].max():.1f}")
-print(f"Mean SOFA: {result['sofa_total'].mean():.2f}")
-
-print("\nFirst 5 patients with SOFA scores:")
-print(result[['subject_id', 'sofa_coagulation', 'sofa_liver', 'sofa_renal', 'sofa_total']].head())
\ No newline at end of file
+    print("Step 2: Calculating SOFA scores...")
+
+    # SOFA components from each patient's worst values (simplified - using available data)
+    def score(values, rule):
+        return values.map(lambda v: rule(v) if not pd.isna(v) else np.nan)
+
+    result['sofa_coagulation'] = score(result['platelets_min'], sofa_coagulation)
+    result['sofa_liver'] = score(result['bilirubin_max'], sofa_liver)
+    result['sofa_renal'] = score(result['creatinine_max'], sofa_renal)
+
+    # For now, use simplified SOFA (3 components); missing components count as 0
+    result['sofa_total'] = result[['sofa_coagulation', 'sofa_liver', 'sofa_renal']].sum(axis=1)
+
+    # Save SOFA scores
+    result[['subject_id', 'sofa_coagulation', 'sofa_liver', 'sofa_renal', 'sofa_total']].to_csv('sofa_scores.csv', index=False)
+    print("✅ Saved: sofa_scores.csv")
+
+    print(f"\nSOFA Score Summary:")
+    print(f"Patients with SOFA data: {result['sofa_total'].notna().sum()}")
+    print(f"SOFA Score range: {result['sofa_total'].min():.1f} to {result['sofa_total'].max():.1f}")
+    print(f"Mean SOFA: {result['sofa_total'].mean():.2f}")
+
+    print("\nFirst 5 patients with SOFA scores:")
+    print(result[['subject_id', 'sofa_coagulation', 'sofa_liver', 'sofa_renal', 'sofa_total']].head())
+
+
+if __name__ == "__main__":
+    main()
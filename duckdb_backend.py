@@ -0,0 +1,178 @@
+# duckdb_backend.py
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from chunk_reader import memory_budget, read_csv_chunks
+from profiles import update_profile
+from sampling import apply_sample
+
+try:
+    import duckdb
+except ImportError:  # optional: only needed with --backend duckdb
+    duckdb = None
+
+# Execution backend for the extractor scans: 'pandas' (chunked read_csv, the
+# default) or 'duckdb' (embedded, parallel, local). Select with --backend duckdb
+# on any stage or ICU_BACKEND=duckdb; run_pipeline.py forwards it to every stage.
+BACKEND_ENV = 'ICU_BACKEND'
+BACKENDS = ['pandas', 'duckdb']
+
+# Column types for the MIMIC-IV columns the extractors read, so DuckDB does not
+# have to guess them from a sample of rows
+COLUMN_TYPES = {
+    'subject_id': 'BIGINT', 'hadm_id': 'BIGINT', 'stay_id': 'BIGINT', 'itemid': 'BIGINT',
+    'charttime': 'TIMESTAMP', 'starttime': 'TIMESTAMP', 'endtime': 'TIMESTAMP',
+    'valuenum': 'DOUBLE', 'value': 'DOUBLE', 'amount': 'DOUBLE', 'rate': 'DOUBLE',
+    'patientweight': 'DOUBLE', 'amountuom': 'VARCHAR', 'rateuom': 'VARCHAR',
+    'icd_code': 'VARCHAR', 'icd_version': 'BIGINT',
+}
+
+_connection = None
+
+
+def backend():
+    """Selected backend from --backend (argv) or ICU_BACKEND, default 'pandas'"""
+    if '--backend' in sys.argv:
+        pos = sys.argv.index('--backend')
+        if pos + 1 < len(sys.argv):
+            os.environ[BACKEND_ENV] = sys.argv[pos + 1]
+    name = os.environ.get(BACKEND_ENV, 'pandas')
+    if name not in BACKENDS:
+        raise ValueError(f"backend must be one of {BACKENDS}, got {name!r}")
+    if name == 'duckdb' and duckdb is None:
+        raise ImportError("The duckdb backend needs the duckdb package (pip install duckdb)")
+    return name
+
+
+def use_duckdb():
+    """True when scans run on DuckDB"""
+    return backend() == 'duckdb'
+
+
+def connect():
+    """Shared in-process connection, memory-limited to the stage's budget (ICU_MEMORY_BUDGET_MB)"""
+    global _connection
+    if _connection is None:
+        _connection = duckdb.connect()
+        _connection.execute(f"SET memory_limit = '{memory_budget() // 1024 ** 2}MB'")
+        # Filter results keep the source file's row order, like the pandas scan
+        _connection.execute("SET preserve_insertion_order = true")
+    return _connection
+
+
+def _source(path, columns):
+    """Table function over a CSV, or over a Parquet copy next to it that is not older than the CSV"""
+    parquet = os.path.splitext(path)[0] + '.parquet'
+    if path.endswith('.parquet') or (os.path.exists(parquet) and (
+            not os.path.exists(path) or os.path.getmtime(parquet) >= os.path.getmtime(path))):
+        return f"read_parquet('{parquet}')"
+    types = ', '.join(f"'{c}': '{COLUMN_TYPES[c]}'" for c in columns if c in COLUMN_TYPES)
+    return f"read_csv('{path}', header = true, types = {{{types}}})"
+
+
+def _in_list(values):
+    """SQL IN-list literal"""
+    return ', '.join(repr(v.item() if isinstance(v, np.generic) else v) for v in values)
+
+
+def _to_pandas(frame):
+    """Nullable integer columns as read_csv would give them (int64, or float64 with NaN)"""
+    for column in frame.columns:
+        if isinstance(frame[column].dtype, pd.api.extensions.ExtensionDtype) \
+                and pd.api.types.is_integer_dtype(frame[column].dtype):
+            has_na = frame[column].isna().any()
+            frame[column] = frame[column].astype('float64' if has_na else 'int64')
+    return frame
+
+
+def filtered_rows(path, columns, where=None, subjects=None):
+    """Rows of a source table with column values in the given sets, in file order
+
+    where: {column: values}. With subjects (the caller's cohort, already
+    sampled/sharded), only their rows are returned. The scan and filter run
+    inside DuckDB over all cores; only matching rows are materialized in
+    pandas. Sampled runs keep the same subjects as the pandas path.
+    """
+    con = connect()
+    conditions = [f"{column} IN ({_in_list(values)})" for column, values in (where or {}).items()]
+    if subjects is not None:
+        con.register('scan_subjects', pd.DataFrame({'subject_id': np.unique(np.asarray(subjects, dtype=np.int64))}))
+        conditions.append("subject_id IN (SELECT subject_id FROM scan_subjects)")
+    sql = f"SELECT {', '.join(columns)} FROM {_source(path, columns)}"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    try:
+        frame = _to_pandas(con.execute(sql).df())
+    finally:
+        if subjects is not None:
+            con.unregister('scan_subjects')
+    return apply_sample(frame) if 'subject_id' in frame else frame
+
+
+def scan_chunks(path, columns, where=None, **kwargs):
+    """Chunks for an extractor loop: one pre-filtered frame on DuckDB, else read_csv_chunks
+
+    Callers keep their own per-chunk filters, so both backends feed the same
+    code and produce the same frames. subjects restricts the DuckDB query to
+    the cohort; on pandas it selects the byte ranges of a sidecar index.
+    """
+    if use_duckdb():
+        return [filtered_rows(path, columns, where, kwargs.get('subjects'))]
+    return read_csv_chunks(path, usecols=columns, **kwargs)
+
+
+def window_events(path, value_column, itemids, units, lookback_hours=0, profile=None):
+    """(unit index, itemid, value) of events attributed to the units' time windows
+
+    The itemid filter and the cohort window join run as one DuckDB query: two
+    ASOF joins per event give the latest stay starting at or before it and
+    the next stay after it, with the same rules as cohort.attribute_stays.
+    With a profile (profiles.py), the joined rows are kept in a temporary
+    table so the profile counters come from the same scan.
+    """
+    con = connect()
+    con.register('window_units', pd.DataFrame({
+        'unit': np.arange(len(units['subject_id']), dtype=np.int64),
+        'subject_id': units['subject_id'],
+        'intime': units['intime'],
+        'end_time': units['end_time'],
+    }))
+    columns = ['subject_id', 'itemid', 'charttime', value_column]
+    valid = "" if profile is not None else f"AND {value_column} IS NOT NULL AND charttime IS NOT NULL"
+    joined = f"""
+        SELECT CASE WHEN e.t <= cur.end_time THEN cur.unit
+                    WHEN e.t >= nxt.intime - {int(lookback_hours * 3600)} THEN nxt.unit
+               END AS unit,
+               e.subject_id IN (SELECT subject_id FROM window_units) AS in_cohort,
+               e.itemid, e.value
+        FROM (
+            SELECT subject_id, itemid, {value_column} AS value, CAST(epoch(charttime) AS BIGINT) AS t
+            FROM {_source(path, columns)}
+            WHERE itemid IN ({_in_list(itemids)}) {valid}
+        ) e
+        ASOF LEFT JOIN window_units cur ON e.subject_id = cur.subject_id AND e.t >= cur.intime
+        ASOF LEFT JOIN window_units nxt ON e.subject_id = nxt.subject_id AND e.t < nxt.intime
+    """
+    try:
+        if profile is None:
+            result = con.execute(f"SELECT unit, itemid, value FROM ({joined}) WHERE unit IS NOT NULL").fetchnumpy()
+        else:
+            con.execute(f"CREATE OR REPLACE TEMP TABLE window_rows AS {joined}")
+            # Distinct (itemid, value, flags) rows with their counts feed the profile
+            grouped = con.execute("""
+                SELECT itemid, value, in_cohort, unit IS NOT NULL AS in_window, count(*) AS n
+                FROM window_rows GROUP BY ALL
+            """).fetchnumpy()
+            update_profile(profile, grouped['itemid'], np.ma.filled(grouped['value'].astype(np.float64), np.nan),
+                           grouped['in_cohort'], grouped['in_window'], grouped['n'])
+            result = con.execute("""
+                SELECT unit, itemid, value FROM window_rows WHERE unit IS NOT NULL AND value IS NOT NULL
+            """).fetchnumpy()
+            con.execute("DROP TABLE window_rows")
+    finally:
+        con.unregister('window_units')
+    return (np.asarray(result['unit'], dtype=np.int64), np.asarray(result['itemid'], dtype=np.int64),
+            np.asarray(result['value'], dtype=np.float64))
@@ -0,0 +1,205 @@
+# event_store.py
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from chunk_reader import read_csv_chunks
+from cohort import to_epoch_seconds
+
+# Configuration
+data_path = "/home/nishat/physionet.org/files/mimiciv/3.1/"
+STORE_DIR = 'event_store'
+
+EVENT_TABLES = {
+    'chartevents': 'icu/chartevents.csv',
+    'labevents': 'hosp/labevents.csv',
+}
+
+EVENT_DTYPE = np.dtype([('subject_id', np.int32), ('itemid', np.int32),
+                        ('time', np.int64), ('value', np.float32)])
+
+# Rows sorted in memory at a time when ordering each subject's events by time
+SORT_BLOCK_ROWS = 50_000_000
+
+_stores = {}
+
+
+def _paths(table, store_dir):
+    prefix = os.path.join(store_dir, table)
+    return {
+        'events': prefix + '.events.npy',
+        'subjects': prefix + '.subjects.npy',
+        'offsets': prefix + '.offsets.npy',
+        'staging': prefix + '.staging.bin',
+    }
+
+
+def build_store(table, store_dir=STORE_DIR, cohort_ids=None, chunksize=1_000_000):
+    """Convert one event CSV into a subject-sorted, memory-mapped CSR store
+
+    Pass 1 parses the CSV once into fixed-width records (staging file) while
+    counting rows per subject; pass 2 scatters the records into their subject
+    slots; pass 3 sorts each block of subjects by time in memory.
+    """
+    print(f"=== BUILDING EVENT STORE: {table} ===")
+    os.makedirs(store_dir, exist_ok=True)
+    paths = _paths(table, store_dir)
+    cohort_ids = None if cohort_ids is None else np.asarray(cohort_ids, dtype=np.int64)
+
+    # Pass 1: CSV -> staging records + per-subject counts
+    counts = {}
+    n_rows = 0
+    with open(paths['staging'], 'wb') as staging:
+        chunks = read_csv_chunks(os.path.join(data_path, EVENT_TABLES[table]), chunksize=chunksize,
+                                 subjects=cohort_ids, usecols=['subject_id', 'itemid', 'charttime', 'valuenum'])
+        for i, chunk in enumerate(chunks):
+            chunk = chunk[chunk['charttime'].notna()]
+            if cohort_ids is not None:
+                chunk = chunk[np.isin(chunk['subject_id'].to_numpy(), cohort_ids)]
+            if chunk.empty:
+                continue
+            records = np.empty(len(chunk), dtype=EVENT_DTYPE)
+            records['subject_id'] = chunk['subject_id'].to_numpy()
+            records['itemid'] = chunk['itemid'].to_numpy()
+            records['time'] = to_epoch_seconds(chunk['charttime'])
+            records['value'] = chunk['valuenum'].to_numpy(dtype=np.float32)
+            staging.write(records.tobytes())
+            n_rows += len(records)
+
+            subjects, per_subject = np.unique(records['subject_id'], return_counts=True)
+            for s, c in zip(subjects.tolist(), per_subject.tolist()):
+                counts[s] = counts.get(s, 0) + c
+            if i % 20 == 0:
+                print(f"  Parsed {i+1} chunks ({n_rows:,} rows)...")
+
+    subjects = np.array(sorted(counts), dtype=np.int32)
+    offsets = np.zeros(len(subjects) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([counts[s] for s in subjects.tolist()])
+
+    # Pass 2: scatter staging records into subject slots
+    events = np.lib.format.open_memmap(paths['events'], mode='w+', dtype=EVENT_DTYPE, shape=(n_rows,))
+    cursor = offsets[:-1].copy()
+    staging = np.memmap(paths['staging'], dtype=EVENT_DTYPE, mode='r', shape=(n_rows,))
+    for start in range(0, n_rows, chunksize):
+        block = np.array(staging[start:start + chunksize])
+        slot = np.searchsorted(subjects, block['subject_id'])
+        order = np.argsort(slot, kind='stable')
+        slot_sorted = slot[order]
+        first = np.r_[0, np.flatnonzero(np.diff(slot_sorted)) + 1]
+        rank = np.arange(len(order)) - np.repeat(first, np.diff(np.r_[first, len(order)]))
+        events[cursor[slot_sorted] + rank] = block[order]
+        np.add.at(cursor, slot_sorted[first], np.diff(np.r_[first, len(order)]))
+    del staging
+    os.remove(paths['staging'])
+
+    # Pass 3: order each subject's events by time, a block of subjects at a time
+    lo = 0
+    while lo < len(subjects):
+        hi = int(np.searchsorted(offsets, offsets[lo] + SORT_BLOCK_ROWS, side='right')) - 1
+        hi = max(hi, lo + 1)
+        block = np.array(events[offsets[lo]:offsets[hi]])
+        events[offsets[lo]:offsets[hi]] = block[np.lexsort((block['time'], block['subject_id']))]
+        lo = hi
+    events.flush()
+    del events
+
+    np.save(paths['subjects'], subjects)
+    np.save(paths['offsets'], offsets)
+    _stores.pop((table, store_dir), None)
+    print(f"✅ {table}: {n_rows:,} events for {len(subjects):,} subjects -> {paths['events']}")
+
+
+def open_store(table, store_dir=STORE_DIR):
+    """Memory-map a built store (cached per process)"""
+    key = (table, store_dir)
+    if key not in _stores:
+        paths = _paths(table, store_dir)
+        _stores[key] = {
+            'events': np.load(paths['events'], mmap_mode='r'),
+            'subjects': np.load(paths['subjects']),
+            'offsets': np.load(paths['offsets']),
+        }
+    return _stores[key]
+
+
+def _epoch(value, default):
+    """Accept None, epoch seconds, or anything pd.Timestamp understands"""
+    if value is None:
+        return default
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    return int(pd.Timestamp(value).timestamp())
+
+
+def get_timeline(subject_id, itemids=None, start=None, end=None,
+                 tables=tuple(EVENT_TABLES), store_dir=STORE_DIR):
+    """Events for one subject as a structured array sorted by time
+
+    Slices the subject's CSR range, narrows it to [start, end] by binary
+    search on time, then filters itemids; nothing else is read from disk.
+    """
+    start = _epoch(start, np.iinfo(np.int64).min)
+    end = _epoch(end, np.iinfo(np.int64).max)
+    parts = []
+    for table in tables:
+        store = open_store(table, store_dir)
+        pos = np.searchsorted(store['subjects'], subject_id)
+        if pos >= len(store['subjects']) or store['subjects'][pos] != subject_id:
+            continue
+        events = store['events'][store['offsets'][pos]:store['offsets'][pos + 1]]
+        lo = np.searchsorted(events['time'], start, side='left')
+        hi = np.searchsorted(events['time'], end, side='right')
+        events = events[lo:hi]
+        if itemids is not None:
+            events = events[np.isin(events['itemid'], np.asarray(list(itemids), dtype=np.int32))]
+        parts.append(np.array(events))
+
+    if not parts:
+        return np.empty(0, dtype=EVENT_DTYPE)
+    timeline = np.concatenate(parts)
+    return timeline[np.argsort(timeline['time'], kind='stable')]
+
+
+def timeline_frame(timeline):
+    """Structured timeline -> DataFrame with datetime charttime"""
+    frame = pd.DataFrame(timeline)
+    frame['charttime'] = pd.to_datetime(frame.pop('time'), unit='s')
+    return frame
+
+
+def main():
+    """Command-line entry point"""
+    parser = argparse.ArgumentParser(description="Per-patient CSR event store")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    build = sub.add_parser('build', help="convert event CSVs into memory-mapped stores")
+    build.add_argument('--tables', nargs='*', default=list(EVENT_TABLES), choices=list(EVENT_TABLES))
+    build.add_argument('--cohort', help="optional cohort CSV (subject_id column) to restrict the store")
+    build.add_argument('--store-dir', default=STORE_DIR)
+
+    show = sub.add_parser('show', help="print one patient's timeline")
+    show.add_argument('subject_id', type=int)
+    show.add_argument('itemids', nargs='*', type=int)
+    show.add_argument('--start')
+    show.add_argument('--end')
+    show.add_argument('--store-dir', default=STORE_DIR)
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        cohort_ids = None
+        if args.cohort:
+            cohort_ids = pd.read_csv(args.cohort, usecols=['subject_id'])['subject_id'].unique()
+        for table in args.tables:
+            build_store(table, args.store_dir, cohort_ids)
+    else:
+        timeline = get_timeline(args.subject_id, args.itemids or None, args.start, args.end,
+                                store_dir=args.store_dir)
+        with pd.option_context('display.max_rows', 200):
+            print(timeline_frame(timeline))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,377 @@
+# feature_server.py
+import argparse
+import http.client
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from event_store import EVENT_TABLES, STORE_DIR, _paths, get_timeline, open_store, timeline_frame
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:  # optional: without it responses are JSON or CSV only
+    pa = None
+
+# Response formats; Arrow IPC (stream format) is the default when pyarrow is installed
+FORMATS = {
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'json': 'application/json',
+    'csv': 'text/csv',
+}
+DEFAULT_FORMAT = 'arrow' if pa is not None else 'json'
+
+
+def key_rows(index, wanted):
+    """Row positions of the wanted keys, in request order (all rows of a repeated key)
+
+    index: (order, sorted keys) from key_index. Two binary searches per key;
+    unknown keys give no rows.
+    """
+    order, keys = index
+    wanted = np.asarray(wanted, dtype=np.int64)
+    lo = np.searchsorted(keys, wanted, side='left')
+    hi = np.searchsorted(keys, wanted, side='right')
+    counts = hi - lo
+    # Expand every [lo, hi) range without a Python loop
+    offsets = np.repeat(lo - np.r_[0, np.cumsum(counts)[:-1]], counts)
+    return order[offsets + np.arange(counts.sum())]
+
+
+def key_index(keys):
+    """(order, sorted keys) for key_rows"""
+    keys = np.asarray(keys, dtype=np.int64)
+    order = np.argsort(keys, kind='stable')
+    return order, keys[order]
+
+
+class FeatureStore:
+    """Cohort, feature matrix and event stores held in memory for the server
+
+    Rows are looked up by subject_id (or stay_id when the matrix has one)
+    through sorted key arrays; the matrix is kept as a DataFrame and, with
+    pyarrow, as an Arrow table, so a request only gathers rows and columns.
+    """
+
+    def __init__(self, features_file, cohort_file, store_dir=STORE_DIR):
+        started = time.time()
+        self.features = pd.read_csv(features_file)
+        self.table = pa.Table.from_pandas(self.features, preserve_index=False) if pa is not None else None
+        self.keys = [k for k in ('subject_id', 'stay_id') if k in self.features]
+        self.by_subject = key_index(self.features['subject_id'])
+        self.by_stay = key_index(self.features['stay_id']) if 'stay_id' in self.features else None
+
+        cohort = pd.read_csv(cohort_file, usecols=lambda c: c in ('subject_id', 'stay_id', 'first_careunit', 'los'))
+        self.careunit = pd.Categorical(cohort['first_careunit'])
+        self.los = cohort['los'].to_numpy(dtype=np.float64)
+        self.cohort_subjects = cohort['subject_id'].to_numpy(dtype=np.int64)
+        self.cohort_stays = cohort['stay_id'].to_numpy(dtype=np.int64) if 'stay_id' in cohort else None
+
+        # Event stores built by event_store.py, memory-mapped once
+        self.store_dir = store_dir
+        self.event_tables = tuple(t for t in EVENT_TABLES if os.path.exists(_paths(t, store_dir)['events']))
+        for table in self.event_tables:
+            open_store(table, store_dir)
+        self.load_seconds = time.time() - started
+
+    def info(self):
+        return {
+            'rows': len(self.features), 'keys': self.keys, 'columns': list(self.features.columns),
+            'careunits': list(self.careunit.categories), 'event_tables': list(self.event_tables),
+            'formats': [f for f in FORMATS if f != 'arrow' or pa is not None],
+            'load_seconds': round(self.load_seconds, 3),
+        }
+
+    def columns(self, names):
+        """Projection with the key columns first; KeyError on unknown names"""
+        if not names:
+            return list(self.features.columns)
+        unknown = [c for c in names if c not in self.features]
+        if unknown:
+            raise KeyError(f"unknown columns: {', '.join(unknown)}")
+        return self.keys + [c for c in names if c not in self.keys]
+
+    def subject_rows(self, subject_ids):
+        return key_rows(self.by_subject, subject_ids)
+
+    def slice_rows(self, careunits=(), min_los=None, max_los=None):
+        """Feature rows of the cohort stays in the given care units and LOS range (days)"""
+        mask = np.ones(len(self.los), dtype=bool)
+        if careunits:
+            codes = [self.careunit.categories.get_loc(u) for u in careunits if u in self.careunit.categories]
+            mask &= np.isin(self.careunit.codes, codes)
+        if min_los is not None:
+            mask &= self.los >= min_los
+        if max_los is not None:
+            mask &= self.los <= max_los
+        if self.by_stay is not None and self.cohort_stays is not None:
+            return key_rows(self.by_stay, self.cohort_stays[mask])
+        return key_rows(self.by_subject, np.unique(self.cohort_subjects[mask]))
+
+    def encode(self, rows, columns, fmt):
+        """Selected rows and columns as (content type, body bytes); columns are projected first"""
+        if fmt == 'arrow':
+            return FORMATS['arrow'], arrow_bytes(self.table.select(columns).take(pa.array(rows)))
+        return encode_frame(self.features[columns].iloc[rows], fmt)
+
+    def timeline(self, subject_id, itemids=None, start=None, end=None):
+        return timeline_frame(get_timeline(subject_id, itemids, start, end, self.event_tables, self.store_dir))
+
+
+def arrow_bytes(table):
+    """Arrow table -> IPC stream bytes"""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def encode_frame(frame, fmt):
+    """DataFrame -> (content type, body bytes) in any supported format"""
+    if fmt == 'arrow':
+        return FORMATS['arrow'], arrow_bytes(pa.Table.from_pandas(frame, preserve_index=False))
+    if fmt == 'csv':
+        return FORMATS['csv'], frame.to_csv(index=False).encode()
+    return FORMATS['json'], frame.to_json(orient='records', date_format='iso').encode()
+
+
+def _ids(value):
+    """Subject / item ids from a JSON list or comma-separated strings"""
+    if value is None:
+        return []
+    if isinstance(value, (int, float)):
+        return [int(value)]
+    if isinstance(value, str):
+        value = [value]
+    if all(isinstance(v, int) for v in value):
+        return np.asarray(value, dtype=np.int64)
+    return [int(v) for item in value for v in str(item).split(',') if v.strip()]
+
+
+def _names(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = [value]
+    return [v.strip() for item in value for v in str(item).split(',') if v.strip()]
+
+
+def _number(value):
+    if isinstance(value, list):
+        value = value[-1]
+    return None if value in (None, '') else float(value)
+
+
+def _first(value):
+    return value[-1] if isinstance(value, list) else value
+
+
+class Handler(BaseHTTPRequestHandler):
+    """HTTP/1.1 (keep-alive) requests against the server's FeatureStore
+
+    GET  /info                                      matrix columns, care units, event tables
+    GET  /features?subject_id=1,2&columns=a,b       rows of the given subjects
+    POST /features {"subject_id": [...], "columns": [...]}   (for long subject lists)
+    GET  /cohort?careunit=MICU&min_los=2&max_los=7&columns=a  cohort slice
+    GET  /timeline?subject_id=1&itemids=220045&start=..&end=..  events from event_store.py
+    POST /reload                                    re-read the files and swap them in
+    Every data request takes format=arrow|json|csv.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Buffer headers and body into one write per response: separate small writes
+    # stall ~40 ms on keep-alive TCP connections (Nagle vs. delayed ACK)
+    wbufsize = -1
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.respond(url.path, parse_qs(url.query))
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        params = parse_qs(url.query)
+        if length:
+            params.update(json.loads(self.rfile.read(length)))
+        self.respond(url.path, params)
+
+    def respond(self, path, params):
+        started = time.perf_counter()
+        try:
+            status, content_type, body = 200, *self.route(path, params)
+        except (KeyError, ValueError) as error:
+            status, content_type = 400, FORMATS['json']
+            body = json.dumps({'error': str(error).strip('"\'')}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Elapsed-Ms', f"{1000 * (time.perf_counter() - started):.2f}")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self, path, params):
+        server = self.server
+        fmt = _first(params.get('format')) or DEFAULT_FORMAT
+        if fmt not in FORMATS:
+            raise ValueError(f"format must be one of {list(FORMATS)}")
+        if fmt == 'arrow' and pa is None:
+            raise ValueError("format=arrow needs pyarrow on the server (pip install pyarrow)")
+
+        if path == '/reload':
+            server.reload()
+            path = '/info'
+        store = server.store
+        if path == '/info':
+            return FORMATS['json'], json.dumps(store.info()).encode()
+        if path == '/features':
+            rows = store.subject_rows(_ids(params.get('subject_id')))
+            return store.encode(rows, store.columns(_names(params.get('columns'))), fmt)
+        if path == '/cohort':
+            rows = store.slice_rows(_names(params.get('careunit')), _number(params.get('min_los')),
+                                    _number(params.get('max_los')))
+            return store.encode(rows, store.columns(_names(params.get('columns'))), fmt)
+        if path == '/timeline':
+            if not store.event_tables:
+                raise ValueError(f"no event store in {store.store_dir} (build one with event_store.py)")
+            subjects = _ids(params.get('subject_id'))
+            if len(subjects) != 1:
+                raise ValueError("timeline takes exactly one subject_id")
+            itemids = _ids(params.get('itemids'))
+            frame = store.timeline(subjects[0], itemids if len(itemids) else None,
+                                   _first(params.get('start')), _first(params.get('end')))
+            return encode_frame(frame, fmt)
+        raise KeyError(f"unknown endpoint {path}")
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class _Serving:
+    """Holds the store behind the handlers; reload builds a new one and swaps it in"""
+    daemon_threads = True
+    verbose = False
+
+    def setup_store(self, loader):
+        self.loader = loader
+        self.store = loader()
+        self.reload_lock = threading.Lock()
+
+    def reload(self):
+        with self.reload_lock:
+            self.store = self.loader()
+
+
+class FeatureHTTPServer(_Serving, ThreadingHTTPServer):
+    pass
+
+
+class FeatureUnixServer(_Serving, socketserver.ThreadingUnixStreamServer):
+    pass
+
+
+def make_server(address, loader):
+    """HTTP server on a local host:port or a Unix socket path"""
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        server = FeatureHTTPServer((host, int(port)), Handler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = FeatureUnixServer(address, Handler)
+    server.setup_store(loader)
+    return server
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+def connect(address):
+    """Keep-alive connection to a running server (host:port or Unix socket path)"""
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        return http.client.HTTPConnection(host, int(port), timeout=60)
+    return _UnixConnection(address)
+
+
+def _jsonable(value):
+    """JSON form of the NumPy / pandas values notebooks hold ids in"""
+    if isinstance(value, (np.ndarray, pd.Series, pd.Index)):
+        return np.asarray(value).tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def fetch(connection, endpoint, **params):
+    """Query a server from a notebook or script and get a DataFrame (or the /info dict)
+
+    e.g. fetch(connect('features.sock'), 'features', subject_id=ids, columns=['Heart_Rate_mean'])
+    """
+    params.setdefault('format', DEFAULT_FORMAT)
+    connection.request('POST', '/' + endpoint.lstrip('/'), body=json.dumps(params, default=_jsonable),
+                       headers={'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    body = response.read()
+    content_type = response.getheader('Content-Type')
+    if response.status != 200:
+        raise ValueError(json.loads(body)['error'])
+    if content_type == FORMATS['arrow']:
+        return pa.ipc.open_stream(body).read_all().to_pandas()
+    if content_type == FORMATS['csv']:
+        return pd.read_csv(io.BytesIO(body))
+    data = json.loads(body)
+    return pd.DataFrame(data) if isinstance(data, list) else data
+
+
+def main():
+    """Load the feature matrix once and serve it until interrupted"""
+    parser = argparse.ArgumentParser(description="Local server for ICU features, cohort slices and timelines")
+    parser.add_argument('--features', default='merged_on_subject_id.csv', help="final feature matrix")
+    parser.add_argument('--cohort', default='patients.csv', help="cohort with first_careunit and los")
+    parser.add_argument('--store-dir', default=STORE_DIR, help="event_store.py stores (optional)")
+    parser.add_argument('--listen', default='127.0.0.1:8765', help="host:port or Unix socket path")
+    parser.add_argument('--verbose', action='store_true', help="log every request")
+    args = parser.parse_args()
+
+    print("=== ICU FEATURE SERVER ===")
+    server = make_server(args.listen, lambda: FeatureStore(args.features, args.cohort, args.store_dir))
+    server.verbose = args.verbose
+    info = server.store.info()
+    print(f"Features: {info['rows']} rows x {len(info['columns'])} columns (loaded in {info['load_seconds']}s)")
+    print(f"Care units: {len(info['careunits'])}, event stores: {info['event_tables'] or 'none'}")
+    if pa is None:
+        print("⚠️  pyarrow not installed: serving JSON/CSV only")
+    print(f"🔌 Listening on {args.listen}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if ':' not in args.listen and os.path.exists(args.listen):
+            os.remove(args.listen)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,53 @@
 import pandas as pd
 
-# Load files
-gen  = pd.read_csv("general.csv")
-vital = pd.read_csv("vital.csv")
-diag = pd.read_csv("diagnosis.csv")
-ther = pd.read_csv("therapy.csv")
+from cohort import cohort_key
+from sampling import apply_sample
+
+# Load files (restricted to the sampled subjects in --sample runs)
+gen  = apply_sample(pd.read_csv("general.csv"))
+vital = apply_sample(pd.read_csv("vital.csv"))
+diag = apply_sample(pd.read_csv("diagnosis.csv"))
+ther = apply_sample(pd.read_csv("therapy.csv"))
+# SOFA from sofa.py (patient-level, computed from the vital table)
+sofa = apply_sample(pd.read_csv("sofa.csv")).drop_duplicates('subject_id')
+sofa = pd.DataFrame({'subject_id': sofa['subject_id'],
+                     'SOFA_score_min': sofa['sofa_total'], 'SOFA_score_max': sofa['sofa_total']})
 
 print("Shapes:")
 print("general:", gen.shape)
 print("vital:", vital.shape)
 print("diagnosis:", diag.shape)
 print("therapy:", ther.shape)
+print("sofa:", sofa.shape)
 
-print("\nMerging based on subject_id ONLY...")
 
-# Step 1: merge general + vital
-m1 = gen.merge(vital, on="subject_id", how="left")
+def merge_keys(left, right):
+    """Key columns shared by two tables (stay-level tables also carry stay_id)"""
+    return [k for k in ('subject_id', 'stay_id') if k in left.columns and k in right.columns]
+
+
+print(f"\nMerging based on {cohort_key()} (patient-level tables on subject_id)...")
+
+def merge_onto(left, right, name):
+    """Left merge that must keep one row per cohort unit (raises on duplicated right keys)"""
+    merged = left.merge(right, on=merge_keys(left, right), how="left", validate="many_to_one")
+    assert len(merged) == len(left), f"merging {name} changed the row count ({len(left)} -> {len(merged)})"
+    return merged
+
+
+# Step 1: merge general + vital (general is patient-level; vital has a row per unit,
+# so in stay mode this is where patients become stays)
+m1 = gen.merge(vital, on=merge_keys(gen, vital), how="left", validate="one_to_many")
+assert len(m1) == len(vital), f"merging vital gave {len(m1)} rows for {len(vital)} units"
 
 # Step 2: merge diagnosis
-m2 = m1.merge(diag, on="subject_id", how="left")
+m2 = merge_onto(m1, diag, "diagnosis")
 
 # Step 3: merge therapy
-final = m2.merge(ther, on="subject_id", how="left")
+final = merge_onto(m2, ther, "therapy")
+
+# Step 4: merge SOFA
+final = merge_onto(final, sofa, "sofa")
 
 # Save
 final.to_csv("merged_on_subject_id.csv", index=False)
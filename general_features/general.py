@@ -1,22 +1,36 @@
 # general_features_with_diabetes_hadm.py
+import os
+import sys
+
 import pandas as pd
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from concepts import concept_codes, concept_itemids
+from duckdb_backend import scan_chunks
+from icd_matrix import code_indicator, icd_matrix, phenotype
+from reference_cache import subject_lookup
+from sampling import apply_sample
+
+HEIGHT_ITEMIDS = concept_itemids('Height').tolist()
+WEIGHT_ITEMIDS = concept_itemids('Weight').tolist()
+DM_ICD9_CODES = concept_codes('Diabetes_mellitus', version=9)
+DM_ICD10_CODES = concept_codes('Diabetes_mellitus', version=10)
+
 print("=== COMPLETE GENERAL FEATURES + DIABETES + HADM_ID EXTRACTION ===")
 
 # 1. Load filtered patients - BASE
-filtered = pd.read_csv('patients.csv')
-our_patients = filtered['subject_id'].tolist()
+filtered = apply_sample(pd.read_csv('patients.csv'))
+our_patients = filtered['subject_id'].unique().tolist()
 print(f"Processing {len(our_patients)} patients...")
 
-# 2. Start with filtered patients as base
-result = filtered[['subject_id']].copy()
+# 2. Start with filtered patients as base (patient-level, also in stay mode)
+result = filtered[['subject_id']].drop_duplicates().copy()
 
 # ------------------------------
 # 3. Gender & Age
 # ------------------------------
 print("Extracting gender and age...")
-patients = pd.read_csv('hosp/patients.csv')
-demo_data = patients[patients['subject_id'].isin(our_patients)][['subject_id', 'gender', 'anchor_age']]
+demo_data = subject_lookup('patients', our_patients, ['gender', 'anchor_age'])
 demo_data = demo_data.rename(columns={'anchor_age': 'age_years'})
 result = result.merge(demo_data, on='subject_id', how='left')
 
@@ -24,16 +38,16 @@ result = result.merge(demo_data, on='subject_id', how='left')
 # 4. Ethnicity + HADM_ID (first admission)
 # ------------------------------
 print("Extracting ethnicity and hadm_id...")
-admissions = pd.read_csv('hosp/admissions.csv')
-first_adm = admissions.sort_values(['subject_id', 'admittime']).groupby('subject_id').first().reset_index()
+# First admission per subject, precomputed in the reference cache (see reference_cache.py)
+first_adm = subject_lookup('first_admissions', our_patients, ['race', 'hadm_id'])
 
 # Ethnicity
-ethnicity_data = first_adm[first_adm['subject_id'].isin(our_patients)][['subject_id', 'race']]
+ethnicity_data = first_adm[['subject_id', 'race']]
 ethnicity_data = ethnicity_data.rename(columns={'race': 'ethnicity'})
 result = result.merge(ethnicity_data, on='subject_id', how='left')
 
 # HADM_ID
-hadm_data = first_adm[first_adm['subject_id'].isin(our_patients)][['subject_id', 'hadm_id']]
+hadm_data = first_adm[['subject_id', 'hadm_id']]
 result = result.merge(hadm_data, on='subject_id', how='left')
 
 # Reorder columns: subject_id, hadm_id, rest...
@@ -46,9 +60,10 @@ result = result[cols]
 # ------------------------------
 print("Extracting height...")
 height_data = []
-chunks = pd.read_csv('icu/chartevents.csv', chunksize=100_000, usecols=['subject_id','itemid','valuenum'])
+chunks = scan_chunks('icu/chartevents.csv', ['subject_id','itemid','valuenum'], {'itemid': HEIGHT_ITEMIDS},
+                     subjects=our_patients)
 for i, chunk in enumerate(chunks):
-    h_chunk = chunk[(chunk['subject_id'].isin(our_patients)) & (chunk['itemid'] == 226730)]
+    h_chunk = chunk[(chunk['subject_id'].isin(our_patients)) & (chunk['itemid'].isin(HEIGHT_ITEMIDS))]
     if not h_chunk.empty:
         height_data.append(h_chunk)
     if i % 10 == 0:
@@ -65,9 +80,10 @@ if height_data:
 # ------------------------------
 print("Extracting weight...")
 weight_data = []
-chunks = pd.read_csv('icu/chartevents.csv', chunksize=100_000, usecols=['subject_id','itemid','valuenum'])
+chunks = scan_chunks('icu/chartevents.csv', ['subject_id','itemid','valuenum'], {'itemid': WEIGHT_ITEMIDS},
+                     subjects=our_patients)
 for i, chunk in enumerate(chunks):
-    w_chunk = chunk[(chunk['subject_id'].isin(our_patients)) & (chunk['itemid'] == 226512)]
+    w_chunk = chunk[(chunk['subject_id'].isin(our_patients)) & (chunk['itemid'].isin(WEIGHT_ITEMIDS))]
     if not w_chunk.empty:
         weight_data.append(w_chunk)
     if i % 10 == 0:
@@ -83,30 +99,11 @@ if weight_data:
 # 7. Diabetes Mellitus
 # ------------------------------
 print("Extracting diabetes mellitus...")
-diag_chunks = pd.read_csv('hosp/diagnoses_icd.csv', chunksize=500_000)
-diabetes_rows = []
-
-for i, chunk in enumerate(diag_chunks):
-    chunk = chunk[chunk['subject_id'].isin(our_patients)]
-    if chunk.empty:
-        continue
-
-    # ICD-9 diabetes 250.xx
-    chunk['is_dm_icd9'] = ((chunk['icd_version'] == 9) & chunk['icd_code'].astype(str).str.startswith('250')).astype(int)
-
-    # ICD-10 diabetes E08–E13
-    chunk['is_dm_icd10'] = ((chunk['icd_version'] == 10) & chunk['icd_code'].astype(str).str.startswith(('E08','E09','E10','E11','E13'))).astype(int)
-
-    chunk['diabetes_mellitus'] = chunk[['is_dm_icd9','is_dm_icd10']].max(axis=1)
-    diabetes_rows.append(chunk[['subject_id','diabetes_mellitus']])
-
-    if i % 10 == 0:
-        print(f"  Processed {i+1} chunks...")
 
-if diabetes_rows:
-    all_diabetes = pd.concat(diabetes_rows, ignore_index=True)
-    diabetes_df = all_diabetes.groupby('subject_id')['diabetes_mellitus'].max().reset_index()
-    result = result.merge(diabetes_df, on='subject_id', how='left')
+# ICD-9 diabetes 250.xx or ICD-10 E08–E13, via the subject x ICD matrix (icd_matrix.py)
+icd = icd_matrix(our_patients)
+dm_indicator = code_indicator(icd, codes={9: DM_ICD9_CODES, 10: DM_ICD10_CODES})
+result['diabetes_mellitus'] = phenotype(icd, dm_indicator, result['subject_id'])
 
 # Fill missing diabetes as 0
 result['diabetes_mellitus'] = result['diabetes_mellitus'].fillna(0).astype(int)
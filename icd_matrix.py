@@ -0,0 +1,225 @@
+# icd_matrix.py
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from chunk_reader import read_csv_chunks
+from cohort import subject_index
+from sampling import apply_sample
+
+# Configuration
+data_path = "/home/nishat/physionet.org/files/mimiciv/3.1/"
+ICD_MATRIX_FILE = 'icd_matrix.npz'
+DIAGNOSES_FILE = 'hosp/diagnoses_icd.csv'
+
+# Charlson comorbidity groups (Quan et al. 2005 coding), code prefixes without dots,
+# with the weights of the Charlson index
+CHARLSON_GROUPS = {
+    'Myocardial_infarction': ({9: ['410', '412'], 10: ['I21', 'I22', 'I252']}, 1),
+    'Congestive_heart_failure': ({9: ['39891', '40201', '40211', '40291', '40401', '40403', '40411', '40413',
+                                      '40491', '40493', '4254', '4255', '4256', '4257', '4258', '4259', '428'],
+                                  10: ['I099', 'I110', 'I130', 'I132', 'I255', 'I420', 'I425', 'I426', 'I427',
+                                       'I428', 'I429', 'I43', 'I50', 'P290']}, 1),
+    'Peripheral_vascular_disease': ({9: ['0930', '4373', '440', '441', '4431', '4432', '4433', '4434', '4435',
+                                         '4436', '4437', '4438', '4439', '4471', '5571', '5579', 'V434'],
+                                     10: ['I70', 'I71', 'I731', 'I738', 'I739', 'I771', 'I790', 'I792', 'K551',
+                                          'K558', 'K559', 'Z958', 'Z959']}, 1),
+    'Cerebrovascular_disease': ({9: ['36234', '430', '431', '432', '433', '434', '435', '436', '437', '438'],
+                                 10: ['G45', 'G46', 'H340', 'I60', 'I61', 'I62', 'I63', 'I64', 'I65', 'I66',
+                                      'I67', 'I68', 'I69']}, 1),
+    'Dementia': ({9: ['290', '2941', '3312'], 10: ['F00', 'F01', 'F02', 'F03', 'F051', 'G30', 'G311']}, 1),
+    'Chronic_pulmonary_disease': ({9: ['4168', '4169', '490', '491', '492', '493', '494', '495', '496', '497',
+                                       '498', '499', '500', '501', '502', '503', '504', '505', '5064', '5081',
+                                       '5088'],
+                                   10: ['I278', 'I279', 'J40', 'J41', 'J42', 'J43', 'J44', 'J45', 'J46', 'J47',
+                                        'J60', 'J61', 'J62', 'J63', 'J64', 'J65', 'J66', 'J67', 'J684', 'J701',
+                                        'J703']}, 1),
+    'Rheumatic_disease': ({9: ['4465', '7100', '7101', '7102', '7103', '7104', '7140', '7141', '7142', '7148',
+                               '725'],
+                           10: ['M05', 'M06', 'M315', 'M32', 'M33', 'M34', 'M351', 'M353', 'M360']}, 1),
+    'Peptic_ulcer_disease': ({9: ['531', '532', '533', '534'], 10: ['K25', 'K26', 'K27', 'K28']}, 1),
+    'Mild_liver_disease': ({9: ['07022', '07023', '07032', '07033', '07044', '07054', '0706', '0709', '570',
+                                '571', '5733', '5734', '5738', '5739', 'V427'],
+                            10: ['B18', 'K700', 'K701', 'K702', 'K703', 'K709', 'K713', 'K714', 'K715', 'K717',
+                                 'K73', 'K74', 'K760', 'K762', 'K763', 'K764', 'K768', 'K769', 'Z944']}, 1),
+    'Diabetes_without_complication': ({9: ['2500', '2501', '2502', '2503', '2508', '2509'],
+                                       10: [f'{e}{d}' for e in ('E10', 'E11', 'E12', 'E13', 'E14')
+                                            for d in ('0', '1', '6', '8', '9')]}, 1),
+    'Diabetes_with_complication': ({9: ['2504', '2505', '2506', '2507'],
+                                    10: [f'{e}{d}' for e in ('E10', 'E11', 'E12', 'E13', 'E14')
+                                         for d in ('2', '3', '4', '5', '7')]}, 2),
+    'Hemiplegia_paraplegia': ({9: ['3341', '342', '343', '3440', '3441', '3442', '3443', '3444', '3445',
+                                   '3446', '3449'],
+                               10: ['G041', 'G114', 'G801', 'G802', 'G81', 'G82', 'G830', 'G831', 'G832',
+                                    'G833', 'G834', 'G839']}, 2),
+    'Renal_disease': ({9: ['40301', '40311', '40391', '40402', '40403', '40412', '40413', '40492', '40493',
+                           '582', '5830', '5831', '5832', '5833', '5834', '5835', '5836', '5837', '585', '586',
+                           '5880', 'V420', 'V451', 'V56'],
+                       10: ['I120', 'I131', 'N032', 'N033', 'N034', 'N035', 'N036', 'N037', 'N052', 'N053',
+                            'N054', 'N055', 'N056', 'N057', 'N18', 'N19', 'N250', 'Z490', 'Z491', 'Z492',
+                            'Z940', 'Z992']}, 2),
+    'Malignancy': ({9: [str(c) for c in range(140, 173)] + [str(c) for c in range(174, 195)]
+                    + ['1950', '1951', '1952', '1953', '1954', '1955', '1958']
+                    + [str(c) for c in range(200, 209)] + ['2386'],
+                    10: [f'C{c:02d}' for c in list(range(0, 27)) + list(range(30, 35)) + list(range(37, 42))
+                         + [43] + list(range(45, 59)) + list(range(60, 77)) + list(range(81, 86)) + [88]
+                         + list(range(90, 98))]}, 2),
+    'Severe_liver_disease': ({9: ['4560', '4561', '4562', '5722', '5723', '5724', '5725', '5726', '5727',
+                                  '5728'],
+                              10: ['I850', 'I859', 'I864', 'I982', 'K704', 'K711', 'K721', 'K729', 'K765',
+                                   'K766', 'K767']}, 3),
+    'Metastatic_solid_tumor': ({9: ['196', '197', '198', '199'], 10: ['C77', 'C78', 'C79', 'C80']}, 6),
+    'AIDS_HIV': ({9: ['042', '043', '044'], 10: ['B20', 'B21', 'B22', 'B24']}, 6),
+}
+
+
+def build_icd_matrix(cohort_ids, output=ICD_MATRIX_FILE, chunksize=None):
+    """One pass over diagnoses_icd -> binary CSR matrix (cohort subjects x distinct ICD codes)
+
+    Columns cover both ICD versions; the vocabulary (icd_version, icd_code)
+    is saved next to the matrix so phenotypes never touch the CSV again.
+    """
+    print("=== BUILDING SUBJECT x ICD MATRIX ===")
+    cohort_ids = np.unique(np.asarray(cohort_ids, dtype=np.int64))
+    pairs = []
+    source = os.path.join(data_path, DIAGNOSES_FILE)
+    stat = os.stat(source)
+    chunks = read_csv_chunks(source, chunksize=chunksize,
+                             subjects=cohort_ids, usecols=['subject_id', 'icd_code', 'icd_version'], dtype={'icd_code': str})
+    for i, chunk in enumerate(chunks):
+        idx = subject_index(cohort_ids, chunk['subject_id'].to_numpy())
+        chunk = chunk[idx >= 0].assign(row=idx[idx >= 0])
+        pairs.append(chunk[['row', 'icd_version', 'icd_code']].drop_duplicates())
+        if i % 5 == 0:
+            print(f"  Processed {i+1} chunks...")
+
+    if pairs:
+        pairs = pd.concat(pairs, ignore_index=True).drop_duplicates()
+    else:
+        # No diagnoses for this cohort: empty vocabulary and an all-zero matrix
+        pairs = pd.DataFrame({'row': np.array([], dtype=np.int64), 'icd_version': np.array([], dtype=np.int64),
+                              'icd_code': np.array([], dtype=object)})
+    pairs['icd_code'] = pairs['icd_code'].str.strip()
+    vocab = pairs[['icd_version', 'icd_code']].drop_duplicates().sort_values(['icd_version', 'icd_code'])
+    vocab = vocab.reset_index(drop=True)
+    col = pd.MultiIndex.from_frame(vocab).get_indexer(pd.MultiIndex.from_frame(pairs[['icd_version', 'icd_code']]))
+
+    matrix = sp.csr_matrix((np.ones(len(pairs), dtype=np.int8), (pairs['row'].to_numpy(), col)),
+                           shape=(len(cohort_ids), len(vocab)))
+    matrix.sum_duplicates()
+    # Write atomically: general, diagnosis and the feature server may load or rebuild it at once
+    partial = f'{output}.{os.getpid()}.tmp.npz'
+    np.savez_compressed(partial, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                        shape=np.array(matrix.shape), subject_id=cohort_ids,
+                        icd_version=vocab['icd_version'].to_numpy(dtype=np.int8),
+                        icd_code=vocab['icd_code'].to_numpy(dtype=str),
+                        source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns)
+    os.replace(partial, output)
+    print(f"✅ {matrix.shape[0]} subjects x {matrix.shape[1]} codes ({matrix.nnz:,} entries) -> {output}")
+    return load_icd_matrix(output)
+
+
+def load_icd_matrix(path=ICD_MATRIX_FILE):
+    """Load a saved matrix: {'matrix', 'subject_id', 'icd_version', 'icd_code'} (+ source stats)"""
+    with np.load(path) as f:
+        icd = {
+            'matrix': sp.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape'])),
+            'subject_id': f['subject_id'],
+            'icd_version': f['icd_version'],
+            'icd_code': f['icd_code'],
+        }
+        for key in ('source_size', 'source_mtime_ns'):
+            icd[key] = int(f[key]) if key in f.files else -1
+    return icd
+
+
+def _is_current(icd):
+    """True when the matrix was built from this version of diagnoses_icd.csv
+
+    A matrix used where the source is not available is not checked.
+    """
+    source = os.path.join(data_path, DIAGNOSES_FILE)
+    if not os.path.exists(source):
+        return True
+    stat = os.stat(source)
+    return icd['source_size'] == stat.st_size and icd['source_mtime_ns'] == stat.st_mtime_ns
+
+
+def icd_matrix(cohort_ids, path=ICD_MATRIX_FILE):
+    """Saved matrix if it is current and covers every cohort subject, else rebuild it for this cohort"""
+    cohort_ids = np.asarray(cohort_ids, dtype=np.int64)
+    if os.path.exists(path):
+        icd = load_icd_matrix(path)
+        if not _is_current(icd):
+            print(f"  {path} is stale ({DIAGNOSES_FILE} changed), rebuilding...")
+        elif np.isin(cohort_ids, icd['subject_id']).all():
+            return icd
+        else:
+            print(f"  {path} does not cover the cohort, rebuilding...")
+    return build_icd_matrix(cohort_ids, path)
+
+
+def code_indicator(icd, codes=None, prefixes=None):
+    """Column indicator (float vector over the vocabulary) for codes/prefixes per ICD version
+
+    codes / prefixes: {version: [code, ...]}; exact matches and prefix
+    matches are combined.
+    """
+    hit = np.zeros(len(icd['icd_code']), dtype=bool)
+    for version, values in (codes or {}).items():
+        hit |= (icd['icd_version'] == version) & np.isin(icd['icd_code'], list(values))
+    for version, values in (prefixes or {}).items():
+        if values:
+            starts = np.char.startswith(icd['icd_code'].astype(str)[:, None], np.asarray(values, dtype=str)[None, :])
+            hit |= (icd['icd_version'] == version) & starts.any(axis=1)
+    return hit.astype(np.float64)
+
+
+def phenotype(icd, indicator, cohort_ids=None):
+    """0/1 per subject: any code of the indicator (sparse matrix x vector product)
+
+    Rows follow icd['subject_id'], or cohort_ids when given (0 for subjects
+    missing from the matrix).
+    """
+    flags = (icd['matrix'] @ indicator > 0).astype(int)
+    if cohort_ids is None:
+        return flags
+    rows = subject_index(icd['subject_id'], cohort_ids)
+    return np.where(rows >= 0, flags[np.maximum(rows, 0)], 0)
+
+
+def charlson(icd, cohort_ids=None):
+    """Charlson comorbidity groups and index per subject"""
+    subject_ids = icd['subject_id'] if cohort_ids is None else np.asarray(cohort_ids, dtype=np.int64)
+    frame = pd.DataFrame({'subject_id': subject_ids})
+    groups = np.column_stack([code_indicator(icd, prefixes=prefixes) for prefixes, _ in CHARLSON_GROUPS.values()])
+    flags = (icd['matrix'] @ groups > 0).astype(int)
+    if cohort_ids is not None:
+        rows = subject_index(icd['subject_id'], subject_ids)
+        flags = np.where((rows >= 0)[:, None], flags[np.maximum(rows, 0)], 0)
+
+    # Milder forms do not count when the severe form of the same disease is present
+    names = list(CHARLSON_GROUPS)
+    for mild, severe in [('Mild_liver_disease', 'Severe_liver_disease'),
+                         ('Diabetes_without_complication', 'Diabetes_with_complication'),
+                         ('Malignancy', 'Metastatic_solid_tumor')]:
+        flags[:, names.index(mild)] &= 1 - flags[:, names.index(severe)]
+
+    for j, name in enumerate(names):
+        frame[name] = flags[:, j]
+    weights = np.array([weight for _, weight in CHARLSON_GROUPS.values()])
+    frame['Charlson_index'] = flags @ weights
+    return frame
+
+
+def main():
+    """Build the matrix for the cohort in patients.csv"""
+    cohort = apply_sample(pd.read_csv('patients.csv'))
+    build_icd_matrix(cohort['subject_id'].unique())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
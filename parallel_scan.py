@@ -0,0 +1,101 @@
+# parallel_scan.py
+import collections
+import io
+
+import numpy as np
+import pandas as pd
+
+from byte_index import RangeCSV, line_ranges
+from chunk_reader import memory_budget
+from cohort import attribute_stays, subject_index, to_epoch_seconds
+from concepts import tag_itemids
+from profiles import merge_profiles, new_profile, update_profile
+from shared_cohort import published, unit_tables, worker_pool, worker_tables
+from sketches import concept_sketch, update_sketch
+from units import conversion_table, normalize_values
+
+# Bytes of source CSV one task parses: the budget split over the workers,
+# with room for the parsed copy, its filtered copies and queued results
+TASK_BUDGET_SHARE = 8
+MIN_TASK_BYTES = 8 * 1024 ** 2
+MAX_TASK_BYTES = 256 * 1024 ** 2
+
+
+def task_bytes(workers):
+    """Byte range per task for this many workers under the memory budget (ICU_MEMORY_BUDGET_MB)"""
+    return int(np.clip(memory_budget() // (TASK_BUDGET_SHARE * workers), MIN_TASK_BYTES, MAX_TASK_BYTES))
+
+
+def scan_range(path, start, end, header_end, features, value_column, lookback_hours):
+    """Worker task: the events of one byte range, tagged with their feature and unit
+
+    The cohort windows and the itemid -> feature lookup are the shared tables
+    attached by the worker (shared_cohort.py). Returns per feature the
+    (unit, value) pairs of plausible in-window events, the range's data
+    profile and its count of implausible values.
+    """
+    tables = worker_tables()
+    source = io.BufferedReader(RangeCSV(path, header_end, np.array([start]), np.array([end])),
+                               buffer_size=1024 ** 2)
+    chunk = pd.read_csv(source, usecols=['subject_id', 'itemid', 'charttime', value_column])
+    feature = tag_itemids(tables['feature_lookup'], chunk['itemid'].to_numpy())
+    chunk = chunk[feature >= 0]
+    feature = feature[feature >= 0]
+
+    subject_ids = chunk['subject_id'].to_numpy(dtype=np.int64)
+    itemids = chunk['itemid'].to_numpy(dtype=np.int64)
+    raw = chunk[value_column].to_numpy(dtype=float)
+    in_cohort = subject_index(tables['subject_id'], subject_ids) >= 0
+    unit = np.full(len(chunk), -1, dtype=np.int64)
+    unit[in_cohort] = attribute_stays(tables, subject_ids[in_cohort],
+                                      to_epoch_seconds(chunk['charttime'].to_numpy()[in_cohort]), lookback_hours)
+
+    found = {}
+    for position, (name, feature_itemids) in enumerate(features.items()):
+        rows = feature == position
+        profile = update_profile(new_profile(feature_itemids), itemids[rows], raw[rows], in_cohort[rows],
+                                 unit[rows] >= 0)
+        values = normalize_values(name, itemids[rows], raw[rows], conversion_table(feature_itemids))
+        rejected = int(((unit[rows] >= 0) & ~np.isnan(raw[rows]) & np.isnan(values)).sum())
+        keep = (unit[rows] >= 0) & ~np.isnan(values)
+        found[name] = (unit[rows][keep], values[keep], profile, rejected)
+    return found
+
+
+def scan_features(path, features, units, value_column='valuenum', lookback_hours=0, workers=2):
+    """One pass over a source table for several features, split across worker processes
+
+    features: {concept name: itemids}, each itemid in one feature only.
+    The file is cut into line-aligned byte ranges (byte_index.line_ranges)
+    parsed by a process pool; the cohort windows and the itemid lookup are
+    published once in shared memory, so a task only carries its byte range.
+    Returns {name: (sketch, profile, rejected)} with the values a serial
+    scan per feature gives; the profile's rows_scanned covers the whole file.
+    """
+    n_units = len(units['subject_id'])
+    sketches = {name: concept_sketch(name, n_units) for name in features}
+    profiles = {name: new_profile(itemids) for name, itemids in features.items()}
+    rejected = dict.fromkeys(features, 0)
+
+    def fold(found):
+        for name, (unit, values, profile, bad) in found.items():
+            update_sketch(sketches[name], unit, values)
+            profiles[name] = merge_profiles(profiles[name], profile)
+            rejected[name] += bad
+
+    header_end, starts, ends = line_ranges(path, task_bytes(workers))
+    print(f"    {len(starts)} byte ranges over {workers} workers...")
+    with published(unit_tables(units, list(features))) as manifest, worker_pool(manifest, workers) as pool:
+        # A few tasks per worker in flight, so finished results do not pile up
+        running = collections.deque()
+        for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+            running.append(pool.submit(scan_range, path, start, end, header_end, features, value_column,
+                                       lookback_hours))
+            if len(running) >= 2 * workers:
+                fold(running.popleft().result())
+            if i % 20 == 0 and i > 0:
+                print(f"    Processed {i + 1 - len(running)} of {len(starts)} ranges...")
+        while running:
+            fold(running.popleft().result())
+
+    return {name: (sketches[name], profiles[name], rejected[name]) for name in features}
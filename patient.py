@@ -1,6 +1,9 @@
 import pandas as pd
 import os
 
+from cohort import stay_mode
+from sampling import apply_sample, sample_fraction, selection_active, shard_spec
+
 data_path = "/home/nishat/physionet.org/files/mimiciv/3.1/"
 
 print("=== CORRECTED FILTERING ===")
@@ -23,6 +26,13 @@ adult_icus = [
 
 print(f"Looking for care units: {adult_icus}")
 
+# Development runs keep a stable hash-selected fraction of subjects; sharded
+# runs (shard.py) keep this shard's subjects
+if selection_active():
+    icustays = apply_sample(icustays)
+    k, n = shard_spec()
+    print(f"Sampled {sample_fraction():.2%} of subjects, shard {k}/{n}: {len(icustays)} stays")
+
 # Apply filters
 filtered_adult = icustays[icustays['first_careunit'].isin(adult_icus)]
 print(f"Adult ICUs: {len(filtered_adult)}")
@@ -30,9 +40,13 @@ print(f"Adult ICUs: {len(filtered_adult)}")
 filtered_los = filtered_adult[filtered_adult['los'] >= 1.25]  # 30 hours
 print(f"LOS >= 30h: {len(filtered_los)}")
 
-# First stay per patient
-first_stays = filtered_los.sort_values(['subject_id', 'intime']).groupby('subject_id').head(1)
-print(f"First stays per patient: {len(first_stays)}")
+# First stay per patient (every qualifying stay in stay mode, --stays)
+if stay_mode():
+    first_stays = filtered_los.sort_values(['subject_id', 'intime'])
+    print(f"Stay mode: keeping all {len(first_stays)} stays of {first_stays['subject_id'].nunique()} patients")
+else:
+    first_stays = filtered_los.sort_values(['subject_id', 'intime']).groupby('subject_id').head(1)
+    print(f"First stays per patient: {len(first_stays)}")
 
 # Save the results
 if len(first_stays) > 0:
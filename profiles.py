@@ -0,0 +1,119 @@
+# profiles.py
+import os
+
+import numpy as np
+import pandas as pd
+
+# Value histogram of the profile: log10 bins, PROFILE_BINS_PER_DECADE per decade
+# over [10**PROFILE_LOG_RANGE[0], 10**PROFILE_LOG_RANGE[1]] (outer bins catch the rest).
+# Raw values are binned before unit conversion, so one layout fits every itemid.
+PROFILE_LOG_RANGE = (-3, 5)
+PROFILE_BINS_PER_DECADE = 6
+PROFILE_BINS = (PROFILE_LOG_RANGE[1] - PROFILE_LOG_RANGE[0]) * PROFILE_BINS_PER_DECADE
+
+# Counters kept per itemid
+PROFILE_COUNTS = ['rows_scanned', 'cohort_rows', 'window_rows', 'null_values', 'non_positive_values']
+
+
+def new_profile(itemids):
+    """Empty data profile over a feature's itemids: fixed-size counters and histograms
+
+    rows_scanned: rows of the itemid the scan read. It depends on how the
+    scan was done: everything, only sampled subjects, or only cohort subjects
+    with a sidecar index (byte_index.py). Compare it only between runs of the
+    same kind. cohort_rows: rows of cohort subjects; window_rows: cohort rows
+    inside a unit's time window. These, the null / non-positive counts and
+    the histogram cover the cohort rows, so they are the same on every path.
+    """
+    itemids = np.unique(np.asarray(itemids, dtype=np.int64))
+    profile = {'itemid': itemids}
+    for name in PROFILE_COUNTS:
+        profile[name] = np.zeros(len(itemids), dtype=np.int64)
+    profile['hist'] = np.zeros((len(itemids), PROFILE_BINS), dtype=np.int64)
+    return profile
+
+
+def value_bins(values):
+    """Histogram bin of each positive value (-1 for null and non-positive values)"""
+    values = np.asarray(values, dtype=np.float64)
+    positive = values > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scaled = (np.log10(np.where(positive, values, 1.0)) - PROFILE_LOG_RANGE[0]) * PROFILE_BINS_PER_DECADE
+    bins = np.clip(np.floor(scaled), 0, PROFILE_BINS - 1).astype(np.int64)
+    return np.where(positive, bins, -1)
+
+
+def update_profile(profile, itemids, values, in_cohort, in_window, counts=None):
+    """Add a chunk of rows (or of distinct rows with their counts); vectorized
+
+    Rows of itemids outside the profile are ignored.
+    """
+    itemids = np.asarray(itemids, dtype=np.int64)
+    if len(itemids) == 0 or len(profile['itemid']) == 0:
+        return profile
+    counts = np.ones(len(itemids), dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+    in_cohort = np.asarray(in_cohort, dtype=bool)
+    in_window = np.asarray(in_window, dtype=bool) & in_cohort
+    values = np.asarray(values, dtype=np.float64)
+
+    n = len(profile['itemid'])
+    pos = np.minimum(np.searchsorted(profile['itemid'], itemids), n - 1)
+    known = profile['itemid'][pos] == itemids
+    pos, counts = pos[known], counts[known]
+    in_cohort, in_window, values = in_cohort[known], in_window[known], values[known]
+
+    def add(mask):
+        return np.bincount(pos[mask], weights=counts[mask], minlength=n).astype(np.int64)
+
+    profile['rows_scanned'] += add(np.ones(len(pos), dtype=bool))
+    profile['cohort_rows'] += add(in_cohort)
+    profile['window_rows'] += add(in_window)
+    profile['null_values'] += add(in_cohort & np.isnan(values))
+    profile['non_positive_values'] += add(in_cohort & (values <= 0))
+
+    bins = value_bins(values)
+    binned = in_cohort & (bins >= 0)
+    flat = profile['hist'].reshape(-1)
+    flat += np.bincount(pos[binned] * PROFILE_BINS + bins[binned], weights=counts[binned],
+                        minlength=flat.size).astype(np.int64)
+    return profile
+
+
+def merge_profiles(a, b):
+    """Combine two profiles over the same itemids (e.g. from parallel workers)"""
+    if not np.array_equal(a['itemid'], b['itemid']):
+        raise ValueError("Profiles cover different itemids")
+    merged = {'itemid': a['itemid'].copy()}
+    for name in PROFILE_COUNTS + ['hist']:
+        merged[name] = a[name] + b[name]
+    return merged
+
+
+def profile_frame(profiles):
+    """One row per (feature, itemid) with the counters and the median cohort value's bin edge"""
+    frames = []
+    for feature, profile in profiles.items():
+        frame = pd.DataFrame({'feature': feature, 'itemid': profile['itemid']})
+        for name in PROFILE_COUNTS:
+            frame[name] = profile[name]
+        # Lower edge of the bin holding the median positive value, to spot unit mix-ups
+        cum = np.cumsum(profile['hist'], axis=1)
+        total = cum[:, -1]
+        median_bin = (cum < (total[:, None] + 1) // 2).sum(axis=1)
+        edge = 10.0 ** (PROFILE_LOG_RANGE[0] + median_bin / PROFILE_BINS_PER_DECADE)
+        frame['median_value_bin'] = np.where(total > 0, edge, np.nan)
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['feature', 'itemid'])
+
+
+def save_profiles(profiles, output_file):
+    """Write <output>_profile.csv (counters) and <output>_profile.npz (histograms) next to output_file"""
+    stem = os.path.splitext(output_file)[0]
+    profile_frame(profiles).to_csv(f'{stem}_profile.csv', index=False)
+    arrays = {}
+    for feature, profile in profiles.items():
+        for name, values in profile.items():
+            arrays[f'{feature}/{name}'] = values
+    edges = 10.0 ** (PROFILE_LOG_RANGE[0] + np.arange(PROFILE_BINS + 1) / PROFILE_BINS_PER_DECADE)
+    np.savez_compressed(f'{stem}_profile.npz', bin_edges=edges, **arrays)
+    return f'{stem}_profile.csv', f'{stem}_profile.npz'
@@ -0,0 +1,163 @@
+# reference_cache.py
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Configuration
+data_path = "/home/nishat/physionet.org/files/mimiciv/3.1/"
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reference_cache')
+
+# Small reference tables parsed by several stages
+REFERENCE_TABLES = {
+    'patients': 'hosp/patients.csv',
+    'admissions': 'hosp/admissions.csv',
+    'd_items': 'icu/d_items.csv',
+    'd_labitems': 'hosp/d_labitems.csv',
+    'd_icd_diagnoses': 'hosp/d_icd_diagnoses.csv',
+}
+
+# Lookups precomputed from a source table when its cache is built
+DERIVED_TABLES = {'first_admissions': 'admissions'}
+
+# Tables with one row per subject, sorted by subject_id (see subject_lookup)
+SUBJECT_TABLES = ['patients', 'first_admissions']
+
+# Stored as datetime64 instead of text
+TIME_COLUMNS = ['admittime', 'dischtime', 'deathtime', 'edregtime', 'edouttime', 'dod']
+
+# Columns that must stay text (ICD codes like '0010' would parse as numbers)
+TEXT_COLUMNS = {'icd_code': str}
+
+
+def cache_file(name):
+    """Cache file of a reference or derived table"""
+    return os.path.join(CACHE_DIR, f'{name}.npz')
+
+
+def _encode(frame, source):
+    """Typed column arrays; text columns as int32 codes + NUL-joined categories (no pickle)"""
+    stat = os.stat(source)
+    arrays = {'source': np.array(os.path.abspath(source)), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+              'columns': np.frombuffer('\0'.join(frame.columns).encode('utf-8'), dtype=np.uint8)}
+    for column in frame.columns:
+        values = frame[column]
+        if values.dtype == object or pd.api.types.is_string_dtype(values.dtype):
+            codes, categories = pd.factorize(values)
+            arrays[f'codes/{column}'] = codes.astype(np.int32)
+            text = '\0'.join(str(c) for c in categories).encode('utf-8')
+            arrays[f'text/{column}'] = np.frombuffer(text, dtype=np.uint8)
+        else:
+            arrays[f'values/{column}'] = values.to_numpy()
+    return arrays
+
+
+def _save(frame, name, source):
+    """Write atomically, so stages building the same cache in parallel never read half a file"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    output = cache_file(name)
+    partial = f'{output}.{os.getpid()}.tmp.npz'
+    np.savez(partial, **_encode(frame, source))
+    os.replace(partial, output)
+
+
+def build_reference_cache(name, path=None):
+    """Parse one reference table (and the lookups derived from it) into the cache"""
+    path = path or os.path.join(data_path, REFERENCE_TABLES[name])
+    frame = pd.read_csv(path, dtype=TEXT_COLUMNS)
+    for column in TIME_COLUMNS:
+        if column in frame:
+            frame[column] = pd.to_datetime(frame[column])
+    if name in SUBJECT_TABLES:
+        frame = frame.sort_values('subject_id', kind='stable').reset_index(drop=True)
+    _save(frame, name, path)
+    print(f"  ✅ {name}: {len(frame)} rows -> {cache_file(name)}")
+
+    if name == 'admissions':
+        # Earliest admission per subject (first non-null value of every column)
+        first = frame.sort_values(['subject_id', 'admittime']).groupby('subject_id').first().reset_index()
+        _save(first, 'first_admissions', path)
+        print(f"  ✅ first_admissions: {len(first)} subjects -> {cache_file('first_admissions')}")
+
+
+def _current(name, source):
+    """True when the cache exists and was built from this version of the source file
+
+    Without the source (e.g. a copied cache on a machine without MIMIC), an
+    existing cache is used as is.
+    """
+    if not os.path.exists(cache_file(name)):
+        if not os.path.exists(source):
+            raise FileNotFoundError(f"{source} not found and no reference cache at {cache_file(name)}")
+        return False
+    if not os.path.exists(source):
+        return True
+    stat = os.stat(source)
+    with np.load(cache_file(name)) as f:
+        return (str(f['source']) == os.path.abspath(source) and int(f['size']) == stat.st_size
+                and int(f['mtime_ns']) == stat.st_mtime_ns)
+
+
+def reference_table(name, columns=None, path=None):
+    """A reference table (or derived lookup) as a DataFrame, from the cache
+
+    The cache is (re)built when missing or when the source CSV changed (path,
+    size or mtime), so every stage should pass the same path (default: under
+    data_path). Only the requested columns are read. Text columns come back
+    with the dtype pd.read_csv gives them; TIME_COLUMNS as datetime64.
+    """
+    table = DERIVED_TABLES.get(name, name)
+    path = path or os.path.join(data_path, REFERENCE_TABLES[table])
+    if not _current(name, path):
+        print(f"  🔄 Building reference cache for {table} ({path})")
+        build_reference_cache(table, path)
+
+    with np.load(cache_file(name)) as f:
+        stored = f['columns'].tobytes().decode('utf-8').split('\0')
+        columns = stored if columns is None else list(columns)
+        unknown = [c for c in columns if c not in stored]
+        if unknown:
+            raise KeyError(f"{name} has no columns {unknown}")
+        data = {}
+        for column in columns:
+            if f'codes/{column}' in f.files:
+                categories = f[f'text/{column}'].tobytes().decode('utf-8').split('\0')
+                # Trailing NaN slot for code -1
+                lookup = np.array(categories + [np.nan], dtype=object)
+                # infer_objects gives the text dtype of this pandas version's read_csv
+                data[column] = pd.Series(lookup[f[f'codes/{column}']]).infer_objects()
+            else:
+                data[column] = f[f'values/{column}']
+    return pd.DataFrame(data, columns=columns)
+
+
+def subject_lookup(name, subject_ids, columns, path=None):
+    """Rows of a SUBJECT_TABLES table for the given subjects (binary search), in their order
+
+    Subjects missing from the table are left out, like an inner merge.
+    """
+    if name not in SUBJECT_TABLES:
+        raise ValueError(f"{name} is not keyed by subject; use one of {SUBJECT_TABLES}")
+    columns = [c for c in columns if c != 'subject_id']
+    table = reference_table(name, ['subject_id'] + columns, path)
+    keys = table['subject_id'].to_numpy()
+    wanted = np.asarray(list(subject_ids), dtype=keys.dtype)
+    pos = np.minimum(np.searchsorted(keys, wanted), max(len(keys) - 1, 0))
+    found = keys[pos] == wanted if len(keys) else np.zeros(len(wanted), dtype=bool)
+    return table.iloc[pos[found]].reset_index(drop=True)
+
+
+def main():
+    """Build (or refresh) the cache for the given tables (default: all REFERENCE_TABLES)"""
+    print("=== BUILDING REFERENCE TABLE CACHE ===")
+    for name in sys.argv[1:] or list(REFERENCE_TABLES):
+        path = os.path.join(data_path, REFERENCE_TABLES[name])
+        if not os.path.exists(path):
+            print(f"  ⚠️  {path} not found, skipped")
+            continue
+        build_reference_cache(name, path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,424 @@
+# run_pipeline.py
+import argparse
+import ast
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+data_path = "/home/nishat/physionet.org/files/mimiciv/3.1/"
+TIMINGS_FILE = 'pipeline_timings.json'
+SETTINGS_FILE = 'pipeline_settings.json'
+LOG_DIR = 'pipeline_logs'
+
+# Dictionary tables behind concepts.py (itemid, lab and ICD concepts)
+DICTIONARIES = ['icu/d_items.csv', 'hosp/d_labitems.csv', 'hosp/d_icd_diagnoses.csv']
+
+# Each stage: script (relative to the repo), upstream stages, raw MIMIC tables it
+# reads (relative to data_path), outputs written into the working directory, and
+# the file names downstream scripts read them as.
+# cpus / memory_gb are the budget a stage reserves while it runs.
+STAGES = {
+    'patient': {
+        'script': 'patient.py', 'deps': [],
+        'sources': ['icu/icustays.csv'],
+        'outputs': ['filtered_patients_fixed.csv'],
+        'publish': {'filtered_patients_fixed.csv': ['patients.csv', 'filtered_patients.csv',
+                                                    'filtered_patients_corrected.csv', 'ICU/patients.csv']},
+        'cpus': 1, 'memory_gb': 4,
+    },
+    'icd_matrix': {
+        'script': 'icd_matrix.py', 'deps': ['patient'],
+        'sources': ['hosp/diagnoses_icd.csv'],
+        'outputs': ['icd_matrix.npz'],
+        'cpus': 1, 'memory_gb': 4,
+    },
+    'general': {
+        'script': 'general_features/general.py', 'deps': ['patient', 'icd_matrix'],
+        'sources': ['icu/chartevents.csv', 'hosp/patients.csv', 'hosp/admissions.csv'] + DICTIONARIES,
+        'outputs': ['general_features_complete.csv'],
+        'publish': {'general_features_complete.csv': ['general.csv']},
+        'cpus': 1, 'memory_gb': 6,
+    },
+    'vital': {
+        # needs weight_kg from general.csv for urine output
+        'script': 'vital_features/vital.py', 'deps': ['patient', 'general'],
+        'sources': ['icu/chartevents.csv', 'hosp/labevents.csv', 'icu/outputevents.csv'] + DICTIONARIES,
+        'outputs': ['FINAL_ESSENTIAL_FEATURES_EXPLICIT.csv'],
+        'publish': {'FINAL_ESSENTIAL_FEATURES_EXPLICIT.csv': ['vital.csv', 'vital_features.csv']},
+        # chart and lab scans run on a process pool (parallel_scan.py)
+        'cpus': 4, 'memory_gb': 8,
+    },
+    'sofa': {
+        'script': 'diagnosis_features/sofa.py', 'deps': ['patient', 'vital'],
+        'outputs': ['sofa_scores.csv'],
+        'publish': {'sofa_scores.csv': ['sofa.csv']},
+        'cpus': 1, 'memory_gb': 2,
+    },
+    'diagnosis': {
+        # SOFA_min / SOFA_max come from sofa.csv
+        'script': 'diagnosis_features/diagnosis.py', 'deps': ['patient', 'icd_matrix', 'sofa'],
+        'sources': ['hosp/patients.csv', 'hosp/admissions.csv'] + DICTIONARIES,
+        'outputs': ['diagnosis.csv'],
+        'cpus': 1, 'memory_gb': 6,
+    },
+    'therapy': {
+        'script': 'therapy_features/therapy.py', 'deps': ['patient'],
+        'sources': ['hosp/procedures_icd.csv', 'icu/inputevents.csv', 'icu/procedureevents.csv',
+                    'hosp/patients.csv'] + DICTIONARIES,
+        'outputs': ['therapy_simple.csv'],
+        'publish': {'therapy_simple.csv': ['therapy.csv']},
+        'cpus': 1, 'memory_gb': 4,
+    },
+    'icu_antibiotics': {
+        'script': 'antibiotics/icu_antibiotics.py', 'deps': [],
+        'sources': ['icu/inputevents.csv'] + DICTIONARIES,
+        'outputs': ['icu_antibiotics.csv'],
+        'cpus': 1, 'memory_gb': 2,
+    },
+    'hosp_antibiotics': {
+        'script': 'antibiotics/hosp_antibiotic.py', 'deps': [],
+        'sources': ['hosp/prescriptions.csv', 'hosp/pharmacy.csv', 'hosp/emar.csv',
+                    'hosp/microbiologyevents.csv'],
+        'outputs': ['merged_antibiotic_records.csv'],
+        'publish': {'merged_antibiotic_records.csv': ['hosp_antibiotic.csv']},
+        'cpus': 1, 'memory_gb': 4,
+    },
+    'antibiotic_timeline': {
+        'script': 'antibiotics/antibiotic_timeline.py', 'deps': ['patient'],
+        'sources': ['hosp/emar.csv', 'icu/inputevents.csv', 'hosp/microbiologyevents.csv'] + DICTIONARIES,
+        'outputs': ['antibiotic_timeline.csv', 'antibiotic_administrations.csv'],
+        'cpus': 1, 'memory_gb': 4,
+    },
+    'emar_doses': {
+        'script': 'antibiotics/emar_doses.py', 'deps': ['patient'],
+        'sources': ['hosp/emar.csv', 'hosp/emar_detail.csv'],
+        'outputs': ['emar_antibiotic_doses.csv'],
+        'cpus': 1, 'memory_gb': 2,
+    },
+    'merge_antibiotics': {
+        'script': 'antibiotics/merge_all_antibiotics.py',
+        'deps': ['patient', 'icu_antibiotics', 'hosp_antibiotics'],
+        'outputs': ['patients_with_antibiotics.csv'],
+        'cpus': 1, 'memory_gb': 2,
+    },
+    'final': {
+        'script': 'final.py', 'deps': ['general', 'vital', 'sofa', 'diagnosis', 'therapy'],
+        'outputs': ['merged_on_subject_id.csv'],
+        'publish': {'merged_on_subject_id.csv': ['ICU/final.csv']},
+        'cpus': 1, 'memory_gb': 2,
+    },
+    'final_antibiotics': {
+        'script': 'antibiotics/antibiotics_final.py', 'deps': ['final', 'merge_antibiotics'],
+        'outputs': ['FINAL_WITH_COMBINED_ANTIBIOTICS.csv'],
+        'cpus': 1, 'memory_gb': 2,
+    },
+}
+
+
+def topological_order(stages):
+    """Stage names ordered so every stage comes after its dependencies"""
+    order, state = [], {}
+
+    def visit(name):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise ValueError(f"Dependency cycle at stage '{name}'")
+        state[name] = 'visiting'
+        for dep in stages[name]['deps']:
+            visit(dep)
+        state[name] = 'done'
+        order.append(name)
+
+    for name in stages:
+        visit(name)
+    return order
+
+
+def stage_files(stage):
+    """All files a stage leaves in the working directory (outputs + published names)"""
+    files = list(stage['outputs'])
+    for aliases in stage.get('publish', {}).values():
+        files.extend(aliases)
+    return files
+
+
+# Script -> repo modules it imports (see script_modules)
+_module_cache = {}
+
+
+def script_modules(script):
+    """Repo modules a stage script imports, directly or through other repo modules
+
+    Imports resolve like in the running script: its own directory first, then
+    the repo root (the sys.path entry every stage script adds).
+    """
+    if script in _module_cache:
+        return _module_cache[script]
+    path = os.path.join(REPO_DIR, script)
+    search = [os.path.dirname(path), REPO_DIR]
+    found, frontier = set(), [path]
+    while frontier:
+        with open(frontier.pop()) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                names = [node.module]
+            else:
+                continue
+            for module in names:
+                for directory in search:
+                    candidate = os.path.join(directory, *module.split('.')) + '.py'
+                    if os.path.exists(candidate):
+                        if candidate not in found:
+                            found.add(candidate)
+                            frontier.append(candidate)
+                        break
+    _module_cache[script] = sorted(found)
+    return _module_cache[script]
+
+
+def source_path(source, workdir):
+    """A raw table as the stages open it: relative to the working directory if there, else under data_path"""
+    local = os.path.join(workdir, source)
+    return local if os.path.exists(local) else os.path.join(data_path, source)
+
+
+def is_current(name, stages, workdir):
+    """A stage is current if its outputs exist and are newer than all of its inputs
+
+    Inputs: its script, the repo modules the script imports, the raw MIMIC
+    tables it reads and its upstream outputs.
+    """
+    stage = stages[name]
+    paths = [os.path.join(workdir, f) for f in stage_files(stage)]
+    if not all(os.path.exists(p) for p in paths):
+        return False
+    oldest_output = min(os.path.getmtime(p) for p in paths)
+
+    inputs = [os.path.join(REPO_DIR, stage['script'])] + script_modules(stage['script'])
+    inputs.extend(source_path(s, workdir) for s in stage.get('sources', []))
+    for dep in stage['deps']:
+        inputs.extend(os.path.join(workdir, f) for f in stage_files(stages[dep]))
+    newest_input = max(os.path.getmtime(p) for p in inputs if os.path.exists(p))
+    return oldest_output >= newest_input
+
+
+def publish(stage, workdir):
+    """Copy outputs to the file names downstream scripts read"""
+    for source, aliases in stage.get('publish', {}).items():
+        for alias in aliases:
+            target = os.path.join(workdir, alias)
+            os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+            shutil.copyfile(os.path.join(workdir, source), target)
+
+
+def critical_path(stages, durations):
+    """Longest chain of dependent stages by duration: (total seconds, [stage names])"""
+    finish, previous = {}, {}
+    for name in topological_order(stages):
+        deps = stages[name]['deps']
+        slowest = max(deps, key=lambda d: finish[d]) if deps else None
+        finish[name] = durations.get(name, 0.0) + (finish[slowest] if slowest else 0.0)
+        previous[name] = slowest
+
+    end = max(finish, key=finish.get)
+    path = [end]
+    while previous[path[-1]]:
+        path.append(previous[path[-1]])
+    return finish[end], path[::-1]
+
+
+def remaining_path(stages, durations):
+    """Longest duration from each stage to the end of the DAG (used as scheduling priority)"""
+    dependents = {name: [] for name in stages}
+    for name, stage in stages.items():
+        for dep in stage['deps']:
+            dependents[dep].append(name)
+    remaining = {}
+    for name in reversed(topological_order(stages)):
+        tail = max((remaining[d] for d in dependents[name]), default=0.0)
+        remaining[name] = durations.get(name, 60.0) + tail
+    return remaining
+
+
+def total_memory_gb():
+    """Physical memory of this machine in GB"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+    except (ValueError, OSError, AttributeError):
+        return 16.0
+
+
+def load_timings(workdir):
+    """Stage durations recorded by previous runs"""
+    path = os.path.join(workdir, TIMINGS_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def settings_changed(workdir, settings):
+    """True if the outputs in workdir were built with different --sample / --stays / --shard settings"""
+    path = os.path.join(workdir, SETTINGS_FILE)
+    previous = {'sample': 1.0, 'stays': False, 'shard': '0/1'}
+    if os.path.exists(path):
+        with open(path) as f:
+            previous.update(json.load(f))
+    return previous != settings
+
+
+def run_pipeline(workdir, cpus, memory_gb, force=False, targets=None, dry_run=False, stages=STAGES,
+                 sample=1.0, stays=False, backend='pandas', shard='0/1'):
+    """Run stages as parallel worker processes, respecting dependencies and the resource budget"""
+    previous_timings = load_timings(workdir)
+    settings = {'sample': sample, 'stays': stays, 'shard': shard}
+    if settings_changed(workdir, settings):
+        print(f"Run settings changed to {settings}: rebuilding all stages")
+        force = True
+    # The backend changes how stages scan, not what they produce, so it is not a setting
+    env = dict(os.environ, ICU_SAMPLE=str(sample), ICU_STAY_MODE='1' if stays else '0', ICU_BACKEND=backend,
+               ICU_SHARD=shard)
+    priority = remaining_path(stages, previous_timings)
+
+    wanted = set(targets or stages)
+    # Pull in upstream stages of the requested targets
+    frontier = list(wanted)
+    while frontier:
+        for dep in stages[frontier.pop()]['deps']:
+            if dep not in wanted:
+                wanted.add(dep)
+                frontier.append(dep)
+
+    pending = [name for name in topological_order(stages) if name in wanted]
+    done, failed, skipped, durations = set(), set(), set(), {}
+    running = {}
+    os.makedirs(os.path.join(workdir, LOG_DIR), exist_ok=True)
+
+    print(f"=== RUNNING PIPELINE ({len(pending)} stages, {cpus} CPUs, {memory_gb:.1f} GB) ===")
+    start = time.time()
+
+    while pending or running:
+        # Skip stages whose outputs are already current
+        for name in list(pending):
+            deps_done = all(d in done for d in stages[name]['deps'])
+            if deps_done and not force and not any(d in durations for d in stages[name]['deps']) \
+                    and is_current(name, stages, workdir):
+                pending.remove(name)
+                done.add(name)
+                skipped.add(name)
+                print(f"  ⏭️  {name}: up to date")
+
+        used_cpus = sum(stages[n]['cpus'] for n in running)
+        used_mem = sum(stages[n]['memory_gb'] for n in running)
+        ready = [n for n in pending if all(d in done for d in stages[n]['deps'])]
+        ready.sort(key=lambda n: -priority[n])
+
+        for name in ready:
+            stage = stages[name]
+            fits = (used_cpus + stage['cpus'] <= cpus and used_mem + stage['memory_gb'] <= memory_gb)
+            if not fits and running:
+                continue
+            pending.remove(name)
+            used_cpus += stage['cpus']
+            used_mem += stage['memory_gb']
+            if dry_run:
+                print(f"  ▶️  {name}: would run {stage['script']}")
+                durations[name] = 0.0
+                done.add(name)
+                continue
+            log = open(os.path.join(workdir, LOG_DIR, f'{name}.log'), 'w')
+            # Half of the stage's reservation goes to parsed CSV chunks (chunk_reader.py);
+            # stages with a process pool (shared_cohort.py) get one worker per reserved CPU
+            stage_env = dict(env, ICU_MEMORY_BUDGET_MB=str(int(stage['memory_gb'] * 1024 / 2)),
+                             ICU_WORKERS=str(min(stage['cpus'], cpus)))
+            proc = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, stage['script'])],
+                                    cwd=workdir, env=stage_env, stdout=log, stderr=subprocess.STDOUT)
+            running[name] = (proc, log, time.time())
+            print(f"  ▶️  {name}: started")
+
+        if dry_run:
+            if not ready and pending:
+                break
+            continue
+
+        # Blocked stages (a dependency failed) can never run
+        blocked = [n for n in pending if any(d in failed for d in stages[n]['deps'])]
+        for name in blocked:
+            pending.remove(name)
+            failed.add(name)
+            print(f"  ⛔ {name}: skipped, upstream stage failed")
+
+        time.sleep(0.5)
+        for name, (proc, log, started) in list(running.items()):
+            if proc.poll() is None:
+                continue
+            log.close()
+            del running[name]
+            durations[name] = time.time() - started
+            if proc.returncode == 0:
+                publish(stages[name], workdir)
+                done.add(name)
+                print(f"  ✅ {name}: {durations[name]:.1f}s")
+            else:
+                failed.add(name)
+                print(f"  ❌ {name}: exit code {proc.returncode} (see {LOG_DIR}/{name}.log)")
+
+    wall = time.time() - start
+    if not dry_run:
+        previous_timings.update(durations)
+        with open(os.path.join(workdir, TIMINGS_FILE), 'w') as f:
+            json.dump(previous_timings, f, indent=2)
+        with open(os.path.join(workdir, SETTINGS_FILE), 'w') as f:
+            json.dump(settings, f)
+
+    estimates = dict(previous_timings)
+    estimates.update(durations)
+    path_seconds, path = critical_path({n: s for n, s in stages.items()}, estimates)
+    print(f"\nWall time: {wall:.1f}s (sum of stages: {sum(durations.values()):.1f}s)")
+    print(f"Critical path ({path_seconds:.1f}s): {' -> '.join(path)}")
+    if skipped:
+        print(f"Up to date: {', '.join(sorted(skipped))}")
+    if failed:
+        print(f"❌ Failed: {', '.join(sorted(failed))}")
+    return not failed
+
+
+def main():
+    """Command-line entry point"""
+    parser = argparse.ArgumentParser(description="Run the ICU feature pipeline as a DAG")
+    parser.add_argument('targets', nargs='*', help="stages to build (default: all)")
+    parser.add_argument('--workdir', default='.', help="directory the stages read and write")
+    parser.add_argument('--cpus', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--memory-gb', type=float, default=total_memory_gb() * 0.8)
+    parser.add_argument('--force', action='store_true', help="rerun stages even if outputs are current")
+    parser.add_argument('--dry-run', action='store_true', help="print the schedule without running")
+    parser.add_argument('--sample', type=float, default=1.0,
+                        help="fraction of subjects (stable subject_id hash) for fast development runs")
+    parser.add_argument('--stays', action='store_true',
+                        help="stay-level mode: every qualifying ICU stay, features keyed on stay_id")
+    parser.add_argument('--backend', choices=['pandas', 'duckdb'], default='pandas',
+                        help="scan engine of the extractors (duckdb needs the duckdb package)")
+    parser.add_argument('--shard', default='0/1',
+                        help="k/N: process only shard k of N (subject hash); see shard.py to run and merge shards")
+    args = parser.parse_args()
+
+    unknown = [t for t in args.targets if t not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)} (choose from {', '.join(STAGES)})")
+
+    ok = run_pipeline(os.path.abspath(args.workdir), args.cpus, args.memory_gb,
+                      force=args.force, targets=args.targets, dry_run=args.dry_run, sample=args.sample,
+                      stays=args.stays, backend=args.backend, shard=args.shard)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
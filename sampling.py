@@ -0,0 +1,190 @@
+# sampling.py
+import io
+import os
+import sys
+
+import numpy as np
+
+# Fraction of subjects kept in development runs (1.0 = full cohort).
+# Set with --sample 0.01 on any stage or the ICU_SAMPLE environment variable;
+# run_pipeline.py forwards it to every stage through the environment.
+SAMPLE_ENV = 'ICU_SAMPLE'
+
+# Shard k of N (subject hash modulo N) in sharded runs (shard.py). Set with
+# --shard k/N on any stage or ICU_SHARD; run_pipeline.py forwards it.
+SHARD_ENV = 'ICU_SHARD'
+
+# Bytes read from the source file per filtering step
+FILTER_BLOCK_BYTES = 64 * 1024 ** 2
+
+
+def sample_fraction():
+    """Sampling fraction from --sample (argv) or ICU_SAMPLE, default 1.0"""
+    if '--sample' in sys.argv:
+        pos = sys.argv.index('--sample')
+        if pos + 1 < len(sys.argv):
+            os.environ[SAMPLE_ENV] = sys.argv[pos + 1]
+    fraction = float(os.environ.get(SAMPLE_ENV, 1.0))
+    if not 0 < fraction <= 1:
+        raise ValueError(f"sample fraction must be in (0, 1], got {fraction}")
+    return fraction
+
+
+def shard_spec():
+    """(k, n) from --shard k/N (argv) or ICU_SHARD, default (0, 1) = unsharded"""
+    if '--shard' in sys.argv:
+        pos = sys.argv.index('--shard')
+        if pos + 1 < len(sys.argv):
+            os.environ[SHARD_ENV] = sys.argv[pos + 1]
+    k, n = (int(part) for part in os.environ.get(SHARD_ENV, '0/1').split('/'))
+    if not 0 <= k < n:
+        raise ValueError(f"shard must be k/N with 0 <= k < N, got {k}/{n}")
+    return k, n
+
+
+def selection_active(fraction=None):
+    """True when only part of the subjects is processed (sampled or sharded run)"""
+    fraction = sample_fraction() if fraction is None else fraction
+    return fraction < 1 or shard_spec()[1] > 1
+
+
+def subject_hash(subject_ids):
+    """Stable 64-bit hash of subject_ids (splitmix64 finalizer), same on every machine"""
+    x = np.asarray(subject_ids, dtype=np.int64).astype(np.uint64)
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def in_sample(subject_ids, fraction=None):
+    """Boolean mask of subjects selected by the stable hash (sample fraction and shard)"""
+    fraction = sample_fraction() if fraction is None else fraction
+    k, n = shard_spec()
+    subject_ids = np.asarray(subject_ids)
+    if fraction >= 1 and n == 1:
+        return np.ones(len(subject_ids), dtype=bool)
+    hashes = subject_hash(subject_ids)
+    # The fraction uses the high bits and the shard the value modulo N, so a
+    # sampled run split into shards keeps exactly the sampled subjects
+    unit = (hashes >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+    return (unit < fraction) & (hashes % np.uint64(n) == np.uint64(k))
+
+
+def apply_sample(frame, column='subject_id', fraction=None):
+    """Keep only the sampled (and, in sharded runs, this shard's) subjects of a frame"""
+    fraction = sample_fraction() if fraction is None else fraction
+    if not selection_active(fraction):
+        return frame
+    return frame[in_sample(frame[column].to_numpy(), fraction)]
+
+
+def _parse_ints(buf, starts, ends):
+    """Vectorized ASCII integer parse of buf[starts:ends] (-1 where not a number)"""
+    widths = ends - starts
+    max_width = int(widths.max()) if len(widths) else 0
+    if max_width == 0:
+        return np.full(len(starts), -1, dtype=np.int64)
+    cols = np.arange(max_width)
+    index = np.minimum(starts[:, None] + cols[None, :], len(buf) - 1)
+    digits = buf[index].astype(np.int64) - ord('0')
+    valid_col = cols[None, :] < widths[:, None]
+    ok = np.all(~valid_col | ((digits >= 0) & (digits <= 9)), axis=1) & (widths > 0)
+    powers = 10 ** np.clip(widths[:, None] - 1 - cols[None, :], 0, 18)
+    values = np.where(valid_col, digits * powers, 0).sum(axis=1)
+    return np.where(ok, values, -1)
+
+
+def line_subjects(buf, column):
+    """Line starts, ends and integer field `column` of a block of whole CSV lines (uint8 array)
+
+    -1 where the field is not a plain integer. Fields before the column
+    must not contain quoted commas.
+    """
+    newlines = np.flatnonzero(buf == ord('\n'))
+    starts = np.r_[0, newlines[:-1] + 1]
+    ends = newlines + 1
+    commas = np.flatnonzero(buf == ord(','))
+
+    field_start = starts.copy()
+    if column > 0:
+        k = np.searchsorted(commas, starts) + column - 1
+        field_start = commas[np.minimum(k, len(commas) - 1)] + 1
+    k = np.searchsorted(commas, field_start)
+    field_end = np.where(k < len(commas), commas[np.minimum(k, len(commas) - 1)], ends - 1)
+    field_end = np.minimum(field_end, ends - 1)
+    return starts, ends, _parse_ints(buf, field_start, field_end)
+
+
+class SampledCSV(io.RawIOBase):
+    """Read-only file that only yields the header and lines of sampled subjects
+
+    Lines are dropped as raw bytes (the subject field is located and parsed
+    with NumPy over whole blocks), so pandas never parses rejected rows.
+    The fields before the subject column must not contain quoted commas.
+    """
+
+    def __init__(self, path, subject_column, fraction):
+        super().__init__()
+        self._file = open(path, 'rb')
+        self._column = subject_column
+        self._fraction = fraction
+        self._pending = self._file.readline()  # header passes through
+        self._pos = 0
+        self._carry = b''
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def _filter_block(self, block):
+        buf = np.frombuffer(block, dtype=np.uint8)
+        starts, ends, subjects = line_subjects(buf, self._column)
+        # Unparseable lines are kept so pandas (not this filter) decides what they are
+        keep = (subjects < 0) | in_sample(np.maximum(subjects, 0), self._fraction)
+        mask = np.repeat(keep, ends - starts)
+        return buf[:len(mask)][mask].tobytes()
+
+    def _fill(self):
+        while self._pos >= len(self._pending) and not self._eof:
+            block = self._carry + self._file.read(FILTER_BLOCK_BYTES)
+            if len(block) == len(self._carry):
+                self._eof = True
+                block = block if block.endswith(b'\n') or not block else block + b'\n'
+                self._carry = b''
+            else:
+                cut = block.rfind(b'\n') + 1
+                block, self._carry = block[:cut], block[cut:]
+            if block:
+                self._pending, self._pos = self._filter_block(block), 0
+
+    def readinto(self, out):
+        self._fill()
+        n = min(len(out), len(self._pending) - self._pos)
+        out[:n] = self._pending[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def subject_column(path):
+    """Position of subject_id in a CSV header line (-1 if the file has none)"""
+    with open(path, 'rb') as f:
+        header = f.readline().decode('utf-8').strip().split(',')
+    header = [h.strip('"') for h in header]
+    return header.index('subject_id') if 'subject_id' in header else -1
+
+
+def sampled_source(path, fraction=None):
+    """Path or SampledCSV stream for pd.read_csv, depending on the sampling fraction and shard"""
+    fraction = sample_fraction() if fraction is None else fraction
+    if not selection_active(fraction) or not os.path.exists(path):
+        return path
+    column = subject_column(path)
+    if column < 0:
+        return path
+    return io.BufferedReader(SampledCSV(path, column, fraction), buffer_size=1024 ** 2)
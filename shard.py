@@ -0,0 +1,153 @@
+# shard.py
+import argparse
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+
+from run_pipeline import REPO_DIR, STAGES, publish, total_memory_gb
+
+# Stages whose tables final.py merges; each shard builds them (and their upstream
+# stages) for its own subjects, and merge_shards stitches them back together
+SHARD_TARGETS = ['general', 'vital', 'sofa', 'diagnosis', 'therapy']
+MERGED_STAGES = ['patient'] + SHARD_TARGETS
+
+
+def shard_dir(workdir, k):
+    """Working directory of shard k"""
+    return os.path.join(workdir, f'shard_{k}')
+
+
+def read_table(path):
+    """Shard table with floats parsed exactly, so merged values are written back unchanged"""
+    return pd.read_csv(path, float_precision='round_trip')
+
+
+def cohort_positions(cohort):
+    """Row position of every subject (first stay) and stay in the merged cohort"""
+    subjects = cohort.drop_duplicates('subject_id')
+    by_subject = pd.Series(subjects.index.to_numpy(), index=subjects['subject_id'].to_numpy())
+    by_stay = pd.Series(np.arange(len(cohort)), index=cohort['stay_id'].to_numpy()) if 'stay_id' in cohort else None
+    return by_subject, by_stay
+
+
+def merge_tables(tables, positions):
+    """Concatenate shard tables in the row order of an unsharded run
+
+    Rows follow the merged cohort (patient.py sorts it by subject_id and
+    intime): by stay where the table has stay_id, by subject otherwise.
+    Columns follow their first appearance across shards.
+    """
+    merged = pd.concat(tables, ignore_index=True, sort=False)
+    by_subject, by_stay = positions
+    if by_stay is not None and 'stay_id' in merged:
+        order = merged['stay_id'].map(by_stay)
+    else:
+        order = merged['subject_id'].map(by_subject)
+    # Rows outside the cohort (should not happen) keep their place at the end
+    order = order.fillna(len(by_subject) + len(merged)).to_numpy()
+    keys = [k for k in ('subject_id', 'stay_id') if k in merged]
+    merged = merged.iloc[np.lexsort([merged[k].to_numpy() for k in reversed(keys)] + [order])]
+    return merged.reset_index(drop=True)
+
+
+def merge_shards(shard_dirs, workdir):
+    """Combine the shard outputs of MERGED_STAGES into workdir, as an unsharded run writes them"""
+    print(f"=== MERGING {len(shard_dirs)} SHARDS -> {workdir} ===")
+    os.makedirs(workdir, exist_ok=True)
+    missing = [os.path.join(d, f) for d in shard_dirs for name in MERGED_STAGES
+               for f in STAGES[name]['outputs'] if not os.path.exists(os.path.join(d, f))]
+    if missing:
+        raise FileNotFoundError(f"Shard outputs missing: {', '.join(missing)}")
+
+    # The cohort first: it defines the row order of every other table
+    patient_file = STAGES['patient']['outputs'][0]
+    cohort = pd.concat([read_table(os.path.join(d, patient_file)) for d in shard_dirs], ignore_index=True)
+    cohort = cohort.sort_values(['subject_id', 'intime'], kind='stable').reset_index(drop=True)
+    positions = cohort_positions(cohort)
+
+    for name in MERGED_STAGES:
+        for output in STAGES[name]['outputs']:
+            if name == 'patient':
+                merged = cohort
+            else:
+                merged = merge_tables([read_table(os.path.join(d, output)) for d in shard_dirs], positions)
+            merged.to_csv(os.path.join(workdir, output), index=False)
+            print(f"  ✅ {output}: {len(merged)} rows")
+        publish(STAGES[name], workdir)
+    print("✅ Merged tables are ready for final.py")
+
+
+def run_shards(workdir, n_shards, cpus, memory_gb, pipeline_args=()):
+    """Run the pipeline for every shard as a separate local process (one per 'node')"""
+    print(f"=== RUNNING {n_shards} SHARDS ({cpus} CPUs, {memory_gb:.1f} GB in total) ===")
+    procs = []
+    for k in range(n_shards):
+        directory = shard_dir(workdir, k)
+        os.makedirs(directory, exist_ok=True)
+        cmd = [sys.executable, os.path.join(REPO_DIR, 'run_pipeline.py'), *SHARD_TARGETS,
+               '--workdir', directory, '--shard', f'{k}/{n_shards}',
+               '--cpus', str(max(cpus // n_shards, 1)), '--memory-gb', str(memory_gb / n_shards),
+               *pipeline_args]
+        log = open(os.path.join(workdir, f'shard_{k}.log'), 'w')
+        procs.append((k, subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT), log))
+        print(f"  ▶️  shard {k}/{n_shards}: {directory}")
+
+    failed = []
+    for k, proc, log in procs:
+        proc.wait()
+        log.close()
+        if proc.returncode == 0:
+            print(f"  ✅ shard {k}/{n_shards}")
+        else:
+            failed.append(k)
+            print(f"  ❌ shard {k}/{n_shards}: exit code {proc.returncode} (see shard_{k}.log)")
+    return not failed
+
+
+def run_final(workdir):
+    """Run final.py on the merged tables"""
+    return subprocess.call([sys.executable, os.path.join(REPO_DIR, 'final.py')], cwd=workdir) == 0
+
+
+def main():
+    """Command-line entry point: run N shards locally and merge, or merge shard directories"""
+    parser = argparse.ArgumentParser(description="Subject-sharded runs of the ICU feature pipeline")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="run N shards as local processes, then merge")
+    run.add_argument('--shards', type=int, required=True)
+    run.add_argument('--workdir', default='.')
+    run.add_argument('--cpus', type=int, default=os.cpu_count() or 1)
+    run.add_argument('--memory-gb', type=float, default=total_memory_gb() * 0.8)
+    run.add_argument('--final', action='store_true', help="run final.py on the merged tables")
+
+    merge = commands.add_parser('merge', help="merge shard working directories (e.g. copied from other machines)")
+    merge.add_argument('shard_dirs', nargs='+')
+    merge.add_argument('--workdir', default='.')
+    merge.add_argument('--final', action='store_true', help="run final.py on the merged tables")
+
+    # Remaining arguments (--sample, --stays, --backend, --force) go to every shard's run_pipeline.py
+    args, pipeline_args = parser.parse_known_args()
+    workdir = os.path.abspath(args.workdir)
+
+    if args.command == 'run':
+        if args.shards < 1:
+            parser.error("--shards must be at least 1")
+        if not run_shards(workdir, args.shards, args.cpus, args.memory_gb, pipeline_args):
+            sys.exit(1)
+        shard_dirs = [shard_dir(workdir, k) for k in range(args.shards)]
+    else:
+        if pipeline_args:
+            parser.error(f"unrecognized arguments: {' '.join(pipeline_args)}")
+        shard_dirs = [os.path.abspath(d) for d in args.shard_dirs]
+
+    merge_shards(shard_dirs, workdir)
+    if args.final and not run_final(workdir):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# shared_cohort.py
+import contextlib
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from concepts import itemid_lookup
+
+# Worker processes of the parallel scans (1 = scan in the stage process).
+# Set with --workers N on any stage or ICU_WORKERS; run_pipeline.py forwards
+# each stage's cpus.
+WORKERS_ENV = 'ICU_WORKERS'
+
+# Arrays attached in this (worker) process: name -> zero-copy NumPy view
+_attached = {}
+# SharedMemory handles must outlive the views that point into them
+_handles = []
+
+
+def scan_workers():
+    """Worker processes from --workers (argv) or ICU_WORKERS, default 1"""
+    if '--workers' in sys.argv:
+        pos = sys.argv.index('--workers')
+        if pos + 1 < len(sys.argv):
+            os.environ[WORKERS_ENV] = sys.argv[pos + 1]
+    workers = int(os.environ.get(WORKERS_ENV, 1))
+    if workers < 1:
+        raise ValueError(f"workers must be at least 1, got {workers}")
+    return workers
+
+
+def publish_arrays(arrays):
+    """Copy arrays into shared memory once; returns (handles, manifest)
+
+    The manifest only holds segment names, dtypes and shapes, so passing it
+    to a worker costs a few hundred bytes regardless of cohort size.
+    """
+    handles, manifest = [], {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        view[...] = array
+        handles.append(shm)
+        manifest[name] = (shm.name, array.dtype.str, array.shape)
+    return handles, manifest
+
+
+def release(handles):
+    """Close and unlink segments created by publish_arrays"""
+    for shm in handles:
+        shm.close()
+        with contextlib.suppress(FileNotFoundError):
+            shm.unlink()
+
+
+def _attach_segment(shm_name):
+    """Attach to an existing segment without taking ownership of it"""
+    try:
+        return shared_memory.SharedMemory(name=shm_name, track=False)
+    except TypeError:
+        # Python < 3.13: pool workers share the parent's resource tracker, so the
+        # extra registration is a no-op and the parent's unlink stays authoritative
+        return shared_memory.SharedMemory(name=shm_name)
+
+
+def attach_arrays(manifest):
+    """Zero-copy read-only NumPy views onto published arrays"""
+    views = {}
+    for name, (shm_name, dtype, shape) in manifest.items():
+        shm = _attach_segment(shm_name)
+        _handles.append(shm)
+        view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        view.flags.writeable = False
+        views[name] = view
+    return views
+
+
+def init_worker(manifest):
+    """ProcessPoolExecutor initializer: attach the shared tables once per worker"""
+    _attached.update(attach_arrays(manifest))
+
+
+def worker_tables():
+    """Tables attached by init_worker (name -> array)"""
+    return _attached
+
+
+def unit_tables(units, feature_names=None):
+    """Cohort unit windows (cohort.cohort_units) + optional itemid -> feature lookup, ready to publish
+
+    The windows keep the stay_table keys, so workers pass the attached
+    tables straight to cohort.attribute_stays.
+    """
+    tables = {name: units[name] for name in ('subject_id', 'intime', 'end_time')}
+    if feature_names:
+        tables['feature_lookup'] = itemid_lookup(feature_names)
+    return tables
+
+
+@contextlib.contextmanager
+def published(tables):
+    """Publish tables for the duration of a with-block, then free the segments"""
+    handles, manifest = publish_arrays(tables)
+    try:
+        yield manifest
+    finally:
+        release(handles)
+
+
+def worker_pool(manifest, workers=None):
+    """Process pool whose workers attach to the shared tables at startup
+
+    Workers are forked where the platform allows it: stage scripts do their
+    work at module level, which spawned workers would run again on import.
+    """
+    method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method),
+                               initializer=init_worker, initargs=(manifest,))
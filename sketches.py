@@ -0,0 +1,117 @@
+# sketches.py
+import numpy as np
+
+from units import PLAUSIBLE_RANGES
+
+# Histogram bins per subject of the quantile sketch
+SKETCH_BINS = 256
+
+# Summary columns produced per feature (<feature>_<stat>)
+SKETCH_STATS = ['mean', 'std', 'median', 'p5', 'p95', 'count']
+
+
+def new_sketch(n_subjects, low, high, bins=SKETCH_BINS):
+    """Empty per-subject sketch: Welford moments, exact min/max and a fixed-bin histogram
+
+    Memory is fixed per subject (bins counters + 5 scalars) however many
+    events are scanned. The histogram spans [low, high], so values must be
+    pre-filtered to that range (units.normalize_values does this).
+    """
+    return {
+        'count': np.zeros(n_subjects, dtype=np.int64),
+        'mean': np.zeros(n_subjects),
+        'm2': np.zeros(n_subjects),
+        'min': np.full(n_subjects, np.inf),
+        'max': np.full(n_subjects, -np.inf),
+        'hist': np.zeros((n_subjects, bins), dtype=np.uint32),
+        'range': np.array([low, high], dtype=np.float64),
+    }
+
+
+def concept_sketch(concept, n_subjects, bins=SKETCH_BINS):
+    """Sketch spanning the concept's plausible range"""
+    if concept not in PLAUSIBLE_RANGES:
+        raise ValueError(f"No plausible range defined for {concept} (units.PLAUSIBLE_RANGES)")
+    low, high = PLAUSIBLE_RANGES[concept]
+    return new_sketch(n_subjects, low, high, bins)
+
+
+def _merge_moments(sketch, count, mean, m2):
+    """Chan et al. pairwise update of (count, mean, m2) into sketch, in place"""
+    total = sketch['count'] + count
+    safe = np.maximum(total, 1)
+    delta = mean - sketch['mean']
+    sketch['mean'] = sketch['mean'] + delta * count / safe
+    sketch['m2'] = sketch['m2'] + m2 + delta ** 2 * sketch['count'] * count / safe
+    sketch['count'] = total
+
+
+def update_sketch(sketch, subject_idx, values):
+    """Add a chunk of (dense subject index, value) pairs; fully vectorized"""
+    subject_idx = np.asarray(subject_idx, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return sketch
+    n = len(sketch['count'])
+
+    count = np.bincount(subject_idx, minlength=n)
+    mean = np.bincount(subject_idx, weights=values, minlength=n) / np.maximum(count, 1)
+    m2 = np.bincount(subject_idx, weights=(values - mean[subject_idx]) ** 2, minlength=n)
+    _merge_moments(sketch, count, mean, m2)
+
+    np.minimum.at(sketch['min'], subject_idx, values)
+    np.maximum.at(sketch['max'], subject_idx, values)
+
+    low, high = sketch['range']
+    bins = sketch['hist'].shape[1]
+    b = np.clip(((values - low) / (high - low) * bins).astype(np.int64), 0, bins - 1)
+    keys, per_key = np.unique(subject_idx * bins + b, return_counts=True)
+    flat = sketch['hist'].reshape(-1)
+    flat[keys] += per_key.astype(np.uint32)
+    return sketch
+
+
+def merge_sketches(a, b):
+    """Combine two sketches over the same subjects (e.g. from parallel workers)"""
+    if not np.array_equal(a['range'], b['range']) or a['hist'].shape != b['hist'].shape:
+        raise ValueError("Sketches have different ranges or shapes")
+    merged = {key: value.copy() for key, value in a.items()}
+    _merge_moments(merged, b['count'], b['mean'], b['m2'])
+    merged['min'] = np.minimum(a['min'], b['min'])
+    merged['max'] = np.maximum(a['max'], b['max'])
+    merged['hist'] = a['hist'] + b['hist']
+    return merged
+
+
+def sketch_quantiles(sketch, q):
+    """Approximate quantile q per subject (linear within a bin, clipped to exact min/max)"""
+    count = sketch['count']
+    hist = sketch['hist']
+    low, high = sketch['range']
+    width = (high - low) / hist.shape[1]
+
+    cum = np.cumsum(hist, axis=1, dtype=np.int64)
+    target = q * count
+    b = np.minimum((cum < target[:, None]).sum(axis=1), hist.shape[1] - 1)
+    rows = np.arange(len(count))
+    in_bin = hist[rows, b].astype(np.float64)
+    before = cum[rows, b] - in_bin
+    frac = np.clip((target - before) / np.maximum(in_bin, 1), 0, 1)
+    values = np.clip(low + (b + frac) * width, sketch['min'], sketch['max'])
+    return np.where(count > 0, values, np.nan)
+
+
+def summarize_sketch(sketch):
+    """Per-subject summary arrays: min, max and SKETCH_STATS"""
+    count = sketch['count']
+    has = count > 0
+    return {
+        'min': np.where(has, sketch['min'], np.nan),
+        'max': np.where(has, sketch['max'], np.nan),
+        'mean': np.where(has, sketch['mean'], np.nan),
+        'std': np.where(count > 1, np.sqrt(sketch['m2'] / np.maximum(count - 1, 1)), np.nan),
+        'median': sketch_quantiles(sketch, 0.5),
+        'p5': sketch_quantiles(sketch, 0.05),
+        'p95': sketch_quantiles(sketch, 0.95),
+        'count': count,
+    }
@@ -0,0 +1,389 @@
+# streaming.py
+import argparse
+import csv
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(REPO_DIR, 'diagnosis_features'))
+sys.path.append(os.path.join(REPO_DIR, 'therapy_features'))
+from cohort import WINDOW_HOURS
+from concepts import concept_itemids
+from sampling import apply_sample
+from sofa import sofa_cardiovascular, sofa_cns, sofa_coagulation, sofa_liver, sofa_renal, sofa_respiration
+from units import FRACTION_OR_PERCENT, PLAUSIBLE_RANGES, UNIT_CONVERSIONS
+from vasopressors import AMOUNT_UNITS, DRUGS, NE_EQUIVALENT, RATE_UNITS, VASOPRESSOR_CONFIG
+
+# Concepts tracked per stay: every vital.py concept with a plausible range, except
+# urine output (vital.py reports it as ml/kg/h over hourly buckets, not per charting)
+STREAM_CONCEPTS = [c for c in PLAUSIBLE_RANGES if c != 'Urine_Output']
+
+# SOFA sub-scores (sofa.py rules) from the worst value so far: (concept, worst, rule)
+SOFA_RULES = {
+    'sofa_coagulation': ('Platelets', 'min', sofa_coagulation),
+    'sofa_liver': ('Bilirubin', 'max', sofa_liver),
+    'sofa_renal': ('Creatinine', 'max', sofa_renal),
+    'sofa_cns': ('GCS', 'min', sofa_cns),
+}
+SOFA_COLUMNS = ['sofa_respiration', 'sofa_cardiovascular'] + list(SOFA_RULES) + ['sofa_total']
+
+# Drugs that count towards the cardiovascular sub-score and pressor hours
+PRESSORS = [d for d, drug in enumerate(DRUGS) if NE_EQUIVALENT[drug] > 0]
+
+output_file = "stream_features.csv"
+
+
+def epoch_seconds(value):
+    """Epoch seconds of an ISO timestamp string (naive times are UTC, like cohort.to_epoch_seconds)"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    return int(datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp())
+
+
+def _number(value):
+    """float of a CSV/JSON field, NaN when missing"""
+    if value is None or value == '':
+        return np.nan
+    return float(value)
+
+
+class StreamState:
+    """Per-stay features updated one event at a time
+
+    Stays live in rows of preallocated arrays (grown by doubling), found
+    through dicts, so an update touches a fixed number of cells and reading
+    a stay's feature vector costs the same however many stays there are.
+    """
+
+    def __init__(self, window_hours=WINDOW_HOURS, capacity=1024):
+        self.window = window_hours * 3600
+        self.rows = {}  # stay_id -> row
+        self.subject_stays = {}  # subject_id -> [(intime, end_time, row)]
+        self.stay_ids = []
+        self.subject_ids = []
+        self.item_concept = {int(i): c for c, concept in enumerate(STREAM_CONCEPTS)
+                             for i in concept_itemids(concept).tolist()}
+        self.item_drug = {int(i): d for d, drug in enumerate(DRUGS) for i in VASOPRESSOR_CONFIG[drug]}
+        self.conversions = {i: UNIT_CONVERSIONS.get(i, (1.0, 0.0)) for i in self.item_concept}
+        self.concept_index = {concept: c for c, concept in enumerate(STREAM_CONCEPTS)}
+        self.columns = ([f'{c}_{stat}' for c in STREAM_CONCEPTS for stat in ('min', 'max')]
+                        + DRUGS + [f'{drug}_dose' for drug in DRUGS] + [f'{drug}_total_mcg_kg' for drug in DRUGS]
+                        + ['Vasopressor_hours', 'NE_equivalent_total_mcg_kg'] + SOFA_COLUMNS)
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        n_concepts, n_drugs = len(STREAM_CONCEPTS), len(DRUGS)
+        old = getattr(self, 'arrays', None)
+        self.arrays = {
+            'intime': np.zeros(capacity, dtype=np.int64),
+            'vmin': np.full((capacity, n_concepts), np.nan),
+            'vmax': np.full((capacity, n_concepts), np.nan),
+            'given': np.zeros((capacity, n_drugs)),
+            'peak': np.full((capacity, n_drugs), np.nan),
+            'delivered': np.zeros((capacity, n_drugs)),
+            'pressor_hours': np.zeros(capacity),
+            'pressor_end': np.full(capacity, np.iinfo(np.int64).min, dtype=np.int64),
+            'sofa': np.full((capacity, len(SOFA_COLUMNS)), np.nan),
+        }
+        if old is not None:
+            for name, values in old.items():
+                self.arrays[name][:len(values)] = values
+
+    def add_stay(self, stay_id, subject_id, intime):
+        """Register a stay (cohort file or an icustays-shaped record); its window starts at intime"""
+        stay_id, subject_id = int(stay_id), int(subject_id)
+        if stay_id in self.rows:
+            return self.rows[stay_id]
+        row = len(self.stay_ids)
+        if row == len(self.arrays['intime']):
+            self._allocate(2 * row)
+        start = epoch_seconds(intime)
+        self.arrays['intime'][row] = start
+        self.rows[stay_id] = row
+        self.stay_ids.append(stay_id)
+        self.subject_ids.append(subject_id)
+        self.subject_stays.setdefault(subject_id, []).append((start, start + self.window, row))
+        return row
+
+    def _locate(self, record, time):
+        """Row of the record's stay, -1 if it has none or time is outside the stay's window
+
+        Records without stay_id (labevents) go to the subject's stay whose
+        window holds the time.
+        """
+        stay_id = record.get('stay_id')
+        if stay_id not in (None, ''):
+            row = self.rows.get(int(float(stay_id)), -1)
+            if row < 0 or time is None:
+                return row
+            start = self.arrays['intime'][row]
+            return row if start <= time <= start + self.window else -1
+        if time is None:
+            return -1
+        for start, end, row in reversed(self.subject_stays.get(int(float(record['subject_id'])), ())):
+            if start <= time <= end:
+                return row
+        return -1
+
+    def update(self, record):
+        """Apply one chartevents/labevents/inputevents/icustays-shaped record; True if it changed state"""
+        if record.get('intime') not in (None, ''):
+            self.add_stay(record['stay_id'], record['subject_id'], record['intime'])
+            return True
+        itemid = int(float(record.get('itemid') or -1))
+        if itemid in self.item_drug:
+            return self._infusion(record, self.item_drug[itemid])
+        if itemid in self.item_concept:
+            return self._measurement(record, itemid, self.item_concept[itemid])
+        return False
+
+    def _measurement(self, record, itemid, c):
+        """Running min/max of a charted or lab value (unit conversion and ranges of units.py)"""
+        value = _number(record.get('valuenum', record.get('value')))
+        if np.isnan(value):
+            return False
+        scale, offset = self.conversions[itemid]
+        value = value * scale + offset
+        if itemid in FRACTION_OR_PERCENT and value <= 1:
+            value *= 100
+        low, high = PLAUSIBLE_RANGES[STREAM_CONCEPTS[c]]
+        if not low <= value <= high:
+            return False
+        row = self._locate(record, epoch_seconds(record.get('charttime')))
+        if row < 0:
+            return False
+        vmin, vmax = self.arrays['vmin'], self.arrays['vmax']
+        if not value >= vmin[row, c]:  # NaN compares False: first value
+            vmin[row, c] = value
+        if not value <= vmax[row, c]:
+            vmax[row, c] = value
+        self._score(row)
+        return True
+
+    def _infusion(self, record, d):
+        """Vasopressor exposure of one inputevents row (same rules as vasopressors.scan_vasopressors)"""
+        start, end = epoch_seconds(record.get('starttime')), epoch_seconds(record.get('endtime'))
+        if start is None or end is None:
+            return False
+        row = self._locate(record, None if record.get('stay_id') not in (None, '') else start)
+        if row < 0:
+            return False
+        arrays = self.arrays
+        arrays['given'][row, d] = 1
+        intime = int(arrays['intime'][row])
+        clip_start, clip_end = max(start, intime), min(end, intime + self.window)
+        overlap_min = max(clip_end - clip_start, 0) / 60.0
+        duration_min = max(end - start, 0) / 60.0
+
+        weight = _number(record.get('patientweight'))
+        weight = weight if weight > 0 else np.nan
+        factor, per_kg, minutes = RATE_UNITS.get(record.get('rateuom'), (np.nan, False, np.nan))
+        rate = _number(record.get('rate')) * factor / minutes
+        if not per_kg:
+            rate = rate / weight
+        amount = _number(record.get('amount')) * AMOUNT_UNITS.get(record.get('amountuom'), np.nan)
+        bolus = amount / weight * (overlap_min / duration_min if duration_min > 0 else 1.0)
+        dose = bolus if np.isnan(rate) else rate * overlap_min
+
+        if overlap_min > 0:
+            if np.isfinite(dose) and dose > 0:
+                arrays['delivered'][row, d] += dose
+            if np.isfinite(rate) and rate > 0 and not rate <= arrays['peak'][row, d]:
+                arrays['peak'][row, d] = rate
+            if d in PRESSORS:
+                # Union of pressor intervals, exact while records arrive ordered by starttime
+                covered = int(arrays['pressor_end'][row])
+                arrays['pressor_hours'][row] += max(clip_end - max(clip_start, covered), 0) / 3600.0
+                arrays['pressor_end'][row] = max(covered, clip_end)
+        self._score(row)
+        return True
+
+    def _score(self, row):
+        """Recompute the stay's SOFA sub-scores from its worst values so far"""
+        vmin, vmax, sofa = self.arrays['vmin'][row], self.arrays['vmax'][row], self.arrays['sofa'][row]
+        po2, fio2 = vmin[self.concept_index['PO2']], vmax[self.concept_index['FiO2']]
+        sofa[0] = sofa_respiration(po2 / (fio2 / 100)) if po2 == po2 and fio2 == fio2 else np.nan
+        n_pressors = sum(1 for d in PRESSORS if self.arrays['delivered'][row, d] > 0)
+        sofa[1] = sofa_cardiovascular(vmin[self.concept_index['Mean_Blood_Pressure']], n_pressors)
+        for j, (concept, worst, rule) in enumerate(SOFA_RULES.values(), start=2):
+            value = (vmin if worst == 'min' else vmax)[self.concept_index[concept]]
+            sofa[j] = rule(value) if value == value else np.nan
+        sofa[-1] = np.nansum(sofa[:-1])
+
+    def features(self, stay_id):
+        """Current feature vector of a stay as {column: value}, None for unknown stays"""
+        row = self.rows.get(int(stay_id))
+        if row is None:
+            return None
+        arrays = self.arrays
+        values = np.concatenate([
+            np.column_stack([arrays['vmin'][row], arrays['vmax'][row]]).reshape(-1),
+            arrays['given'][row], arrays['peak'][row], arrays['delivered'][row],
+            [arrays['pressor_hours'][row],
+             arrays['delivered'][row] @ np.array([NE_EQUIVALENT[drug] for drug in DRUGS])],
+            arrays['sofa'][row],
+        ])
+        vector = {'subject_id': self.subject_ids[row], 'stay_id': self.stay_ids[row]}
+        vector.update(zip(self.columns, (None if v != v else float(v) for v in values)))
+        return vector
+
+    def snapshot(self):
+        """All stays' feature vectors as a DataFrame"""
+        return pd.DataFrame([self.features(stay_id) for stay_id in self.stay_ids],
+                            columns=['subject_id', 'stay_id'] + self.columns)
+
+
+def tail_records(paths, follow=True, poll_seconds=0.2):
+    """Records from CSV (MIMIC-IV layout, header line) or JSON-lines files, following appended lines
+
+    A line is only parsed once its newline has been written, so rows are
+    never read half-flushed. Without follow, iteration stops at the end of
+    every file (replay).
+    """
+    sources = []
+    for path in paths:
+        handle = open(path, 'r', newline='')
+        header = None if path.endswith('.jsonl') else next(csv.reader([handle.readline()]))
+        sources.append({'handle': handle, 'header': header, 'partial': ''})
+    try:
+        while True:
+            idle = True
+            for source in sources:
+                line = source['handle'].readline()
+                if not line:
+                    continue
+                idle = False
+                line = source['partial'] + line
+                if not line.endswith('\n'):
+                    source['partial'] = line
+                    continue
+                source['partial'] = ''
+                if not line.strip():
+                    continue
+                if source['header'] is None:
+                    yield json.loads(line)
+                else:
+                    yield dict(zip(source['header'], next(csv.reader([line]))))
+            if idle:
+                if not follow:
+                    return
+                time.sleep(poll_seconds)
+    finally:
+        for source in sources:
+            source['handle'].close()
+
+
+class StreamStats:
+    """Event counts and time spent in StreamState.update"""
+
+    def __init__(self):
+        self.events = 0
+        self.applied = 0
+        self.seconds = 0.0
+        self.started = time.time()
+
+    def record(self, state, record):
+        t0 = time.perf_counter()
+        changed = state.update(record)
+        self.seconds += time.perf_counter() - t0
+        self.events += 1
+        self.applied += changed
+        return changed
+
+    def summary(self):
+        rate = self.events / max(time.time() - self.started, 1e-9)
+        latency = 1e6 * self.seconds / max(self.events, 1)
+        return f"{self.events} events ({self.applied} applied), {rate:.0f}/s, {latency:.1f} µs/event"
+
+
+def serve(state, stats, address, lock):
+    """Serve JSON-lines over a Unix socket path or a local host:port
+
+    Each line is an event record, or {"query": stay_id} which is answered
+    with the stay's feature vector as one JSON line.
+    """
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                message = json.loads(line)
+                if 'query' in message:
+                    with lock:
+                        vector = state.features(message['query'])
+                    self.wfile.write((json.dumps(vector) + '\n').encode())
+                else:
+                    with lock:
+                        stats.record(state, message)
+
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        server = socketserver.ThreadingTCPServer((host, int(port)), Handler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = socketserver.ThreadingUnixStreamServer(address, Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='stream-server', daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    """Update per-stay features from tailed event files and/or a local socket"""
+    parser = argparse.ArgumentParser(description="Streaming per-stay ICU features")
+    parser.add_argument('--cohort', default='patients.csv', help="stays to track (subject_id, stay_id, intime)")
+    parser.add_argument('--follow', nargs='*', default=[], help="event files to tail (.csv or .jsonl)")
+    parser.add_argument('--replay', action='store_true', help="read the files once instead of tailing them")
+    parser.add_argument('--socket', help="Unix socket path or host:port for events and queries")
+    parser.add_argument('--output', default=output_file, help="feature snapshot written on exit")
+    parser.add_argument('--report-seconds', type=float, default=10.0)
+    args = parser.parse_args()
+
+    print("=== STREAMING ICU FEATURES ===")
+    state, stats, lock = StreamState(), StreamStats(), threading.Lock()
+    if os.path.exists(args.cohort):
+        cohort = apply_sample(pd.read_csv(args.cohort, usecols=['subject_id', 'stay_id', 'intime']))
+        for stay in cohort.itertuples(index=False):
+            state.add_stay(stay.stay_id, stay.subject_id, stay.intime)
+    print(f"Stays: {len(state.stay_ids)}")
+
+    server = serve(state, stats, args.socket, lock) if args.socket else None
+    if server:
+        print(f"🔌 Listening on {args.socket}")
+    last_report = time.time()
+    try:
+        if args.follow:
+            for record in tail_records(args.follow, follow=not args.replay):
+                with lock:
+                    stats.record(state, record)
+                if time.time() - last_report >= args.report_seconds:
+                    print(f"  {stats.summary()}")
+                    last_report = time.time()
+        while server:
+            time.sleep(args.report_seconds)
+            print(f"  {stats.summary()}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server:
+            server.shutdown()
+        with lock:
+            state.snapshot().to_csv(args.output, index=False)
+        print(f"  {stats.summary()}")
+        print(f"✅ Saved: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,15 @@
 # extract_therapy_simple.py
 import pandas as pd
-import numpy as np
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cohort import cohort_units, unit_frame
+from duckdb_backend import scan_chunks
+from reference_cache import subject_lookup
+from sampling import apply_sample
+from vasopressors import VASOPRESSOR_CONFIG, vasopressor_exposure
+from ventilation import VENT_GAP_HOURS, ventilation_summary
 
 print("=== EXTRACTING THERAPY FEATURES (OPTIMIZED) ===")
 
@@ -11,12 +19,13 @@ output_file = "therapy_simple.csv"
 
 # Load patient cohort
 print("Loading patient cohort...")
-cohort = pd.read_csv('patients.csv')
+cohort = apply_sample(pd.read_csv('patients.csv'))
 our_patients = set(cohort['subject_id'].unique())
 print(f"Patients: {len(our_patients)}")
 
-# Initialize therapy dataframe with subject_id
-therapy_df = pd.DataFrame({'subject_id': list(our_patients)})
+# Initialize therapy dataframe with subject_id (+ stay_id in stay mode, --stays)
+therapy_df = unit_frame(cohort_units(cohort))
+KEY_COLUMNS = therapy_df.columns.tolist()
 
 def safe_extract_dialysis():
     """Extract dialysis therapy safely with memory management"""
@@ -24,11 +33,10 @@ def safe_extract_dialysis():
     
     try:
         # Process in chunks to save memory
-        chunks = pd.read_csv(os.path.join(data_path, 'hosp/procedures_icd.csv'), 
-                            chunksize=100000)
-        
         dialysis_patients = set()
         dialysis_codes = {'5A1D', '5A1D0', '5A1D1', '5A1D2', '5A1D5', '5A1D6', '5A1D7', '5A1D8', '5498'}
+        chunks = scan_chunks(os.path.join(data_path, 'hosp/procedures_icd.csv'), ['subject_id', 'icd_code'],
+                             {'icd_code': sorted(dialysis_codes)}, subjects=sorted(our_patients))
         
         for i, chunk in enumerate(chunks):
             # Filter for our patients and dialysis codes
@@ -52,147 +60,66 @@ def safe_extract_dialysis():
         therapy_df['Dialysis'] = 0
 
 def safe_extract_ventilation():
-    """Extract mechanical ventilation safely"""
+    """Extract mechanical ventilation episodes safely"""
     print("\n=== EXTRACTING MECHANICAL VENTILATION ===")
+    global therapy_df
     
     try:
-        # Load d_items first to get ventilation itemids
-        d_items = pd.read_csv(os.path.join(data_path, 'icu/d_items.csv'))
-        vent_items = set(d_items[
-            d_items['label'].str.contains('ventilat|intubat', case=False, na=False)
-        ]['itemid'])
-        
-        # Process procedureevents in chunks
-        chunks = pd.read_csv(os.path.join(data_path, 'icu/procedureevents.csv'), 
-                            chunksize=100000)
+        # Merge overlapping/nearby procedureevents intervals into episodes
+        summary = ventilation_summary(cohort, gap_hours=VENT_GAP_HOURS)
+        therapy_df = therapy_df.merge(summary, on=KEY_COLUMNS, how='left')
+        therapy_df['Mechanical_Ventilation'] = therapy_df['Mechanical_Ventilation'].fillna(0).astype(int)
+        therapy_df['Ventilation_episodes'] = therapy_df['Ventilation_episodes'].fillna(0).astype(int)
+        therapy_df['Ventilation_hours'] = therapy_df['Ventilation_hours'].fillna(0.0)
         
-        vent_patients = set()
-        
-        for i, chunk in enumerate(chunks):
-            chunk_filtered = chunk[
-                chunk['subject_id'].isin(our_patients) & 
-                chunk['itemid'].isin(vent_items)
-            ]
-            
-            if not chunk_filtered.empty:
-                vent_patients.update(chunk_filtered['subject_id'].unique())
-            
-            if i % 10 == 0:
-                print(f"  Processed {i+1} chunks...")
-        
-        therapy_df['Mechanical_Ventilation'] = therapy_df['subject_id'].isin(vent_patients).astype(int)
         count = therapy_df['Mechanical_Ventilation'].sum()
         print(f"  ✅ Mechanical Ventilation: {count} patients ({count/len(therapy_df)*100:.1f}%)")
+        print(f"  ✅ Ventilation episodes: {therapy_df['Ventilation_episodes'].sum()} "
+              f"(gap tolerance {VENT_GAP_HOURS}h)")
         
     except Exception as e:
         print(f"  ⚠️  Error: {e}")
         therapy_df['Mechanical_Ventilation'] = 0
 
 def safe_extract_vasopressors():
-    """Extract vasopressors safely with chunk processing"""
+    """Extract vasopressor flags, doses and exposure in one pass over inputevents"""
     print("\n=== EXTRACTING VASOPRESSORS ===")
-    
-    vasopressor_config = {
-        'Epinephrine': {221289, 30047, 30120},
-        'Norepinephrine': {221906, 30051, 30128},
-        'Dopamine': {221662, 30043, 30119},
-        'Dobutamine': {221653, 30042, 30125}
-    }
+    global therapy_df
     
     try:
-        # Process inputevents in chunks
-        chunks = pd.read_csv(os.path.join(data_path, 'icu/inputevents.csv'), 
-                            chunksize=100000)
+        exposure = vasopressor_exposure(cohort)
+        therapy_df = therapy_df.merge(exposure, on=KEY_COLUMNS, how='left')
         
-        vasopressor_patients = {name: set() for name in vasopressor_config.keys()}
-        
-        for i, chunk in enumerate(chunks):
-            chunk_filtered = chunk[chunk['subject_id'].isin(our_patients)]
-            
-            for vasopressor, itemids in vasopressor_config.items():
-                patients_with_vaso = chunk_filtered[
-                    chunk_filtered['itemid'].isin(itemids)
-                ]['subject_id'].unique()
-                
-                if len(patients_with_vaso) > 0:
-                    vasopressor_patients[vasopressor].update(patients_with_vaso)
-            
-            if i % 10 == 0:
-                print(f"  Processed {i+1} chunks...")
-        
-        # Add binary columns
-        for vasopressor, patients_set in vasopressor_patients.items():
-            therapy_df[vasopressor] = therapy_df['subject_id'].isin(patients_set).astype(int)
+        for vasopressor in VASOPRESSOR_CONFIG.keys():
+            therapy_df[vasopressor] = therapy_df[vasopressor].fillna(0).astype(int)
             count = therapy_df[vasopressor].sum()
             print(f"  ✅ {vasopressor}: {count} patients ({count/len(therapy_df)*100:.1f}%)")
         
-    except Exception as e:
-        print(f"  ⚠️  Error: {e}")
-        for vasopressor in vasopressor_config.keys():
-            therapy_df[vasopressor] = 0
-
-def safe_extract_doses():
-    """Extract vasopressor doses with minimal memory usage"""
-    print("\n=== EXTRACTING VASOPRESSOR DOSES ===")
-    
-    dose_config = {
-        'Epinephrine_dose': {221289, 30047, 30120},
-        'Norepinephrine_dose': {221906, 30051, 30128},
-        'Dopamine_dose': {221662, 30043, 30119},
-        'Dobutamine_dose': {221653, 30042, 30125}
-    }
-    
-    try:
-        # Initialize dose columns with NaN
-        for dose_col in dose_config.keys():
-            therapy_df[dose_col] = np.nan
-        
-        # Process in chunks and update doses
-        chunks = pd.read_csv(os.path.join(data_path, 'icu/inputevents.csv'), 
-                            chunksize=50000,
-                            usecols=['subject_id', 'itemid', 'rate'])
-        
-        for i, chunk in enumerate(chunks):
-            chunk_filtered = chunk[
-                chunk['subject_id'].isin(our_patients) & 
-                chunk['rate'].notna() & 
-                (chunk['rate'] > 0)
-            ]
-            
-            for dose_col, itemids in dose_config.items():
-                dose_data = chunk_filtered[chunk_filtered['itemid'].isin(itemids)]
-                
-                if not dose_data.empty:
-                    # Update maximum doses
-                    current_max = dose_data.groupby('subject_id')['rate'].max()
-                    
-                    for subject_id, max_rate in current_max.items():
-                        current_val = therapy_df.loc[therapy_df['subject_id'] == subject_id, dose_col].values
-                        if len(current_val) > 0 and (np.isnan(current_val[0]) or max_rate > current_val[0]):
-                            therapy_df.loc[therapy_df['subject_id'] == subject_id, dose_col] = max_rate
-            
-            if i % 20 == 0:
-                print(f"  Processed {i+1} chunks...")
-        
         # Print dose statistics
-        for dose_col in dose_config.keys():
+        for vasopressor in VASOPRESSOR_CONFIG.keys():
+            dose_col = f'{vasopressor}_dose'
             count = therapy_df[dose_col].notna().sum()
             if count > 0:
                 avg_dose = therapy_df[dose_col].mean()
-                print(f"  ✅ {dose_col}: {count} patients, avg: {avg_dose:.3f} mcg/kg/min")
+                print(f"  ✅ {dose_col}: {count} patients, avg peak: {avg_dose:.3f} mcg/kg/min")
             else:
                 print(f"  ⚠️  {dose_col}: No dose data")
-                
+        
+        on_pressors = (therapy_df['Vasopressor_hours'] > 0).sum()
+        print(f"  ✅ Vasopressor exposure in window: {on_pressors} patients, "
+              f"median NE-equivalent: {therapy_df.loc[therapy_df['Vasopressor_hours'] > 0, 'NE_equivalent_total_mcg_kg'].median():.1f} mcg/kg")
+        
     except Exception as e:
-        print(f"  ⚠️  Error extracting doses: {e}")
+        print(f"  ⚠️  Error: {e}")
+        for vasopressor in VASOPRESSOR_CONFIG.keys():
+            therapy_df[vasopressor] = 0
 
 def add_demographics_safe():
     """Add demographics safely"""
     print("\n=== ADDING DEMOGRAPHICS ===")
     
     try:
-        patients = pd.read_csv(os.path.join(data_path, 'hosp/patients.csv'))
-        patients_cohort = patients[patients['subject_id'].isin(our_patients)]
+        patients_cohort = subject_lookup('patients', our_patients, ['anchor_age', 'gender'])
         
         therapy_df['age'] = therapy_df['subject_id'].map(
             patients_cohort.set_index('subject_id')['anchor_age']
@@ -226,9 +153,6 @@ def main():
         safe_extract_vasopressors()
         save_intermediate()
         
-        safe_extract_doses()
-        save_intermediate()
-        
         add_demographics_safe()
         
         # Final save
@@ -243,7 +167,7 @@ def main():
         print(f"\n🎯 THERAPY EXTRACTION COMPLETED!")
         print("Features extracted:")
         for col in therapy_df.columns:
-            if col != 'subject_id':
+            if col not in KEY_COLUMNS:
                 if 'dose' in col:
                     count = therapy_df[col].notna().sum()
                     print(f"  - {col}: {count} patients")
@@ -0,0 +1,158 @@
+# vasopressors.py
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cohort import cohort_units, to_epoch_seconds, unit_frame, unit_index
+from concepts import concept_itemids, itemid_lookup, tag_itemids
+from duckdb_backend import scan_chunks
+from ventilation import merge_intervals
+
+# Configuration
+data_path = "/home/nishat/physionet.org/files/mimiciv/3.1/"
+output_file = "vasopressor_exposure.csv"
+
+DRUGS = ['Epinephrine', 'Norepinephrine', 'Dopamine', 'Dobutamine']
+VASOPRESSOR_CONFIG = {drug: set(concept_itemids(drug).tolist()) for drug in DRUGS}
+
+# Norepinephrine-equivalent factors (dobutamine is an inotrope, not a pressor)
+NE_EQUIVALENT = {
+    'Epinephrine': 1.0,
+    'Norepinephrine': 1.0,
+    'Dopamine': 0.01,
+    'Dobutamine': 0.0
+}
+
+# rateuom -> (factor to mcg/<time>, rate is already per kg, minutes per time unit)
+RATE_UNITS = {
+    'mcg/kg/min': (1.0, True, 1.0),
+    'mcg/kg/hour': (1.0, True, 60.0),
+    'mg/kg/min': (1000.0, True, 1.0),
+    'mg/kg/hour': (1000.0, True, 60.0),
+    'mcg/min': (1.0, False, 1.0),
+    'mcg/hour': (1.0, False, 60.0),
+    'mg/min': (1000.0, False, 1.0),
+    'mg/hour': (1000.0, False, 60.0),
+}
+AMOUNT_UNITS = {'mcg': 1.0, 'mg': 1000.0}
+
+INPUT_COLUMNS = ['subject_id', 'stay_id', 'starttime', 'endtime', 'itemid', 'amount', 'amountuom',
+                 'rate', 'rateuom', 'patientweight']
+
+
+def normalized_rate(rate, rateuom, weight):
+    """Convert infusion rates to mcg/kg/min (NaN for unknown units or weights)"""
+    units = pd.Series(rateuom)
+    factor = units.map({u: f for u, (f, _, _) in RATE_UNITS.items()}).to_numpy(dtype=float)
+    per_kg = (units.map({u: k for u, (_, k, _) in RATE_UNITS.items()}) == True).to_numpy()
+    minutes = units.map({u: m for u, (_, _, m) in RATE_UNITS.items()}).to_numpy(dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mcg_kg_min = rate * factor / minutes
+        return np.where(per_kg, mcg_kg_min, mcg_kg_min / weight)
+
+
+def scan_vasopressors(units, chunksize=None):
+    """Single pass over inputevents: flags, peak rates, area under rate and pressor intervals"""
+    intime, end_time = units['intime'], units['end_time']
+    n = len(intime)
+    n_drugs = len(DRUGS)
+    drug_lookup = itemid_lookup(DRUGS)
+
+    given = np.zeros(n * n_drugs, dtype=bool)
+    peak_rate = np.full(n * n_drugs, -np.inf)
+    delivered = np.zeros(n * n_drugs)
+    interval_subjects, interval_starts, interval_ends = [], [], []
+
+    chunks = scan_chunks(os.path.join(data_path, 'icu/inputevents.csv'), INPUT_COLUMNS,
+                         {'itemid': sorted(set().union(*VASOPRESSOR_CONFIG.values()))}, chunksize=chunksize,
+                         reserved_bytes=given.nbytes + peak_rate.nbytes + delivered.nbytes,
+                         subjects=units['subject_id'])
+
+    for i, chunk in enumerate(chunks):
+        drug = tag_itemids(drug_lookup, chunk['itemid'].to_numpy())
+        idx = unit_index(units, chunk['subject_id'].to_numpy(), chunk['stay_id'].to_numpy())
+        keep = (idx >= 0) & (drug >= 0)
+        if not keep.any():
+            continue
+        chunk = chunk[keep]
+        idx = idx[keep]
+        drug = drug[keep]
+        flat = idx * n_drugs + drug
+        given[flat] = True
+
+        # Clip each infusion interval to the cohort time window
+        start = to_epoch_seconds(chunk['starttime'])
+        end = to_epoch_seconds(chunk['endtime'])
+        clip_start = np.maximum(start, intime[idx])
+        clip_end = np.minimum(end, end_time[idx])
+        overlap_min = np.maximum(clip_end - clip_start, 0) / 60.0
+        duration_min = np.maximum(end - start, 0) / 60.0
+        in_window = overlap_min > 0
+
+        weight = chunk['patientweight'].to_numpy(dtype=float)
+        weight = np.where(weight > 0, weight, np.nan)
+        rate = normalized_rate(chunk['rate'].to_numpy(dtype=float), chunk['rateuom'].to_numpy(), weight)
+
+        # Bolus rows have no rate: spread the charted amount over the interval
+        amount = chunk['amount'].to_numpy(dtype=float) * chunk['amountuom'].map(AMOUNT_UNITS).to_numpy(dtype=float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bolus = amount / weight * np.where(duration_min > 0, overlap_min / duration_min, 1.0)
+        dose = np.where(np.isnan(rate), bolus, rate * overlap_min)
+        dose = np.where(in_window & np.isfinite(dose) & (dose > 0), dose, 0.0)
+
+        delivered += np.bincount(flat, weights=dose, minlength=delivered.size)
+        has_rate = in_window & np.isfinite(rate) & (rate > 0)
+        np.maximum.at(peak_rate, flat[has_rate], rate[has_rate])
+
+        pressor = in_window & (drug != DRUGS.index('Dobutamine'))
+        interval_subjects.append(idx[pressor])
+        interval_starts.append(clip_start[pressor])
+        interval_ends.append(clip_end[pressor])
+
+        if i % 20 == 0:
+            print(f"  Processed {i+1} chunks...")
+
+    peak_rate[np.isinf(peak_rate)] = np.nan
+    if interval_subjects:
+        intervals = tuple(np.concatenate(a) for a in (interval_subjects, interval_starts, interval_ends))
+    else:
+        intervals = tuple(np.array([], dtype=np.int64) for _ in range(3))
+    return (given.reshape(n, n_drugs), peak_rate.reshape(n, n_drugs),
+            delivered.reshape(n, n_drugs), intervals)
+
+
+def vasopressor_exposure(cohort):
+    """Per-unit vasopressor exposure within the cohort time window"""
+    units = cohort_units(cohort)
+    given, peak_rate, delivered, intervals = scan_vasopressors(units)
+
+    # Union of pressor intervals so overlapping drugs are not double-counted
+    ep_subject, ep_start, ep_end = merge_intervals(*intervals, gap_seconds=0)
+    pressor_hours = np.bincount(ep_subject, weights=(ep_end - ep_start) / 3600.0, minlength=len(units['intime']))
+
+    exposure = unit_frame(units)
+    for d, drug in enumerate(DRUGS):
+        exposure[drug] = given[:, d].astype(int)
+        exposure[f'{drug}_dose'] = peak_rate[:, d]
+        exposure[f'{drug}_total_mcg_kg'] = delivered[:, d]
+    exposure['Vasopressor_hours'] = pressor_hours
+    factors = np.array([NE_EQUIVALENT[drug] for drug in DRUGS])
+    exposure['NE_equivalent_total_mcg_kg'] = delivered @ factors
+    return exposure
+
+
+def main():
+    """Run the vasopressor exposure engine standalone"""
+    print("=== EXTRACTING VASOPRESSOR EXPOSURE ===")
+    cohort = pd.read_csv('patients.csv')
+    exposure = vasopressor_exposure(cohort)
+    exposure.to_csv(output_file, index=False)
+    print(f"✅ Saved: {output_file}")
+    print(f"  Patients on pressors in window: {(exposure['Vasopressor_hours'] > 0).sum()}")
+
+
+if __name__ == "__main__":
+    main()
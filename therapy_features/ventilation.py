@@ -0,0 +1,125 @@
+# ventilation.py
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cohort import cohort_units, to_epoch_seconds, unit_frame, unit_index
+from concepts import concept_itemids
+from duckdb_backend import scan_chunks
+
+# Configuration
+data_path = "/home/nishat/physionet.org/files/mimiciv/3.1/"
+output_file = "ventilation_episodes.csv"
+
+# Intervals separated by at most this many hours belong to the same episode
+VENT_GAP_HOURS = 6
+
+VENTILATION_COLUMNS = ['Ventilation_hours', 'Ventilation_episodes', 'Hours_to_first_ventilation']
+
+
+def ventilation_itemids():
+    """Ventilation/intubation itemids (d_items label concept)"""
+    return set(concept_itemids('Mechanical_Ventilation').tolist())
+
+
+def load_ventilation_intervals(units, itemids, stay_ids=None, chunksize=None):
+    """Collect (unit index, start, end) arrays for ventilation procedures"""
+    subjects, starts, ends = [], [], []
+    chunks = scan_chunks(os.path.join(data_path, 'icu/procedureevents.csv'),
+                         ['subject_id', 'stay_id', 'itemid', 'starttime', 'endtime'],
+                         {'itemid': sorted(itemids)}, chunksize=chunksize, subjects=units['subject_id'])
+
+    for i, chunk in enumerate(chunks):
+        chunk = chunk[chunk['itemid'].isin(itemids) & chunk['starttime'].notna() & chunk['endtime'].notna()]
+        if stay_ids is not None:
+            chunk = chunk[chunk['stay_id'].isin(stay_ids)]
+        if chunk.empty:
+            continue
+
+        idx = unit_index(units, chunk['subject_id'].to_numpy(), chunk['stay_id'].to_numpy())
+        keep = idx >= 0
+        subjects.append(idx[keep])
+        starts.append(to_epoch_seconds(chunk['starttime'].to_numpy()[keep]))
+        ends.append(to_epoch_seconds(chunk['endtime'].to_numpy()[keep]))
+
+        if i % 10 == 0:
+            print(f"  Processed {i+1} chunks...")
+
+    if not subjects:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty
+    return np.concatenate(subjects), np.concatenate(starts), np.concatenate(ends)
+
+
+def merge_intervals(subjects, starts, ends, gap_seconds):
+    """Sort-and-sweep union of intervals per subject, vectorized across the cohort
+
+    Each subject's timeline is shifted into its own disjoint range so a single
+    running maximum of end times sweeps every subject at once.
+    Returns (episode subject, episode start, episode end).
+    """
+    if len(subjects) == 0:
+        return subjects, starts, ends
+
+    ends = np.maximum(ends, starts)
+    origin = starts.min()
+    span = ends.max() - origin + gap_seconds + 1
+    shifted_start = starts - origin + subjects * span
+    shifted_end = ends - origin + subjects * span
+
+    order = np.lexsort((shifted_start, subjects))
+    shifted_start, shifted_end = shifted_start[order], shifted_end[order]
+    subjects, starts = subjects[order], starts[order]
+
+    reach = np.maximum.accumulate(shifted_end)
+    new_episode = np.ones(len(order), dtype=bool)
+    new_episode[1:] = shifted_start[1:] > reach[:-1] + gap_seconds
+
+    first = np.flatnonzero(new_episode)
+    episode_end = np.maximum.reduceat(shifted_end, first) - subjects[first] * span + origin
+    return subjects[first], starts[first], episode_end
+
+
+def ventilation_summary(cohort, gap_hours=VENT_GAP_HOURS):
+    """Ventilated hours, episode count and time to first ventilation per cohort unit"""
+    units = cohort_units(cohort)
+    intime = units['intime']
+    stay_ids = set(cohort['stay_id']) if 'stay_id' in cohort.columns else None
+
+    subjects, starts, ends = load_ventilation_intervals(units, ventilation_itemids(), stay_ids)
+    ep_subject, ep_start, ep_end = merge_intervals(subjects, starts, ends, int(gap_hours * 3600))
+
+    n = len(intime)
+    hours = np.bincount(ep_subject, weights=(ep_end - ep_start) / 3600.0, minlength=n)
+    episodes = np.bincount(ep_subject, minlength=n)
+
+    # Episodes are sorted by subject then start, so the first one per subject is the earliest
+    first_start = np.full(n, np.nan)
+    is_first = np.ones(len(ep_subject), dtype=bool)
+    is_first[1:] = ep_subject[1:] != ep_subject[:-1]
+    first_start[ep_subject[is_first]] = ep_start[is_first]
+
+    summary = unit_frame(units)
+    summary['Mechanical_Ventilation'] = (episodes > 0).astype(int)
+    summary['Ventilation_hours'] = np.where(episodes > 0, hours, 0.0)
+    summary['Ventilation_episodes'] = episodes
+    summary['Hours_to_first_ventilation'] = (first_start - intime) / 3600.0
+    return summary
+
+
+def main():
+    """Run the ventilation episode engine standalone"""
+    print("=== EXTRACTING MECHANICAL VENTILATION EPISODES ===")
+    cohort = pd.read_csv('patients.csv')
+    summary = ventilation_summary(cohort)
+    summary.to_csv(output_file, index=False)
+    print(f"✅ Saved: {output_file}")
+    print(f"  Ventilated patients: {summary['Mechanical_Ventilation'].sum()}")
+    print(f"  Median ventilated hours: {summary.loc[summary['Ventilation_episodes'] > 0, 'Ventilation_hours'].median():.1f}")
+
+
+if __name__ == "__main__":
+    main()
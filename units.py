@@ -0,0 +1,77 @@
+# units.py
+import numpy as np
+
+# Per-itemid conversion into the concept's unit: value * scale + offset
+UNIT_CONVERSIONS = {
+    # Temperature °F -> °C
+    223761: (5 / 9, -32 * 5 / 9),
+    678: (5 / 9, -32 * 5 / 9),
+    679: (5 / 9, -32 * 5 / 9),
+}
+
+# Itemids charted either as a fraction (0.21-1.0) or a percent (21-100);
+# values <= 1 are read as fractions and scaled to percent
+FRACTION_OR_PERCENT = {223835, 3420, 3422, 189, 190}
+
+# Physiologically plausible range per concept after conversion (inclusive).
+# Zero is a valid value where the lower bound is 0 (e.g. blood pressure in arrest, CRP).
+PLAUSIBLE_RANGES = {
+    'PO2': (10, 800),  # mmHg
+    'FiO2': (21, 100),  # %
+    'SpO2': (10, 100),  # %
+    'Bilirubin': (0, 100),  # mg/dl
+    'Lactate': (0, 50),  # mmol/l
+    'CRP': (0, 1000),  # mg/l
+    'Leukocytes': (0, 1000),  # /nl
+    'Blood_Sugar': (5, 3000),  # mg/dl
+    'Platelets': (0, 3000),  # 10³/mm³
+    'Creatinine': (0, 40),  # mg/dl
+    'Systolic_BP': (0, 350),  # mmHg
+    'Diastolic_BP': (0, 300),  # mmHg
+    'Mean_Blood_Pressure': (0, 300),  # mmHg
+    'Respiratory_Rate': (0, 100),  # /min
+    'Heart_Rate': (0, 350),  # /min
+    'Temperature': (25, 45),  # °C
+    'Urine_Output': (0, 5000),  # ml per charting
+    'GCS': (3, 15),
+    'GCS_Eye': (1, 4),
+    'GCS_Verbal': (1, 5),
+    'GCS_Motor': (1, 6),
+}
+
+
+def conversion_table(itemids):
+    """Sorted itemids with their scale, offset and fraction flag (dense arrays)"""
+    itemids = np.unique(np.asarray(itemids, dtype=np.int64))
+    scale = np.ones(len(itemids))
+    offset = np.zeros(len(itemids))
+    for i, itemid in enumerate(itemids.tolist()):
+        scale[i], offset[i] = UNIT_CONVERSIONS.get(itemid, (1.0, 0.0))
+    fraction = np.isin(itemids, list(FRACTION_OR_PERCENT))
+    return itemids, scale, offset, fraction
+
+
+def normalize_values(concept, itemids, values, table=None):
+    """Convert values to the concept's unit; NaN where missing or implausible
+
+    Vectorized over a whole chunk: itemids are matched to the conversion
+    table by binary search, so no per-row Python runs during the scan.
+    Itemids outside the table pass through unconverted.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    itemids = np.asarray(itemids, dtype=np.int64)
+    if len(values) == 0:
+        return values
+    table_ids, scale, offset, fraction = conversion_table(itemids) if table is None else table
+
+    pos = np.minimum(np.searchsorted(table_ids, itemids), len(table_ids) - 1)
+    known = table_ids[pos] == itemids
+    row_scale = np.where(known, scale[pos], 1.0)
+    row_offset = np.where(known, offset[pos], 0.0)
+    row_fraction = known & fraction[pos]
+
+    values = values * row_scale + row_offset
+    values = np.where(row_fraction & (values <= 1), values * 100, values)
+
+    low, high = PLAUSIBLE_RANGES.get(concept, (-np.inf, np.inf))
+    return np.where((values >= low) & (values <= high), values, np.nan)
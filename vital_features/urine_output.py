@@ -0,0 +1,146 @@
+# urine_output.py
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cohort import WINDOW_HOURS, cohort_units, load_weights, to_epoch_seconds, unit_frame, unit_index
+from concepts import concept_itemids
+from duckdb_backend import scan_chunks
+from profiles import update_profile
+
+# Configuration
+data_path = "/home/nishat/physionet.org/files/mimiciv/3.1/"
+output_file = "urine_output.csv"
+series_file = "urine_rate_hourly.npz"
+
+# Urine itemids in outputevents (volumes in ml per charting)
+URINE_ITEMIDS = concept_itemids('Urine_Output').tolist()
+
+# Rolling windows (hours) used by the KDIGO urine output criteria
+KDIGO_WINDOWS = [6, 12, 24]
+
+URINE_COLUMNS = ['Urine_Output_total_ml'] + [f'Urine_Rate_{k}h_min' for k in KDIGO_WINDOWS]
+
+
+def hourly_urine_totals(file_path, itemids, units, n_hours=WINDOW_HOURS, chunksize=None, profile=None):
+    """Bucket urine volumes into hourly per-unit totals in one pass over outputevents
+
+    A profile (profiles.py) passed in is filled from the same pass.
+    """
+    n_subjects = len(units['subject_id'])
+    intime = units['intime']
+    totals = np.zeros(n_subjects * n_hours)
+    charted = np.zeros(n_subjects * n_hours, dtype=np.int64)
+
+    chunks = scan_chunks(file_path, ['subject_id', 'stay_id', 'itemid', 'charttime', 'value'],
+                         {'itemid': itemids}, chunksize=chunksize, reserved_bytes=totals.nbytes + charted.nbytes,
+                         subjects=units['subject_id'])
+
+    for chunk_idx, chunk in enumerate(chunks):
+        chunk = chunk[chunk['itemid'].isin(itemids)]
+        if chunk.empty:
+            continue
+
+        idx = unit_index(units, chunk['subject_id'].to_numpy(), chunk['stay_id'].to_numpy())
+        in_cohort = idx >= 0
+        times = to_epoch_seconds(chunk['charttime'].to_numpy())
+        values = chunk['value'].to_numpy(dtype=float)
+        hour = (times - intime[np.maximum(idx, 0)]) // 3600
+        in_window = in_cohort & (hour >= 0) & (hour < n_hours)
+        if profile is not None:
+            update_profile(profile, chunk['itemid'].to_numpy(), values, in_cohort, in_window)
+
+        in_window &= ~np.isnan(values) & (values >= 0)
+        flat = idx[in_window] * n_hours + hour[in_window]
+
+        totals += np.bincount(flat, weights=values[in_window], minlength=totals.size)
+        charted += np.bincount(flat, minlength=charted.size)
+
+        if chunk_idx % 20 == 0 and chunk_idx > 0:
+            print(f"    Processed {chunk_idx + 1} chunks...")
+
+    return totals.reshape(n_subjects, n_hours), charted.reshape(n_subjects, n_hours)
+
+
+def _masked_extreme(values, mask, reduce):
+    """Row-wise min/max over masked entries (NaN for rows with no entries)"""
+    fill = np.inf if reduce is np.min else -np.inf
+    out = reduce(np.where(mask, values, fill), axis=1)
+    out[np.isinf(out)] = np.nan
+    return out
+
+
+def urine_rates(totals, charted, weights, windows=KDIGO_WINDOWS):
+    """Turn hourly totals into ml/kg/h rates and KDIGO rolling-window minima
+
+    Hours after the last charted hour are unobserved (not anuric), so hourly
+    rates and rolling windows only cover hours up to the last charting.
+    """
+    n_subjects, n_hours = totals.shape
+    hours = np.arange(n_hours)
+
+    has_data = charted.any(axis=1)
+    last_hour = np.where(has_data, n_hours - 1 - np.argmax(charted[:, ::-1] > 0, axis=1), -1)
+    observed = hours[None, :] <= last_hour[:, None]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        hourly = totals / weights[:, None]
+    hourly = np.where(observed, hourly, np.nan)
+
+    cumulative = np.concatenate([np.zeros((n_subjects, 1)), np.cumsum(totals, axis=1)], axis=1)
+    rolling_min = {}
+    for k in windows:
+        if k > n_hours:
+            rolling_min[k] = np.full(n_subjects, np.nan)
+            continue
+        window_sums = cumulative[:, k:] - cumulative[:, :-k]
+        window_end = np.arange(k, n_hours + 1)
+        valid = window_end[None, :] <= last_hour[:, None] + 1
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rates = window_sums / (weights[:, None] * k)
+        rolling_min[k] = _masked_extreme(rates, valid, np.min)
+
+    return hourly, rolling_min
+
+
+def extract_urine_rates(cohort, itemids=URINE_ITEMIDS, general_file='general.csv', window_hours=WINDOW_HOURS,
+                        profile=None):
+    """Extract weight-normalized urine output (ml/kg/h) for the cohort (one row per unit)"""
+    units = cohort_units(cohort, window_hours)
+    weights = load_weights(units['subject_id'], general_file)
+
+    totals, charted = hourly_urine_totals(os.path.join(data_path, 'icu/outputevents.csv'),
+                                          itemids, units, window_hours, profile=profile)
+    hourly, rolling_min = urine_rates(totals, charted, weights)
+
+    has_data = charted.any(axis=1)
+    urine = unit_frame(units)
+    urine['Urine_Output_total_ml'] = np.where(has_data, totals.sum(axis=1), np.nan)
+    observed = ~np.isnan(hourly)
+    urine['Urine_Output_min'] = _masked_extreme(hourly, observed, np.min)
+    urine['Urine_Output_max'] = _masked_extreme(hourly, observed, np.max)
+    for k, values in rolling_min.items():
+        urine[f'Urine_Rate_{k}h_min'] = values
+
+    np.savez_compressed(series_file, subject_id=units['subject_id'], stay_id=units['stay_id'],
+                        rate_ml_kg_h=hourly.astype(np.float32))
+    print(f"    ✅ Urine output: {int(has_data.sum())} patients "
+          f"({int(np.isfinite(weights[has_data]).sum())} with weight)")
+    print(f"    💾 Hourly ml/kg/h series saved to {series_file}")
+    return urine
+
+
+def main():
+    """Run the urine output engine standalone"""
+    print("=== EXTRACTING HOURLY URINE OUTPUT (ml/kg/h) ===")
+    cohort = pd.read_csv('filtered_patients_corrected.csv')
+    urine = extract_urine_rates(cohort)
+    urine.to_csv(output_file, index=False)
+    print(f"✅ Saved: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,20 @@
 import pandas as pd
 import numpy as np
 import os
-from datetime import datetime, timedelta
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from chunk_reader import read_csv_chunks
+from cohort import attribute_stays, cohort_units, to_epoch_seconds, unit_frame
+from concepts import concept_itemids
+from duckdb_backend import use_duckdb, window_events
+from parallel_scan import scan_features
+from profiles import new_profile, save_profiles, update_profile
+from sampling import apply_sample
+from shared_cohort import scan_workers
+from sketches import SKETCH_STATS, concept_sketch, summarize_sketch, update_sketch
+from units import conversion_table, normalize_values
+from urine_output import URINE_COLUMNS, extract_urine_rates
 
 print("=== EXTRACTING FINAL ESSENTIAL FEATURES (EXPLICIT NAMES) ===")
 
@@ -10,128 +23,142 @@ print("=== EXTRACTING FINAL ESSENTIAL FEATURES (EXPLICIT NAMES) ===")
 data_path = "/home/nishat/physionet.org/files/mimiciv/3.1/"
 output_file = "FINAL_ESSENTIAL_FEATURES_EXPLICIT.csv"
 
+# Per-itemid data profile of every scan (profiles.py), saved next to the output
+PROFILES = {}
+
 # Load patient cohort
-cohort = pd.read_csv('filtered_patients_corrected.csv')
+cohort = apply_sample(pd.read_csv('filtered_patients_corrected.csv'))
 our_patients = cohort['subject_id'].unique().tolist()
 print(f"Patients: {len(our_patients)}")
 
-# Get ICU admission times for time window filtering
-cohort_times = cohort[['subject_id', 'intime']].copy()
-cohort_times['intime'] = pd.to_datetime(cohort_times['intime'])
-cohort_times['end_time'] = cohort_times['intime'] + timedelta(hours=30)
+# Cohort units (first stay per patient, or every stay with --stays) and their
+# 30-hour windows; accumulators are indexed by unit
+units = cohort_units(cohort)
+KEY_COLUMNS = unit_frame(units).columns.tolist()
+print(f"Units: {len(units['subject_id'])} ({' + '.join(KEY_COLUMNS)})")
+
+# labevents has no stay_id; labs drawn up to this many hours before intime
+# can be attributed to the stay (0 = inside the window only)
+LAB_LOOKBACK_HOURS = 0
 
-# ESSENTIAL FEATURES MAPPING - WITH EXPLICIT NAMES
-ESSENTIAL_FEATURES = {
+# ESSENTIAL FEATURES - itemids resolved through the concept dictionary (concepts.py)
+ESSENTIAL_FEATURE_NAMES = [
     # Blood Gas & Oxygenation
-    'PO2': [220224, 490, 50821, 50816],  # mmHg
-    'FiO2': [223835, 3420, 3422, 189, 190],  # %
-    'SpO2': [220277, 646, 834],  # %
-    
+    'PO2', 'FiO2', 'SpO2',
     # Laboratory Values
-    'Bilirubin': [50885, 50884, 4948, 4949],  # mg/dl
-    'Lactate': [50813, 818, 1531],  # mmol/l
-    'CRP': [50889],  # mg/l
-    'Leukocytes': [51301, 51300, 51302, 51303],  # /nl
-    'Blood_Sugar': [50809, 50931, 807, 811, 1529],  # mg/dl (EXPLICIT NAME)
-    'Platelets': [51265, 51256, 52769],  # 10³/mm³
-    'Creatinine': [50912, 791, 1525],  # mg/dl
-    
+    'Bilirubin', 'Lactate', 'CRP', 'Leukocytes', 'Blood_Sugar', 'Platelets', 'Creatinine',
     # Blood Pressure
-    'Systolic_BP': [220050, 51, 455, 6701, 442, 6701],  # mmHg
-    'Diastolic_BP': [220051, 8368, 8441, 8555, 443, 8440],  # mmHg
-    'Mean_Blood_Pressure': [220052, 456, 52, 6702, 444],  # mmHg (EXPLICIT NAME)
-    
+    'Systolic_BP', 'Diastolic_BP', 'Mean_Blood_Pressure',
     # Vital Signs
-    'Respiratory_Rate': [220210, 618, 615, 614, 651],  # /min
-    'Heart_Rate': [220045, 211, 220046],  # /min
-    'Temperature': [223762, 676, 677, 678, 223761, 679],  # °C
-    
-    # Output
-    'Urine_Output': [226559, 226560, 227510, 227489],  # ml/h
-    
+    'Respiratory_Rate', 'Heart_Rate', 'Temperature',
+    # Output (ml/kg/h, see urine_output.py)
+    'Urine_Output',
     # Neurological Scores
-    'GCS': [198, 226755, 227013],  # 3-15 scale
-    'GCS_Eye': [220739, 184],
-    'GCS_Verbal': [223900, 723],
-    'GCS_Motor': [223901, 454],
-}
+    'GCS', 'GCS_Eye', 'GCS_Verbal', 'GCS_Motor',
+]
+ESSENTIAL_FEATURES = {name: concept_itemids(name).tolist() for name in ESSENTIAL_FEATURE_NAMES}
 
 # REQUIRED COLUMNS - WITH EXPLICIT NAMES
 REQUIRED_COLUMNS = [
     'PO2', 'FiO2', 'Bilirubin', 'Lactate', 'Systolic_BP', 'Diastolic_BP', 
     'Mean_Blood_Pressure', 'CRP', 'Leukocytes', 'Urine_Output', 'Blood_Sugar', 
     'Respiratory_Rate', 'Heart_Rate', 'Platelets', 'Creatinine', 'Temperature', 
-    'SOFA_score', 'GCS', 'SpO2'  # Added SpO2 explicitly
+    'GCS', 'SpO2'  # Added SpO2 explicitly
 ]
+# SOFA_score is computed by sofa.py from this table and merged in final.py
 
 # Initialize results dataframe
-results = pd.DataFrame({'subject_id': our_patients})
+results = unit_frame(units)
 
 # Add all required columns (initialize with NaN)
 for feature in REQUIRED_COLUMNS:
-    if feature != 'SOFA_score':  # SOFA will be loaded separately
-        results[f'{feature}_min'] = np.nan
-        results[f'{feature}_max'] = np.nan
+    results[f'{feature}_min'] = np.nan
+    results[f'{feature}_max'] = np.nan
 
-def extract_feature(feature_name, itemids, source_file, value_column='valuenum'):
+def extract_feature(feature_name, itemids, source_file, value_column='valuenum', lookback_hours=0):
     """Extract a single feature with comprehensive error handling"""
     print(f"  Extracting {feature_name}...")
     
-    all_data = []
+    sketch = concept_sketch(feature_name, len(results))
+    profile = PROFILES[feature_name] = new_profile(itemids)
+    table = conversion_table(itemids)
+    rejected = 0
     
     try:
         file_path = os.path.join(data_path, source_file)
-        chunks = pd.read_csv(file_path, chunksize=500000,
-                            usecols=['subject_id', 'itemid', 'charttime', value_column])
+        if use_duckdb():
+            # Itemid filter and window join in one DuckDB query (duckdb_backend.py)
+            unit, itemid, values = window_events(file_path, value_column, itemids, units, lookback_hours, profile)
+            values = normalize_values(feature_name, itemid, values, table)
+            rejected = int(np.isnan(values).sum())
+            plausible = ~np.isnan(values)
+            update_sketch(sketch, unit[plausible], values[plausible])
+        else:
+            chunks = read_csv_chunks(file_path, reserved_bytes=sum(a.nbytes for a in sketch.values()),
+                                     subjects=units['subject_id'],
+                                     usecols=['subject_id', 'itemid', 'charttime', value_column])
         
-        for chunk_idx, chunk in enumerate(chunks):
-            # Filter for our patients and valid values
-            chunk = chunk[chunk['subject_id'].isin(our_patients)]
-            chunk = chunk[chunk[value_column].notna() & (chunk[value_column] > 0)]
-            
-            if chunk.empty:
-                continue
+            for chunk_idx, chunk in enumerate(chunks):
+                # This feature's itemids, for every subject read (the data profile counts them as scanned)
+                chunk = chunk[chunk['itemid'].isin(itemids)]
+                in_cohort = chunk['subject_id'].isin(our_patients).to_numpy()
+                raw = chunk[value_column].to_numpy(dtype=float)
                 
-            # Merge with time windows to get first 30 hours only
-            chunk_with_time = chunk.merge(cohort_times, on='subject_id', how='inner')
-            chunk_with_time['charttime'] = pd.to_datetime(chunk_with_time['charttime'])
+                # Attribute cohort events to their unit's stay window (first 30 hours only)
+                unit = np.full(len(chunk), -1, dtype=np.int64)
+                unit[in_cohort] = attribute_stays(units, chunk['subject_id'].to_numpy()[in_cohort],
+                                                  to_epoch_seconds(chunk['charttime'].to_numpy()[in_cohort]),
+                                                  lookback_hours)
+                update_profile(profile, chunk['itemid'].to_numpy(), raw, in_cohort, unit >= 0)
             
-            chunk_filtered = chunk_with_time[
-                (chunk_with_time['charttime'] >= chunk_with_time['intime']) &
-                (chunk_with_time['charttime'] <= chunk_with_time['end_time'])
-            ]
+                # Convert units and drop physiologically implausible values (units.py);
+                # rejects are counted over in-window rows, as window_events returns them
+                values = normalize_values(feature_name, chunk['itemid'].to_numpy(), raw, table)
+                rejected += int(((unit >= 0) & ~np.isnan(raw) & np.isnan(values)).sum())
+                in_window = (unit >= 0) & ~np.isnan(values)
             
-            # Extract feature data
-            feature_data = chunk_filtered[chunk_filtered['itemid'].isin(itemids)]
+                # Fold the chunk into the per-subject streaming sketch (sketches.py)
+                if in_window.any():
+                    update_sketch(sketch, unit[in_window], values[in_window])
             
-            if not feature_data.empty:
-                all_data.append(feature_data[['subject_id', value_column]])
-            
-            if chunk_idx % 20 == 0 and chunk_idx > 0:
-                print(f"    Processed {chunk_idx + 1} chunks...")
+                if chunk_idx % 20 == 0 and chunk_idx > 0:
+                    print(f"    Processed {chunk_idx + 1} chunks...")
         
-        # Aggregate results
-        if all_data:
-            combined_data = pd.concat(all_data, ignore_index=True)
-            stats = combined_data.groupby('subject_id')[value_column].agg(['min', 'max']).reset_index()
-            
-            # Update results
-            for _, row in stats.iterrows():
-                subject_id = row['subject_id']
-                mask = results['subject_id'] == subject_id
-                results.loc[mask, f'{feature_name}_min'] = row['min']
-                results.loc[mask, f'{feature_name}_max'] = row['max']
-            
-            print(f"    ✅ {feature_name}: {len(stats)} patients")
-            return True
-        else:
-            print(f"    ❌ {feature_name}: No data found")
-            return False
+        return store_feature(feature_name, sketch, rejected)
             
     except Exception as e:
         print(f"    ⚠️  Error extracting {feature_name}: {e}")
         return False
 
+def extract_features_parallel(feature_names, source_file, workers, lookback_hours=0):
+    """Extract several features in one pass over a source file, split across worker processes"""
+    print(f"  Extracting {', '.join(feature_names)} in one pass ({workers} workers)...")
+    features = {name: ESSENTIAL_FEATURES[name] for name in feature_names}
+    try:
+        scanned = scan_features(os.path.join(data_path, source_file), features, units,
+                                lookback_hours=lookback_hours, workers=workers)
+    except Exception as e:
+        print(f"    ⚠️  Error extracting features from {source_file}: {e}")
+        return False
+    for feature_name, (sketch, profile, rejected) in scanned.items():
+        PROFILES[feature_name] = profile
+        store_feature(feature_name, sketch, rejected)
+    return True
+
+def store_feature(feature_name, sketch, rejected):
+    """Aggregate a feature's sketch into the results columns"""
+    summary = summarize_sketch(sketch)
+    n_patients = int((summary['count'] > 0).sum())
+    if n_patients:
+        for stat in ['min', 'max'] + SKETCH_STATS:
+            results[f'{feature_name}_{stat}'] = summary[stat]
+        
+        print(f"    ✅ {feature_name}: {n_patients} patients ({rejected} implausible values dropped)")
+        return True
+    else:
+        print(f"    ❌ {feature_name}: No data found")
+        return False
+
 def extract_lab_features():
     """Extract laboratory features"""
     print("\n=== EXTRACTING LABORATORY FEATURES ===")
@@ -141,8 +168,14 @@ def extract_lab_features():
         'Platelets', 'Creatinine'
     ]
     
+    # With --workers N, one parallel pass over labevents for all lab features
+    if scan_workers() > 1 and not use_duckdb():
+        extract_features_parallel(lab_features, 'hosp/labevents.csv', scan_workers(), LAB_LOOKBACK_HOURS)
+        return
+    
     for feature in lab_features:
-        extract_feature(feature, ESSENTIAL_FEATURES[feature], 'hosp/labevents.csv')
+        extract_feature(feature, ESSENTIAL_FEATURES[feature], 'hosp/labevents.csv',
+                        lookback_hours=LAB_LOOKBACK_HOURS)
 
 def extract_chart_features():
     """Extract chart features"""
@@ -153,14 +186,29 @@ def extract_chart_features():
         'Respiratory_Rate', 'Heart_Rate', 'Temperature', 'GCS', 'GCS_Eye', 'GCS_Verbal', 'GCS_Motor'
     ]
     
+    # With --workers N, one parallel pass over chartevents for all chart features
+    if scan_workers() > 1 and not use_duckdb():
+        extract_features_parallel(chart_features, 'icu/chartevents.csv', scan_workers())
+        return
+    
     for feature in chart_features:
         extract_feature(feature, ESSENTIAL_FEATURES[feature], 'icu/chartevents.csv')
 
 def extract_urine_output():
-    """Extract urine output"""
+    """Extract hourly urine output rate (ml/kg/h) and KDIGO rolling minima"""
     print("\n=== EXTRACTING URINE OUTPUT ===")
-    extract_feature('Urine_Output', ESSENTIAL_FEATURES['Urine_Output'], 
-                   'icu/outputevents.csv', 'value')
+    global results
+    try:
+        PROFILES['Urine_Output'] = new_profile(ESSENTIAL_FEATURES['Urine_Output'])
+        urine = extract_urine_rates(cohort, ESSENTIAL_FEATURES['Urine_Output'], profile=PROFILES['Urine_Output'])
+    except Exception as e:
+        print(f"    ⚠️  Error extracting Urine_Output: {e}")
+        return False
+
+    results = results.drop(columns=['Urine_Output_min', 'Urine_Output_max'])
+    results = results.merge(urine[KEY_COLUMNS + ['Urine_Output_min', 'Urine_Output_max'] + URINE_COLUMNS],
+                            on=KEY_COLUMNS, how='left')
+    return True
 
 def ensure_gcs_completeness():
     """Ensure GCS is complete"""
@@ -206,60 +254,6 @@ def ensure_gcs_completeness():
             calculated_count = valid_min.sum()
             print(f"  ✅ Added GCS from components for {calculated_count} patients")
 
-def load_sofa_scores():
-    """Load SOFA scores from existing file"""
-    print("\n=== LOADING SOFA SCORES ===")
-    
-    try:
-        sofa_df = pd.read_csv('sofa.csv')
-        
-        if 'subject_id' in sofa_df.columns:
-            # Look for SOFA columns
-            sofa_cols = ['subject_id']
-            
-            if 'sofa_total_min' in sofa_df.columns and 'sofa_total_max' in sofa_df.columns:
-                sofa_cols.extend(['sofa_total_min', 'sofa_total_max'])
-                # Rename to match our naming convention
-                sofa_df = sofa_df.rename(columns={
-                    'sofa_total_min': 'SOFA_score_min',
-                    'sofa_total_max': 'SOFA_score_max'
-                })
-            elif 'sofa_total' in sofa_df.columns:
-                sofa_df['SOFA_score_min'] = sofa_df['sofa_total']
-                sofa_df['SOFA_score_max'] = sofa_df['sofa_total']
-                sofa_cols.extend(['SOFA_score_min', 'SOFA_score_max'])
-            else:
-                # Find any SOFA-related columns
-                possible_sofa_cols = [col for col in sofa_df.columns if 'sofa' in col.lower()]
-                if possible_sofa_cols:
-                    # Use the first SOFA column found for both min and max
-                    sofa_col = possible_sofa_cols[0]
-                    sofa_df['SOFA_score_min'] = sofa_df[sofa_col]
-                    sofa_df['SOFA_score_max'] = sofa_df[sofa_col]
-                    sofa_cols.extend(['SOFA_score_min', 'SOFA_score_max'])
-                else:
-                    print("  ❌ No SOFA columns found")
-                    return False
-            
-            # Merge with results
-            global results
-            results = results.merge(sofa_df[['subject_id', 'SOFA_score_min', 'SOFA_score_max']], 
-                                  on='subject_id', how='left')
-            
-            sofa_count = results['SOFA_score_min'].notna().sum()
-            print(f"  ✅ SOFA scores loaded for {sofa_count} patients")
-            return True
-        else:
-            print("  ❌ 'subject_id' column not found in sofa.csv")
-            return False
-            
-    except FileNotFoundError:
-        print("  ❌ sofa.csv file not found")
-        return False
-    except Exception as e:
-        print(f"  ❌ Error loading sofa.csv: {e}")
-        return False
-
 def verify_all_columns():
     """Verify that ALL required columns are present"""
     print("\n" + "="*70)
@@ -288,8 +282,6 @@ def verify_all_columns():
                 display_name = 'Mean Blood Pressure'
             elif feature == 'Blood_Sugar':
                 display_name = 'Blood Sugar'
-            elif feature == 'SOFA_score':
-                display_name = 'SOFA Score'
             elif feature == 'GCS':
                 display_name = 'GCS'
             
@@ -324,15 +316,17 @@ def main():
     extract_chart_features()
     extract_urine_output()
     ensure_gcs_completeness()
-    load_sofa_scores()
     
     # Final verification
     verify_all_columns()
     
     # Select only the required columns for final output
-    final_columns = ['subject_id']
+    final_columns = list(KEY_COLUMNS)
     for feature in REQUIRED_COLUMNS:
         final_columns.extend([f'{feature}_min', f'{feature}_max'])
+    for feature in REQUIRED_COLUMNS:
+        final_columns.extend(f'{feature}_{stat}' for stat in SKETCH_STATS)
+    final_columns.extend(URINE_COLUMNS)
     
     # Keep only columns that exist
     available_columns = [col for col in final_columns if col in results.columns]
@@ -344,6 +338,8 @@ def main():
     
     # Final summary
     print(f"✅ Saved: {output_file}")
+    profile_csv, _ = save_profiles(PROFILES, output_file)
+    print(f"🔎 Data profile per itemid: {profile_csv}")
     print(f"📊 Total patients: {len(final_results)}")
     print(f"🔢 Total columns: {len(final_results.columns)}")
     